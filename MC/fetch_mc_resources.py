@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 
-import inspect
+import asyncio
 import subprocess
 
 
@@ -30,27 +30,70 @@ def msg(*args, color=bcolors.BOKBLUE):
 
 
 DRY_MODE_RUNNING = False
+# Maximum number of grid commands running at the same time
+MAX_CONCURRENT_COMMANDS = 8
 
 
-def run_cmd(cmd, print_output=True):
+# Persistent alien session used for the metadata commands, if enabled
+ALIEN_SESSION = None
+
+
+def enable_alien_session():
+    """
+    Sends the metadata commands through the persistent alien session of `QC/Tools/grid_commands.py`
+    """
+    global ALIEN_SESSION
+    from grid_commands import AlienSession
+    ALIEN_SESSION = AlienSession()
+
+
+async def run_cmd_async(cmd, print_output=True, timeout=None, semaphore=None):
     vmsg("Running command:", f"`{cmd}`")
     cmd = cmd.split()
-    if DRY_MODE_RUNNING:
-        msg("Dry mode!!!")
-        return
-    if "capture_output" in inspect.signature(subprocess.run).parameters:
-        # Python 3.7+
-        run_result = subprocess.run(cmd, capture_output=True)
-    else:
-        run_result = subprocess.run(cmd)
+    if ALIEN_SESSION is not None and ALIEN_SESSION.handles(cmd):
+        run_result = await ALIEN_SESSION.run_async(cmd, timeout=timeout)
+        # None if the session cannot be opened, the command then runs as a separate process
+        if run_result is not None:
+            return run_result
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(*cmd,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            stdout, stderr = b"", f"Timeout after {timeout} s".encode()
+        except asyncio.CancelledError:
+            proc.kill()
+            await proc.wait()
+            raise
+    run_result = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
     if print_output:
-        if run_result.stdout is not None:
-            vmsg("stdout:", run_result.stdout.decode('ascii'))
-        if run_result.stderr is not None:
-            vmsg("stderr:", run_result.stderr.decode('ascii'))
+        vmsg("stdout:", run_result.stdout.decode('ascii'))
+        vmsg("stderr:", run_result.stderr.decode('ascii'))
     return run_result
 
 
+def run_cmds(cmds, print_output=True, timeout=None):
+    """
+    Runs the commands concurrently (at most MAX_CONCURRENT_COMMANDS at the same time), returns the results in the same order
+    """
+    if DRY_MODE_RUNNING:
+        msg("Dry mode!!!")
+        return [None for i in cmds]
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+        return await asyncio.gather(*[run_cmd_async(i, print_output=print_output, timeout=timeout, semaphore=semaphore) for i in cmds])
+    return asyncio.run(run_all())
+
+
+def run_cmd(cmd, print_output=True, timeout=None):
+    return run_cmds([cmd], print_output=print_output, timeout=timeout)[0]
+
+
 def extract_time(logfile="logtmp_3047049637.txt"):
     print("Input file", logfile)
     results = run_cmd(f"cat {logfile}", print_output=False)
@@ -168,35 +211,23 @@ def main(alien_path=None,
     out_directory = os.path.join(out_directory, alien_path.strip("/").split("/")[-1])
     os.makedirs(out_directory, exist_ok=True)
 
-    def download_file(full_alien_path, target_path):
-        local_file = os.path.join(target_path, full_alien_path.split("/")[-1])
-        if os.path.isfile(local_file):
-            files.append(local_file)
-            return local_file
-
-        if 0:  # Check the stats
-            r = run_cmd(f"alien_stat alien://{full_alien_path}", print_output=True)
-            if r.returncode != 0:
-                print("File not found")
-                return
-        run_cmd(f"alien_cp alien://{full_alien_path} file:{target_path}", print_output=False)
-        return local_file
-
-    files = []
+    def download_files(full_alien_paths, target_path):
+        # Downloads concurrently the files that are not there yet
+        local_files = [os.path.join(target_path, i.split("/")[-1]) for i in full_alien_paths]
+        to_download = [i for i, j in zip(full_alien_paths, local_files) if not os.path.isfile(j)]
+        run_cmds([f"alien_cp alien://{i} file:{target_path}" for i in to_download], print_output=False)
+        return local_files
+
+    log_files_found = [i for i in log_files_found if i != ""]
+    metric_files_found = [i for i in metric_files_found if i != ""]
+    files = download_files(log_files_found, out_directory)
     aods = {}
-    for i in log_files_found:
-        if i == "":
-            continue
-        f = download_file(i, out_directory)
+    for f, i in zip(files, log_files_found):
         aods[f] = i.replace(i.split('/')[-1], "AO2D.root")
-        files.append(f)
 
     job_efficiency = []
     if compute_efficiency:
-        for i in metric_files_found:
-            if i == "":
-                continue
-            f = download_file(i, out_directory)
+        for f in download_files(metric_files_found, out_directory):
             eff_file = f+"efficiency"
             if os.path.isfile(eff_file):
                 with open(eff_file) as eff_file:
@@ -213,6 +244,7 @@ def main(alien_path=None,
 
     sizes = []
     if 1:
+        to_stat = []
         for f in aods:
             sizefile = f+"size"
             if os.path.isfile(sizefile):
@@ -221,8 +253,10 @@ def main(alien_path=None,
                         sizes.append(float(j))
                         break
                     continue
-            i = aods[f]
-            r = run_cmd(f"alien_stat alien://{i}", print_output=False)
+            to_stat.append(f)
+        stats = run_cmds([f"alien_stat alien://{aods[f]}" for f in to_stat], print_output=False)
+        for f, r in zip(to_stat, stats):
+            sizefile = f+"size"
             r = r.stdout.decode("ascii").split("\n")
             for j in r:
                 if "Size:" not in j:
@@ -298,9 +332,13 @@ if __name__ == "__main__":
                         help='Number of parallel workers')
     parser.add_argument('--max_files', "-m", type=int, default=-1,
                         help='Max files to check')
+    parser.add_argument('--alien_session', "-S", action="store_true",
+                        help='Run the alien metadata commands through one persistent alien session')
     parser.add_argument('--logfile', "-l", choices=["pipeline_action", "logtmp"], default="pipeline_action",
                         help='Number of parallel workers')
     args = parser.parse_args()
+    if args.alien_session:
+        enable_alien_session()
     main(alien_path=args.alien_path,
          parallel_workers=args.parallel_workers,
          max_files=args.max_files,
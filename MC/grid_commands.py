@@ -0,0 +1 @@
+../QC/Tools/grid_commands.py
\ No newline at end of file
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
-from ROOT import TCanvas, TColor, TLatex, TH1, gPad, TFile, TH2F, gStyle
+import os
+import threading
+from collections import OrderedDict
 import numpy as np
+# ROOT is imported in the functions using it, so that importing this module does not load ROOT
 
 
 nice_labels = []
@@ -10,6 +13,7 @@ nice_labels = []
 def draw_nice_label(l, x=0.7, y=0.5, s=0.035, yd=0, align=11):
     if type(l) is not str:
         raise ValueError(f"Label {l} must be a string, but is a type {type(l)}")
+    from ROOT import TLatex
     latex = TLatex(x, y+yd, l)
     latex.SetNDC()
     latex.SetTextFont(42)
@@ -20,24 +24,168 @@ def draw_nice_label(l, x=0.7, y=0.5, s=0.035, yd=0, align=11):
     return latex
 
 
+class ObjectCache:
+    def __init__(self, max_files=8, max_objects=256):
+        """
+        Bounded cache of the open ROOT files and of the objects read from them, the least recently used are evicted.
+        Files are keyed by (path, modification time) and objects by (path, modification time, object path),
+        so a file changed on disk is read again.
+        """
+        self.max_files = max_files
+        self.max_objects = max_objects
+        self.files = OrderedDict()
+        self.objects = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.file_hits = 0
+        self.file_misses = 0
+
+    def file_key(self, filename):
+        if os.path.isfile(filename):
+            filename = os.path.abspath(filename)
+            return filename, os.path.getmtime(filename)
+        # Remote files
+        return filename, None
+
+    def is_open(self, filename):
+        return self.file_key(filename) in self.files
+
+    def open(self, filename):
+        """
+        Returns the file opened for reading, kept open until it is evicted or released
+        """
+        key = self.file_key(filename)
+        with self.lock:
+            if key in self.files:
+                self.file_hits += 1
+                self.files.move_to_end(key)
+                return self.files[key]
+            self.file_misses += 1
+            # Older versions of the same file are not needed anymore
+            self.release(key[0])
+            from ROOT import TFile
+            f = TFile.Open(key[0], "READ")
+            if not f or f.IsZombie():
+                raise ValueError(f"Cannot open {filename}")
+            self.files[key] = f
+            while len(self.files) > self.max_files:
+                self.close_file(*self.files.popitem(last=False))
+            return f
+
+    def get(self, filename, objname, read=None, copy=False):
+        """
+        Returns the object `objname` of the file, None if not found.
+        If not cached it is read with `read(file, objname)`, by default `file.Get(objname)`.
+        With `copy` a clone of the cached object is returned, that the caller can modify.
+        """
+        key = self.file_key(filename) + (objname,)
+        with self.lock:
+            if key in self.objects:
+                self.hits += 1
+                self.objects.move_to_end(key)
+                obj = self.objects[key]
+            else:
+                self.misses += 1
+                f = self.open(filename)
+                obj = read(f, objname) if read is not None else f.Get(objname)
+                if not obj:
+                    return None
+                if not detach(obj):
+                    # Directories and trees stay attached to the file and are not cached
+                    return obj
+                self.objects[key] = obj
+                while len(self.objects) > self.max_objects:
+                    self.objects.popitem(last=False)
+        if copy:
+            obj = obj.Clone()
+            detach(obj)
+        return obj
+
+    def close_file(self, key, f):
+        f.Close()
+        for i in [i for i in self.objects if i[:2] == key]:
+            del self.objects[i]
+
+    def release(self, filename):
+        """
+        Closes the file (all its versions) and drops its objects
+        """
+        if os.path.isfile(filename):
+            filename = os.path.abspath(filename)
+        with self.lock:
+            for key in [i for i in self.files if i[0] == filename]:
+                self.close_file(key, self.files.pop(key))
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.files):
+                self.close_file(key, self.files.pop(key))
+            self.objects.clear()
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "file_hits": self.file_hits,
+                "file_misses": self.file_misses,
+                "open_files": len(self.files),
+                "objects": len(self.objects)}
+
+
+def detach(obj):
+    """
+    Detaches a histogram (or efficiency) from its file, so that it is kept when the file is closed.
+    Returns False for the objects that cannot live without their file (directories, trees).
+    """
+    if obj.InheritsFrom("TDirectory") or obj.InheritsFrom("TTree"):
+        return False
+    if (obj.InheritsFrom("TH1") or obj.InheritsFrom("TEfficiency")) and obj.GetDirectory():
+        import ROOT
+        obj.SetDirectory(0)
+        # Not owned by the file anymore, deleted when not referenced
+        ROOT.SetOwnership(obj, True)
+    return True
+
+
+object_cache = None
+
+
+def get_object_cache():
+    """
+    Returns the cache of files and objects shared by all the scripts
+    """
+    global object_cache
+    if object_cache is None:
+        object_cache = ObjectCache()
+    return object_cache
+
+
+def set_object_cache_size(max_files=None, max_objects=None):
+    cache = get_object_cache()
+    if max_files is not None:
+        cache.max_files = max_files
+    if max_objects is not None:
+        cache.max_objects = max_objects
+
+
 def getfromfile(filename, objname="", alternatives=None):
-    f = TFile(filename, "READ")
+    """
+    Returns a copy of the object of the file, the file and the object are read once through the shared cache
+    """
+    cache = get_object_cache()
     if type(objname) is int:
-        objname = f.GetListOfKeys().At(objname).GetName()
-    obj = f.Get(objname)
+        objname = cache.open(filename).GetListOfKeys().At(objname).GetName()
+    obj = cache.get(filename, objname, copy=True)
     if not obj:
         if alternatives is not None:
             if type(alternatives) is not list:
                 alternatives = [alternatives]
             print("Trying alternatives to", objname, "trying", alternatives[0], "in", alternatives)
             return getfromfile(filename, objname=alternatives.pop(0), alternatives=alternatives)
-        f.ls()
+        cache.open(filename).ls()
         raise ValueError("Did not find", objname, "in", filename)
     if "Directory" in obj.ClassName():
         obj.ls()
-    if "TH" in obj.ClassName() and "Sparse" not in obj.ClassName():
-        obj.SetDirectory(0)
-    f.Close()
     return obj
 
 
@@ -45,6 +193,7 @@ transposed_histos = {}
 
 
 def transpose_th2(h):
+    from ROOT import TH2F
     htransposed = TH2F(f"htransposed_{h.GetName()}", f"htransposed_{h.GetName()};{h.GetYaxis().GetTitle()};{h.GetXaxis().GetTitle()}", h.GetYaxis().GetNbins(),
                        h.GetYaxis().GetXmin(), h.GetYaxis().GetXmax(), h.GetXaxis().GetNbins(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
     for ix in range(1, h.GetNbinsX() + 1):
@@ -63,6 +212,7 @@ nice_canvases = {}
 
 def draw_nice_canvas(name, x=800, y=800, logx=False, logy=False, logz=True, title=None, replace=True, extend_right=False):
     global nice_canvases
+    from ROOT import TCanvas
     if not replace and name in nice_canvases:
         c = nice_canvases[name]
         c.cd()
@@ -102,6 +252,7 @@ nice_frames = {}
 
 
 def make_color_range(ncolors, simple=False):
+    from ROOT import TColor, gStyle
     if ncolors <= 0:
         print("ncolors must be > 0")
     if ncolors == 1:
@@ -140,6 +291,7 @@ def make_color_range(ncolors, simple=False):
 
 
 def set_nice_frame(h):
+    from ROOT import TH1
     h.SetBit(TH1.kNoStats)
     h.SetBit(TH1.kNoTitle)
     h.GetYaxis().SetTitleSize(0.04)
@@ -149,6 +301,7 @@ def set_nice_frame(h):
 
 
 def draw_nice_frame(c, x, y, xt, yt):
+    from ROOT import gPad
     if c is None:
         gPad.cd()
     else:
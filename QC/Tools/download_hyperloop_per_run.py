@@ -7,20 +7,22 @@ Example usage: `./download_per_run.py TRAIN_ID`
 """
 
 import os
-try:
-    from ROOT import TFile, TH1, TF1, TLatex, gMinuit, TNamed
-    import ROOT
-except:
-    raise Exception("Cannot find ROOT, are you in a ROOT enviroment?")
-from multiprocessing import Pool
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
 
 try:
     import tqdm
 except ImportError as e:
+    tqdm = None
     print("Module tqdm is not imported.",
           "Progress bar will not be available (you can install tqdm for the progress bar) `pip3 install --user tqdm`")
 
-from utils import draw_nice_canvas, draw_nice_frame
+from utils import draw_nice_canvas, draw_nice_frame, get_object_cache
+from hyperloop_catalog import get_catalog, is_valid
+from hyperloop_trains import get_fetcher
+from grid_commands import get_runner, traced, set_trace_file, enable_alien_session
+import hist_arrays
 
 # Modes
 VERBOSE_MODE = False
@@ -41,11 +43,61 @@ def set_dry_mode():
     print("Turning on dry mode")
 
 
+REMOTE_READ_PREFIX = None
+
+
+def set_remote_read_prefix(prefix):
+    """
+    Sets the prefix used to open the remote files for object-level reads (e.g. `root://localhost:1094/`).
+    By default the files are opened from alien.
+    """
+    global REMOTE_READ_PREFIX
+    REMOTE_READ_PREFIX = prefix
+    print("Reading remote objects from", prefix)
+
+
+READER_BACKEND = "root"
+
+
+def set_reader_backend(backend):
+    """
+    Sets the backend used to read the objects from the files: `root` (PyROOT) or `uproot`.
+    With `uproot` the one dimensional histograms are read as `hist_arrays.ArrayHisto` without importing ROOT,
+    ROOT is only used for the other objects, the fits and the drawing.
+    """
+    global READER_BACKEND
+    if backend not in ["root", "uproot"]:
+        raise ValueError(f"Reader backend {backend} not recognized")
+    if backend == "uproot":
+        try:
+            import uproot
+        except ImportError:
+            wmsg("Module uproot is not imported, reading with ROOT (you can install it with `pip3 install --user uproot`)")
+            return
+    READER_BACKEND = backend
+    vmsg("Using reader backend", backend)
+
+
+HISTOGRAM_BACKEND = "root"
+
+
+def set_histogram_backend(backend):
+    """
+    Sets the backend used for the histogram statistics: `root` (PyROOT calls) or `numpy` (`hist_arrays`)
+    """
+    global HISTOGRAM_BACKEND
+    if backend not in ["root", "numpy"]:
+        raise ValueError(f"Histogram backend {backend} not recognized")
+    HISTOGRAM_BACKEND = backend
+    vmsg("Using histogram backend", backend)
+
+
 labels_drawn = []
 
 
 def draw_label(label, x=0.55, y=0.96, size=0.035, align=21, ndc=True):
     global labels_drawn
+    from ROOT import TLatex
     while label.startswith(" ") or label.endswith(" "):
         label = label.strip()
     l = TLatex(x, y, label)
@@ -94,27 +146,300 @@ def fatal_msg(*args, fatal_message="Fatal Error!"):
     raise RuntimeError(fatal_message)
 
 
-def run_cmd(cmd, print_output=True):
-    vmsg("Running command:", f"`{cmd}`")
-    cmd = cmd.split()
-    if DRY_MODE_RUNNING:
-        msg("Dry mode!!!")
-        return
-    import subprocess
-    import inspect
-    if "capture_output" in inspect.signature(subprocess.run).parameters:
-        # Python 3.7+
-        run_result = subprocess.run(cmd, capture_output=True)
-    else:
-        run_result = subprocess.run(cmd)
+def print_cmd_output(run_result, print_output=True):
     if print_output:
         if run_result.stdout is not None:
             vmsg("-- stdout:", run_result.stdout.decode('ascii'))
         if run_result.stderr is not None and run_result.stderr != b"":
             vmsg("-- stderr:", run_result.stderr.decode('ascii'))
+
+
+def run_cmd(cmd, print_output=True, timeout="default", tags=None):
+    vmsg("Running command:", f"`{cmd}`")
+    cmd = cmd.split()
+    if DRY_MODE_RUNNING:
+        msg("Dry mode!!!")
+        return
+    run_result = get_runner().run(cmd, timeout=timeout, tags=tags)
+    print_cmd_output(run_result, print_output)
     return run_result
 
 
+async def run_cmd_async(cmd, print_output=True, timeout="default", tags=None):
+    """
+    Same as `run_cmd`, to be awaited from coroutines running on the grid command runner
+    """
+    vmsg("Running command:", f"`{cmd}`")
+    cmd = cmd.split()
+    if DRY_MODE_RUNNING:
+        msg("Dry mode!!!")
+        return
+    run_result = await get_runner().run_async(cmd, timeout=timeout, tags=tags)
+    print_cmd_output(run_result, print_output)
+    return run_result
+
+
+def parse_alien_find(out, directory):
+    import json
+    if out is None:
+        return None
+    try:
+        listing = json.loads(out.stdout.decode('ascii'))
+    except ValueError:
+        wmsg("Cannot parse listing of", directory)
+        return None
+    found = []
+    for i in listing.get("results", []):
+        if "lfn" not in i or "size" not in i:
+            continue
+        found.append({"lfn": i["lfn"], "size": int(i["size"]), "md5": i.get("md5", None)})
+    return found
+
+
+def alien_find(directory, pattern, tags=None):
+    """
+    Finds recursively the files matching the pattern in a directory on alien.
+    Returns a list of dictionaries with the `lfn`, `size` and `md5` of each file or None if the listing failed.
+    """
+    return parse_alien_find(run_cmd(f"alien_find -json -f {directory} {pattern}", print_output=False, tags=tags), directory)
+
+
+async def alien_find_async(directory, pattern, tags=None):
+    return parse_alien_find(await run_cmd_async(f"alien_find -json -f {directory} {pattern}", print_output=False, tags=tags), directory)
+
+
+def parse_alien_ls(out, directories):
+    import json
+    if out is None:
+        return None
+    try:
+        listing = json.loads(out.stdout.decode('ascii'))
+    except ValueError:
+        wmsg("Cannot parse listing of", directories)
+        return None
+    found = []
+    for i in listing.get("results", []):
+        lfn = i.get("lfn", i.get("path", None))
+        if lfn is None or "size" not in i or lfn.endswith("/"):
+            continue
+        found.append({"lfn": lfn, "size": int(i["size"]), "md5": i.get("md5", None)})
+    return found
+
+
+async def alien_ls_files_async(directories, tags=None):
+    """
+    Lists (not recursively) the files of several directories on alien with a single `alien_ls`.
+    Returns a list of dictionaries with the `lfn`, `size` and `md5` of each file or None if the listing failed.
+    """
+    return parse_alien_ls(await run_cmd_async("alien_ls -json -l -m " + " ".join(directories), print_output=False, tags=tags), directories)
+
+
+class AlienMetadataIndex:
+    """
+    In-memory index of the size and checksum of the files on alien.
+    It is filled with bulk listings of whole directories, single files not covered by any listing are stat'ed on demand.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        # Directories listed, with the depth of the listing (None if complete)
+        self.listed_dirs = {}
+
+    @staticmethod
+    def normalize(lfn):
+        lfn = lfn.replace("alien://", "")
+        while "//" in lfn:
+            lfn = lfn.replace("//", "/")
+        return lfn
+
+    def add(self, lfn, size, md5=None):
+        self.entries[self.normalize(lfn)] = {"size": int(size), "md5": md5}
+
+    def lookup(self, lfn):
+        return self.entries.get(self.normalize(lfn), None)
+
+    def is_listed(self, lfn):
+        lfn = self.normalize(lfn)
+        for i, max_depth in self.listed_dirs.items():
+            if lfn.startswith(i + "/") and (max_depth is None or lfn[len(i) + 1:].count("/") < max_depth):
+                return True
+        return False
+
+    def list_directory(self, directory, pattern="AnalysisResults.root", tags=None):
+        """
+        Lists recursively all the files matching the pattern in the directory with a single `alien_find`
+        """
+        directory = self.normalize(directory).rstrip("/")
+        return self.add_listing(directory, alien_find(directory, pattern, tags=tags))
+
+    async def list_directories_async(self, directories, pattern="AnalysisResults.root", tags=None):
+        """
+        Lists the files directly in several directories with a single non recursive listing,
+        only the files named as `pattern` are indexed
+        """
+        directories = [self.normalize(i).rstrip("/") for i in directories]
+        listing = await alien_ls_files_async(directories, tags=tags)
+        if listing is None:
+            return None
+        by_directory = {i: [] for i in directories}
+        for i in listing:
+            lfn = self.normalize(i["lfn"])
+            if os.path.dirname(lfn) in by_directory and os.path.basename(lfn) == pattern:
+                by_directory[os.path.dirname(lfn)].append(i)
+        return sum(self.add_listing(i, by_directory[i], max_depth=1) for i in directories)
+
+    def add_listing(self, directory, listing, max_depth=None):
+        """
+        Adds the files of a listing, if `max_depth` only those at most `max_depth` levels below the directory (1: directly in it)
+        """
+        if listing is None:
+            return None
+        if max_depth is not None:
+            listing = [i for i in listing if self.normalize(i["lfn"])[len(directory) + 1:].count("/") < max_depth]
+        for i in listing:
+            self.add(i["lfn"], i["size"], i["md5"])
+        self.listed_dirs[directory] = max_depth
+        vmsg("Indexed", len(listing), "files in", directory)
+        return len(listing)
+
+    def prefetch(self, list_of_hl_output, pattern="AnalysisResults.root", tags=None, directories_per_listing=20):
+        """
+        Fills the index for all the outputs in the list.
+        The output directories are listed (not recursively, the files of the sub-jobs are not needed)
+        `directories_per_listing` at a time, all the listings run concurrently on the grid command runner.
+        """
+        directories = sorted(set(self.normalize(i.alien_outputdir).rstrip("/") for i in list_of_hl_output
+                                 if i.alien_outputdir is not None and not self.is_listed(i.alien_outputdir + "/")))
+        if len(directories) == 0:
+            return
+        groups = [directories[i:i + directories_per_listing] for i in range(0, len(directories), directories_per_listing)]
+
+        async def list_all():
+            return await asyncio.gather(*[self.list_directories_async(i, pattern=pattern, tags=tags) for i in groups])
+        listed = get_runner().run_coroutine(list_all())
+        if DRY_MODE_RUNNING:
+            return
+        failed = [d for g, n in zip(groups, listed) if n is None for d in g]
+        msg("Indexed", len(self.entries), "remote files with", len(groups), "listings")
+        if len(failed) > 0:
+            wmsg("Listing failed for", len(failed), "output directories, their files will be stat'ed one by one:", failed)
+
+    def stat(self, lfn, tags=None):
+        """
+        Returns the entry for a single file, going to alien only if the file is not indexed yet
+        """
+        entry = self.lookup(lfn)
+        if entry is not None or self.is_listed(lfn):
+            return entry
+        out = run_cmd(f"alien_stat alien://{self.normalize(lfn)}", tags=tags)
+        if out is None:
+            return None
+        out = out.stdout.decode('ascii')
+        size = None
+        md5 = None
+        for i in out.split("\n"):
+            if "Size" in i:
+                size = int(i.split(" ")[1])
+            elif "MD5" in i:
+                md5 = i.split(":")[1].strip()
+        if size is None:
+            wmsg("Cannot find size in", out)
+            return None
+        self.add(lfn, size, md5)
+        return self.lookup(lfn)
+
+
+alien_metadata = AlienMetadataIndex()
+
+alien_listing_cache = {}
+
+
+async def alien_ls_async(directory, tags=None):
+    """
+    Lists the content of a directory on alien, each directory is listed only once
+    """
+    directory = AlienMetadataIndex.normalize(directory)
+    if directory not in alien_listing_cache:
+        out = await run_cmd_async(f"alien_ls alien://{directory}", print_output=False, tags=tags)
+        if out is None:
+            return []
+        alien_listing_cache[directory] = out.stdout.decode('ascii').split("\n")
+    return alien_listing_cache[directory]
+
+
+def resolve_merge_stages(list_of_hl_output):
+    """
+    Looks for the partially merged outputs of all the runs in the list concurrently
+    """
+    to_resolve = [i for i in list_of_hl_output if not i.merge_stage_resolved]
+    if len(to_resolve) == 0:
+        return
+
+    async def resolve_all():
+        await asyncio.gather(*[i.resolve_merge_stage_async() for i in to_resolve])
+    msg("Looking for partially merged outputs of", len(to_resolve), "runs")
+    get_runner().run_coroutine(resolve_all())
+
+
+def file_checksum(file_name, chunk_size=16*1024*1024):
+    """
+    MD5 checksum of a local file, as the one reported by alien
+    """
+    import hashlib
+    md5 = hashlib.md5()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_from_file(f, name):
+    """
+    Gets an object from a file following its path through directories and lists, returns None if not found
+    """
+    obj = f
+    for i in name.split("/"):
+        if "List" in obj.ClassName():
+            obj = obj.FindObject(i)
+        else:
+            obj = obj.Get(i)
+        if not obj:
+            return None
+    return obj
+
+
+def get_from_uproot(f, name):
+    """
+    Same as `get_from_file` for a file opened with uproot
+    """
+    import uproot
+    obj = f
+    for i in name.split("/"):
+        if isinstance(obj, uproot.ReadOnlyDirectory):
+            if i not in obj:
+                return None
+            obj = obj[i]
+            continue
+        # Objects in lists
+        found = None
+        for j in obj:
+            if j.has_member("fName") and j.member("fName") == i:
+                found = j
+                break
+        if found is None:
+            return None
+        obj = found
+    return obj
+
+
+def objects_from_ini(input_configuration):
+    """
+    Returns the list of objects requested in a trending configuration, the configuration is validated first
+    """
+    from trend_plan import compile_plan
+    return compile_plan(input_configuration).objects()
+
+
 drawn_objects = []
 
 
@@ -122,9 +447,11 @@ class HyperloopOutput:
     def __init__(self,
                  json_entry,
                  full_json=None,
-                 out_path="/tmp/"):
+                 out_path="/tmp/",
+                 train_id=None):
 
         self.out_path = os.path.abspath(out_path)
+        self.train_id = train_id
 
         def get(key):
             # Gets the key from the json entry
@@ -145,30 +472,47 @@ class HyperloopOutput:
         vmsg("Adding hyperloop output for run number", self.run_number)
         self.merge_state = get("merge_state")
         self.derived_data = get("derived_data")
-        if self.merge_state != "done":
-            wmsg("Merge state for run", self.run_number, "is", self.merge_state)
-            if self.alien_outputdir is not None and self.exists() == False:
-                vmsg("Attempting to get partial merged files")
-                merge_stages = self.get_merged_stages()
-                partial_merge = None
-                for i in merge_stages:
-                    partial_merge = self.list_partial_merged_files(merge_stage=i)
-                    if partial_merge is not None:
-                        break
-                if partial_merge is not None:
-                    wmsg(f"Partial merge for run {self.run_number} found in stage {i}", "getting", partial_merge[-1])
-                    partial_merge = self.list_partial_merged_files(merge_stage=partial_merge[-1])
-                    partial_merge_file = [i for i in partial_merge if "AnalysisResults.root" in i]
-                    self.alien_outputdir += "/"+partial_merge_file[0].strip("AnalysisResults.root")
-                    self.alien_outputdir = self.alien_outputdir.replace("//", "/")
-                    self.merge_state = "partially_merged"
+        # Partially merged outputs are looked for only when the path is needed
+        self.merge_stage_resolved = self.merge_state == "done" or self.alien_outputdir is None
 
         self.dataset_name = getgeneral("dataset_name")
-        # ROOT interface
-        self.tfile = None
-        self.root_objects = {}
+        # ROOT interface, the ROOT files and objects are in the shared cache of `utils`
+        self.ufile = None
+        self.array_objects = {}
+        self.aliases = {}
+
+    async def resolve_merge_stage_async(self):
+        """
+        Looks for the partially merged output of runs whose merging is not done
+        """
+        if self.merge_stage_resolved:
+            return
+        self.merge_stage_resolved = True
+        wmsg("Merge state for run", self.run_number, "is", self.merge_state)
+        if self.exists():
+            return
+        vmsg("Attempting to get partial merged files")
+        merge_stages = await self.get_merged_stages_async()
+        partial_merge = None
+        for i in merge_stages:
+            partial_merge = await self.list_partial_merged_files_async(merge_stage=i)
+            if partial_merge is not None:
+                break
+        if partial_merge is not None:
+            wmsg(f"Partial merge for run {self.run_number} found in stage {i}", "getting", partial_merge[-1])
+            partial_merge = await self.list_partial_merged_files_async(merge_stage=partial_merge[-1])
+            partial_merge_file = [i for i in partial_merge if "AnalysisResults.root" in i]
+            self.alien_outputdir += "/"+partial_merge_file[0].strip("AnalysisResults.root")
+            self.alien_outputdir = self.alien_outputdir.replace("//", "/")
+            self.merge_state = "partially_merged"
+
+    def resolve_merge_stage(self):
+        if self.merge_stage_resolved:
+            return
+        get_runner().run_coroutine(self.resolve_merge_stage_async())
 
     def alien_path_analysis_results(self):
+        self.resolve_merge_stage()
         if self.alien_outputdir is not None:
             return self.alien_outputdir + "/AnalysisResults.root"
         return None
@@ -176,64 +520,72 @@ class HyperloopOutput:
     def get_dataset_name(self):
         return self.dataset_name
 
-    def get_merged_stages(self):
-        alien_listing = run_cmd(f"alien_ls alien://{self.alien_outputdir}", print_output=False)
+    async def get_merged_stages_async(self):
         merge_stages = []
-        for i in alien_listing.stdout.decode('ascii').split("\n"):
+        for i in await alien_ls_async(self.alien_outputdir, tags=self.trace_tags()):
             if "Stage" in i and "/" in i:
                 merge_stages.append(i)
         merge_stages.sort()
         merge_stages.reverse()
         return merge_stages
 
-    def list_partial_merged_files(self, merge_stage="Stage_3/"):
-        alien_listing = run_cmd(f"alien_ls alien://{self.alien_outputdir}/{merge_stage}", print_output=False)
-        alien_listing = alien_listing.stdout.decode('ascii').split("\n")
+    def get_merged_stages(self):
+        return get_runner().run_coroutine(self.get_merged_stages_async())
+
+    async def list_partial_merged_files_async(self, merge_stage="Stage_3/"):
+        alien_listing = await alien_ls_async(f"{self.alien_outputdir}/{merge_stage}", tags=self.trace_tags())
         alien_listing = [f"{merge_stage}/{i}" for i in alien_listing if i]
         # print(alien_listing)
         if len(alien_listing) == 0:
             return None
         return alien_listing
 
+    def list_partial_merged_files(self, merge_stage="Stage_3/"):
+        return get_runner().run_coroutine(self.list_partial_merged_files_async(merge_stage=merge_stage))
+
     def get_alien_path(self):
         if "alien://" in self.alien_path_analysis_results():
             raise RuntimeError(f"Path {self.alien_path_analysis_results()} is already an alien path")
         return "alien://" + self.alien_path_analysis_results()
 
-    def find_derived_data(self, merged_derived_data=True):
+    async def find_derived_data_async(self, merged_derived_data=True, with_size=False):
+        """
+        Returns the list of derived data (AO2D) files of the run, with their size in bytes if `with_size` is set.
+        Merged derived data are preferred when present.
+        """
         if self.derived_data is None:
             return None
-        # Check if it is already there
-        out_name = os.path.join(self.out_path, f"HyperloopID_{self.run_number}.json")
-
-        if os.path.isfile(self.local_file_position()):
-            print("YOOO")
-
-        cmd = f"alien_find {self.alien_outputdir} AO2D.root"
-        out = run_cmd(cmd)
-        found_files = out.stdout
-        # print(found_files)
-        found_files = found_files.decode('ascii').strip("\n")
+        await self.resolve_merge_stage_async()
+        found_files = await alien_find_async(self.alien_outputdir, "AO2D.root", tags=self.trace_tags())
+        if found_files is None:
+            return None
         file_list = []
-        if merged_derived_data and "AOD" not in found_files:
+        if merged_derived_data and not any("AOD" in i["lfn"] for i in found_files):
             merged_derived_data = False
-        found_files = found_files.split("\n")
-        # print(found_files)
         for i in found_files:
-            if merged_derived_data and "AOD" not in i:
+            if merged_derived_data and "AOD" not in i["lfn"]:
                 continue
-            elif not merged_derived_data and "AOD" in i:
+            elif not merged_derived_data and "AOD" in i["lfn"]:
                 continue
-            file_list.append(i)
-        # print(file_list)
+            if with_size:
+                file_list.append((i["lfn"], i["size"]))
+            else:
+                file_list.append(i["lfn"])
         return file_list
 
+    def find_derived_data(self, merged_derived_data=True, with_size=False):
+        return get_runner().run_coroutine(self.find_derived_data_async(merged_derived_data=merged_derived_data,
+                                                                       with_size=with_size))
+
     def local_file_position(self):
         return self.alien_path_analysis_results().replace("alien://", "")
 
     def get_run(self):
         return self.run_number
 
+    def trace_tags(self):
+        return {"run": self.run_number, "train_id": self.train_id}
+
     def out_filename(self):
         if self.alien_path_analysis_results() is None:
             return None
@@ -253,7 +605,10 @@ class HyperloopOutput:
             target_output_file = target_output_file.replace("//", "/")
         return target_output_file
 
-    def exists(self):
+    def exists(self, remote=False):
+        if remote:
+            # Checking the presence of the file on alien
+            return alien_metadata.stat(self.alien_path_analysis_results(), tags=self.trace_tags()) is not None
         f = self.out_filename()
         check = os.path.isfile(f)
         if check:
@@ -272,14 +627,74 @@ class HyperloopOutput:
             if throw_fatal:
                 fatal_msg("Cannot open", f)
             return False
-        # Check that the size is the same
+        # Files validated after their download are checked against the local catalog
+        entry = self.catalog_entry()
+        if entry is not None and entry["merge_state"] == self.merge_state and is_valid(entry):
+            vmsg("File", f"`{f}`", "is sane according to the catalog")
+            return True
+        if not self.verify_file(f):
+            return False
+        vmsg("File", f"`{f}`", "is sane")
+        return True
+
+    def verify_file(self, f):
+        """
+        Checks a local file against the size and, when available, the MD5 checksum of the remote file
+        """
         alien_size = self.get_alien_file_size()
         local_size = os.path.getsize(f)
-        if abs(alien_size - local_size) > 1000:
+        if alien_size != local_size:
+            vmsg("File", f"`{f}`", "has size", local_size, "instead of", alien_size)
+            return False
+        alien_checksum = self.get_alien_checksum()
+        if alien_checksum is not None and file_checksum(f) != alien_checksum:
+            wmsg("File", f"`{f}`", "does not match the checksum of", self.get_alien_path())
             return False
-        vmsg("File", f"`{f}`", "is sane")
         return True
 
+    def catalog_entry(self):
+        if self.out_filename() is None:
+            return None
+        return get_catalog(self.out_path).lookup_local(self.out_filename())
+
+    def record_in_catalog(self):
+        if self.train_id is None:
+            return
+        get_catalog(self.out_path).record(train_id=self.train_id,
+                                          run=self.get_run(),
+                                          local_path=self.out_filename(),
+                                          remote_path=self.alien_path_analysis_results(),
+                                          size=os.path.getsize(self.out_filename()),
+                                          checksum=self.get_alien_checksum(),
+                                          merge_state=self.merge_state,
+                                          dataset_name=self.get_dataset_name())
+
+    def write_summary(self, overwrite_summary=True):
+        """
+        Writes the download summary (remote path, run, period and merge state) next to the local file
+        """
+        summary = os.path.join(os.path.dirname(self.out_filename()), "download_summary.txt")
+        if not overwrite_summary and os.path.isfile(summary):
+            return
+        with open(summary, "w") as f:
+            f.write(self.get_alien_path() + "\n")
+            f.write(f"Run{self.get_run()}\n")
+            f.write(f"Period{self.get_dataset_name()}\n")
+            if self.merge_state != "done":
+                f.write(f"Merge state: {self.merge_state}\n")
+
+    def keep_present(self, write_download_summary=True):
+        """
+        Keeps a sane file already present instead of downloading it: it is recorded in the catalog
+        (or marked as used if already there) and its download summary is written
+        """
+        if write_download_summary:
+            self.write_summary()
+        if self.catalog_entry() is None:
+            self.record_in_catalog()
+        else:
+            get_catalog(self.out_path).touch(self.out_filename())
+
     def __str__(self) -> str:
         p = f"{self.get_alien_path()}, locally {self.out_filename()}, run {self.get_run()}"
         if self.is_sane():
@@ -290,20 +705,16 @@ class HyperloopOutput:
         return self.__str__()
 
     def get_alien_file_size(self):
-        cmd = f"alien_stat {self.get_alien_path()}"
-        out = run_cmd(cmd)
-        out = out.stdout.decode('ascii')
-        s = None
-        for i in out.split("\n"):
-            if "Size" in i:
-                s = int(i.split(" ")[1])
-                break
-        if s is None:
-            wmsg("Cannot find size in", out)
+        entry = alien_metadata.stat(self.alien_path_analysis_results(), tags=self.trace_tags())
+        if entry is None:
             return 0
-        return s
-        print("Size", s, "bytes", s/1024/1024/1024, "GB")
-        raise ValueError("Not implemented")
+        return entry["size"]
+
+    def get_alien_checksum(self):
+        entry = alien_metadata.stat(self.alien_path_analysis_results(), tags=self.trace_tags())
+        if entry is None:
+            return None
+        return entry["md5"]
 
     def copy_from_alien(self,
                         write_download_summary=True,
@@ -318,32 +729,75 @@ class HyperloopOutput:
             os.makedirs(out_path)
         else:
             vmsg("Directory", f"`{out_path}`", "already present")
-        if write_download_summary and (overwrite_summary or not os.path.isfile(os.path.join(out_path, "download_summary.txt"))):
-            with open(os.path.join(out_path, "download_summary.txt"), "w") as f:
-                f.write(self.get_alien_path() + "\n")
-                f.write(f"Run{self.get_run()}\n")
-                f.write(f"Period{self.get_dataset_name()}\n")
-                if self.merge_state != "done":
-                    f.write(f"Merge state: {self.merge_state}\n")
+        if write_download_summary:
+            self.write_summary(overwrite_summary)
         if not overwrite and self.exists():
             if self.is_sane():
                 msg("File", f"`{self.out_filename()}`",
                     "already present, skipping for download")
+                self.keep_present(write_download_summary=False)
                 return self.out_filename()
             else:
                 os.remove(self.out_filename())
                 msg("File", self.out_filename(),
                     "was not sane, removing it and attempting second download", color=bcolors.BWARNING)
+        get_catalog(self.out_path).forget(self.out_filename())
 
-        msg("Downloading", self.get_alien_path(), "to", self.out_filename())
-        cmd = f"alien_cp -q {self.get_alien_path()} file:{self.out_filename()}"
-        run_cmd(cmd)
-        if self.is_sane():
+        if alien_metadata.is_listed(self.alien_path_analysis_results()) and not self.exists(remote=True):
+            wmsg("File", self.get_alien_path(), "is not on alien, skipping download")
+            return None
+        # Downloading to a staging file that is moved in place only once verified
+        part = self.out_filename() + ".part"
+        remote_size = self.get_alien_file_size()
+        if os.path.isfile(part) and 0 < os.path.getsize(part) < remote_size:
+            msg("Resuming download of", self.get_alien_path(), "from", os.path.getsize(part), "bytes")
+            if not self.resume_download(part, remote_size):
+                os.remove(part)
+        elif os.path.isfile(part):
+            os.remove(part)
+        if not os.path.isfile(part):
+            msg("Downloading", self.get_alien_path(), "to", self.out_filename())
+            cmd = f"alien_cp -q {self.get_alien_path()} file:{part}"
+            run_cmd(cmd, tags=self.trace_tags())
+        if not os.path.isfile(part):
+            wmsg("Download of", self.get_alien_path(), "failed")
+            return None
+        if self.verify_file(part):
+            os.replace(part, self.out_filename())
+            self.record_in_catalog()
             return self.out_filename()
-        else:
-            wmsg("File", self.out_filename(), "is not sane after download")
+        if os.path.getsize(part) >= remote_size:
+            # Complete but not matching, it cannot be resumed
+            os.remove(part)
+        wmsg("File", self.out_filename(), "is not sane after download")
         return None
 
+    def resume_download(self, part, remote_size, chunk_size=64*1024*1024):
+        """
+        Appends the missing bytes of the remote file to a partially downloaded file reading the remote file as raw
+        """
+        import ctypes
+        from ROOT import TFile
+        with traced("root_raw_read", **self.trace_tags()) as record:
+            remote = TFile.Open(self.remote_url() + "?filetype=raw")
+            if not remote or remote.IsZombie():
+                wmsg("Cannot open", self.remote_url(), "to resume the download")
+                return False
+            offset = os.path.getsize(part)
+            buffer = ctypes.create_string_buffer(chunk_size)
+            with open(part, "ab") as f:
+                while offset < remote_size:
+                    n = min(chunk_size, remote_size - offset)
+                    # ReadBuffer returns true in case of failure
+                    if remote.ReadBuffer(buffer, offset, n):
+                        wmsg("Failed reading", self.remote_url(), "at", offset, "bytes")
+                        break
+                    f.write(buffer.raw[:n])
+                    offset += n
+                    record["bytes"] += n
+            remote.Close()
+        return offset == remote_size
+
     def copy_from_alien_derived_data(self,
                                      write_download_summary=True,
                                      overwrite=False,
@@ -359,13 +813,8 @@ class HyperloopOutput:
             os.makedirs(out_path)
         else:
             vmsg("Directory", f"`{out_path}`", "already present")
-        if write_download_summary and (overwrite_summary or not os.path.isfile(os.path.join(out_path, "download_summary.txt"))):
-            with open(os.path.join(out_path, "download_summary.txt"), "w") as f:
-                f.write(self.get_alien_path() + "\n")
-                f.write(f"Run{self.get_run()}\n")
-                f.write(f"Period{self.get_dataset_name()}\n")
-                if self.merge_state != "done":
-                    f.write(f"Merge state: {self.merge_state}\n")
+        if write_download_summary:
+            self.write_summary(overwrite_summary)
         if not overwrite and self.exists():
             if self.is_sane():
                 msg("File", f"`{self.out_filename()}`",
@@ -385,44 +834,160 @@ class HyperloopOutput:
             wmsg("File", self.out_filename(), "is not sane after download")
         return None
 
+    def objects_filename(self):
+        """
+        Local file with the objects read from the remote file without downloading it
+        """
+        if self.out_filename() is None:
+            return None
+        return self.out_filename().replace("AnalysisResults.root", "AnalysisResults_objects.root")
+
+    def has_objects_cache(self):
+        return self.objects_filename() is not None and os.path.isfile(self.objects_filename())
+
+    def remote_url(self):
+        if REMOTE_READ_PREFIX is None:
+            return self.get_alien_path()
+        return REMOTE_READ_PREFIX.rstrip("/") + "/" + self.alien_path_analysis_results().lstrip("/")
+
+    def fetch_objects(self, names, overwrite=False):
+        """
+        Reads only the requested objects from the remote file and stores them in the local objects cache file.
+        Objects already in the cache are not read again unless `overwrite` is set.
+        If the full output is already present and sane it is used instead.
+        """
+        if self.objects_filename() is None:
+            wmsg("Output filename is None, skipping object read")
+            return None
+        if not overwrite and self.is_sane(throw_fatal=False):
+            vmsg("Full output", f"`{self.out_filename()}`", "already present, not reading the objects")
+            return self.out_filename()
+        from ROOT import TFile
+        self.close()
+        os.makedirs(os.path.dirname(self.objects_filename()), exist_ok=True)
+        cache = TFile(self.objects_filename(), "UPDATE")
+        missing = [i for i in names if overwrite or not get_from_file(cache, i)]
+        if len(missing) == 0:
+            vmsg("All objects already cached in", self.objects_filename())
+            cache.Close()
+            return self.objects_filename()
+        msg("Reading", len(missing), "objects from", self.remote_url())
+        if DRY_MODE_RUNNING:
+            msg("Dry mode!!!")
+            cache.Close()
+            return None
+        with traced("root_remote_read", **self.trace_tags()) as record:
+            remote = TFile.Open(self.remote_url())
+            if not remote or remote.IsZombie():
+                wmsg("Cannot open", self.remote_url())
+                cache.Close()
+                return None
+            for i in missing:
+                obj = get_from_file(remote, i)
+                if not obj:
+                    wmsg("Cannot find", i, "in", self.remote_url())
+                    continue
+                d = cache
+                if os.path.dirname(i) != "":
+                    d = cache.GetDirectory(os.path.dirname(i))
+                    if not d:
+                        d = cache.mkdir(os.path.dirname(i), "", True)
+                d.WriteTObject(obj, os.path.basename(i), "Overwrite")
+            record["bytes"] = remote.GetBytesRead()
+            remote.Close()
+        cache.Close()
+        return self.objects_filename()
+
+    def input_filename(self):
+        """
+        File the objects are read from: the full output or, if it was not downloaded, the objects cache
+        """
+        if not os.path.isfile(self.out_filename()) and self.has_objects_cache():
+            vmsg("Using objects cache", self.objects_filename())
+            return self.objects_filename()
+        return self.out_filename()
+
     def open(self):
-        if not self.tfile:
-            self.tfile = TFile(self.out_filename())
-        return self.tfile
+        """
+        Returns the input file, kept open by the shared cache of files and objects until evicted or closed
+        """
+        cache = get_object_cache()
+        f = self.input_filename()
+        if cache.is_open(f):
+            return cache.open(f)
+        with traced("root_open", **self.trace_tags()):
+            tfile = cache.open(f)
+            if f == self.out_filename():
+                get_catalog(self.out_path).touch(f)
+        return tfile
+
+    def open_uproot(self):
+        if self.ufile is None:
+            import uproot
+            with traced("uproot_open", **self.trace_tags()):
+                f = self.input_filename()
+                self.ufile = uproot.open(f)
+                if f == self.out_filename():
+                    get_catalog(self.out_path).touch(f)
+        return self.ufile
+
+    def close(self):
+        get_object_cache().release(self.input_filename())
+        if self.ufile is not None:
+            self.ufile.close()
+        self.ufile = None
+        self.array_objects = {}
+
+    def __getstate__(self):
+        """
+        The open file and the ROOT objects are not sent to other processes, they are reopened there when needed
+        """
+        state = self.__dict__.copy()
+        state["ufile"] = None
+        state["array_objects"] = {}
+        return state
 
     def has_in_file(self, name):
+        if READER_BACKEND == "uproot":
+            return get_from_uproot(self.open_uproot(), name) is not None
         if self.open().Get(name):
             return True
         return False
 
-    def get(self, name=None):
-        if name in self.root_objects:
-            return self.root_objects[name]
-        f = self.open()
+    def get(self, name=None, as_root=False):
+        """
+        Returns the object from the file, with the uproot reader backend the one dimensional histograms
+        are returned as `hist_arrays.ArrayHisto` unless `as_root` is set (e.g. to fit or draw them)
+        """
+        name = self.aliases.get(name, name)
+        if READER_BACKEND == "uproot" and not as_root and name is not None:
+            if name not in self.array_objects:
+                obj = get_from_uproot(self.open_uproot(), name)
+                if obj is None:
+                    raise ValueError(f"{name} not found")
+                self.array_objects[name] = hist_arrays.from_uproot(obj)
+            if self.array_objects[name] is not None:
+                return self.array_objects[name]
+            # Other objects are read with ROOT
         if name is None:
-            f.ls()
+            self.open().ls()
             return
-        if "/" in name:
-            obj = f
-            for i in name.split("/"):
-                if "List" in obj.ClassName():
-                    obj = obj.FindObject(i)
-                else:
-                    obj = obj.Get(i)
-                if not obj:
-                    f.ls()
-                    if "/" in name:
-                        split_names = name.split("/")
-                        partial_name = split_names.pop(0)
-                        print(f"Looking for content in {partial_name}")
-                        f.Get(partial_name).ls()
-                        for j in split_names:
-                            partial_name += f"/{j}"
-                            print(f"Looking for {partial_name}")
-                            f.Get(partial_name).ls()
-                    raise ValueError(f"{name} not found")
-        else:
-            obj = f.Get(name)
+        # Read once per file version, the object is kept (detached from the file) in the shared cache
+        self.open()
+        obj = get_object_cache().get(self.input_filename(), name, read=get_from_file)
+        if not obj:
+            f = self.open()
+            f.ls()
+            if "/" in name:
+                split_names = name.split("/")
+                partial_name = split_names.pop(0)
+                print(f"Looking for content in {partial_name}")
+                f.Get(partial_name).ls()
+                for j in split_names:
+                    partial_name += f"/{j}"
+                    print(f"Looking for {partial_name}")
+                    f.Get(partial_name).ls()
+            raise ValueError(f"{name} not found")
         if "Direc" in obj.ClassName():
             obj.ls()
         of_interest = ["TH1F"]
@@ -433,19 +998,29 @@ class HyperloopOutput:
             #     t = t + " Run " + f"{self.get_run()}"
             #     t = t.strip()
             #     obj.SetTitle(t)
-        self.root_objects[name] = obj
         return obj
 
     def get_as(self, name, alias):
-        if alias in self.root_objects:
-            return self.root_objects[alias]
-        self.root_objects[alias] = self.get(name)
+        self.aliases[alias] = name
         return self.get(alias)
 
+    def get_arrays(self, name):
+        """
+        Returns the object as `hist_arrays.ArrayHisto`, None if it cannot be converted (e.g. TEfficiency or TH2)
+        """
+        h = self.get(name)
+        if not h or not hist_arrays.is_convertible(h):
+            return None
+        return hist_arrays.from_root(h)
+
     def average(self, name):
         h = self.get(name)
         if not h:
             return None
+        if HISTOGRAM_BACKEND == "numpy" and not isinstance(h, hist_arrays.ArrayHisto) and hist_arrays.is_convertible(h):
+            # Only the statistics are needed, the bins are not converted
+            mean, mean_error = hist_arrays.mean_from_stats(hist_arrays.root_stats(h))
+            return mean[0], mean_error[0]
         return h.GetMean(), h.GetMeanError()
 
     def valueat1(self, name):
@@ -459,85 +1034,72 @@ class HyperloopOutput:
         b = h.GetXaxis().FindBin(1)
         return h.GetBinContent(b), h.GetBinError(b)
 
-    def functionfit(self, name, option):
-        h = self.get(name)
-        extra = None
+    def project(self, name, option):
+        """
+        Returns the histogram to fit: the object itself or, for two dimensional histograms, its projection in `projection_range`.
+        Also returns the projection interval (low, high, axis title) and its description, None if not projected.
+        """
+        h = self.get(name, as_root=True)
         if not h:
-            return None
+            return None, None, None
         if h.GetEntries() <= 0:
             raise ValueError("Error", h.GetName(), "has no entries")
-        if 0:
-            can = draw_nice_canvas("before_fit", replace=False)
+        if "TH2" not in h.ClassName():
+            return h, None, None
+        from trend_plan import section_plan
+        option = section_plan(option, name)
+        projection_range = option.projection_range
+        if projection_range is None:
+            raise ValueError(f"projection_range not set for {name}")
+        projection_interval = [h.GetYaxis().GetBinLowEdge(h.GetYaxis().FindBin(projection_range[0])),
+                               h.GetYaxis().GetBinUpEdge(h.GetYaxis().FindBin(projection_range[1])),
+                               h.GetYaxis().GetTitle()]
+        extra = "Projection interval: " + f"{projection_interval[0]:.2f}, {projection_interval[1]:.2f}, {projection_interval[2]}"
+        if option.projection == "x":
+            h = h.ProjectionX("tmp", h.GetYaxis().FindBin(projection_range[0]), h.GetYaxis().FindBin(projection_range[1]))
+        elif option.projection == "y":
+            h = h.ProjectionY("tmp", h.GetXaxis().FindBin(projection_range[0]), h.GetXaxis().FindBin(projection_range[1]))
+        if 0:  # Show projection
+            can = draw_nice_canvas("projection", replace=False)
             h.Draw()
             can.Modified()
             can.Update()
-            # input("Press enter to continue")
-        projection_interval = None
-        if "TH2" in h.ClassName():
-            projection_range = option["projection_range"].split(", ")
-            if len(projection_range) != 2:
-                raise ValueError("projection_range not properly set")
-            projection_range = [float(i) for i in projection_range]
-            projection_interval = [h.GetYaxis().GetBinLowEdge(h.GetYaxis().FindBin(projection_range[0])),
-                                   h.GetYaxis().GetBinUpEdge(h.GetYaxis().FindBin(projection_range[1])),
-                                   h.GetYaxis().GetTitle()]
-            extra = TNamed("projection_interval",
-                           "Projection interval: " + f"{projection_interval[0]:.2f}, {projection_interval[1]:.2f}, {projection_interval[2]}")
-            if option["projection"] == "x":
-                h = h.ProjectionX("tmp", h.GetYaxis().FindBin(projection_range[0]), h.GetYaxis().FindBin(projection_range[1]))
-            elif option["projection"] == "y":
-                h = h.ProjectionY("tmp", h.GetXaxis().FindBin(projection_range[0]), h.GetXaxis().FindBin(projection_range[1]))
-            if 0:  # Show projection
-                can = draw_nice_canvas("projection", replace=False)
-                h.Draw()
-                can.Modified()
-                can.Update()
-                input("Press enter to continue")
-
-        fitrange = option["fit_range"].split(", ")
-        if len(fitrange) != 2:
-            raise ValueError("fit_range not properly set")
-
-        fitrange = [float(i) for i in fitrange]
-        fun = TF1(h.GetName()+"functionfit", option["function"], *fitrange)
-        for i in enumerate(option["initial_parameters"].split(", ")):
-            fun.SetParameter(i[0], float(i[1]))
-            if f"par_range{i[0]}" in option:
-                par_range = option[f"par_range{i[0]}"].split(", ")
-                par_range = [float(i) for i in par_range]
-                fun.SetParLimits(i[0], *par_range)
-            # print(fun.GetParameter(i[0]))
-        # fun.Print()
-        # for strat in [3]:
-        h.Fit(fun, "QNR")
-        if 0:
-            fun.Draw("SAME")
             input("Press enter to continue")
+        return h, projection_interval, extra
+
+    def get_projected_arrays(self, name, option):
+        """
+        Returns the histogram to fit as `hist_arrays.ArrayHisto` with the description of the projection (or None)
+        """
+        h, projection_interval, extra = self.project(name, option)
+        if h is None or not hist_arrays.is_convertible(h):
+            return None, None
+        return hist_arrays.from_root(h), extra
 
-        if 0:
-            for strat in [0, 1, 2, 3]:
-                ROOT.Math.MinimizerOptions().SetStrategy(strat)
-                h.Fit(fun, option["fit_opt"], "", *fitrange)
-            fit_converged = gMinuit and gMinuit.fCstatu and ("CONVERGED" in gMinuit.fCstatu or "OK" in gMinuit.fCstatu)
-            if not fit_converged:
-                if gMinuit:
-                    status = gMinuit and gMinuit.fCstatu
-                else:
-                    status = "No gMinuit"
-                wmsg("Fit did not converge", status, "with strategy", strat)
-
-        show_single_fit = option["show_single_fit"]
-        if (type(show_single_fit) is str and show_single_fit == "true") or (type(show_single_fit) is not str and show_single_fit):
+    def functionfit(self, name, option):
+        from ROOT import TH1, TNamed
+        from trend_fit import get_fit_engine
+        from trend_plan import section_plan
+        option = section_plan(option, name)
+        h, projection_interval, extra = self.project(name, option)
+        if h is None:
+            return None
+        if extra is not None:
+            extra = TNamed("projection_interval", extra)
+        # The model is compiled once per configuration and the fit seeded from the closest run already fitted
+        fun, fit_record = get_fit_engine().fit(h, option, run=self.get_run())
+        if fit_record["status"] != 0:
+            wmsg("Fit did not converge for run", self.get_run(), "status", fit_record["status"])
+
+        if option.show_single_fit:
             can = draw_nice_canvas("fit_canvas", replace=False)
             h.SetBit(TH1.kNoStats)
             h.SetBit(TH1.kNoTitle)
-            show_single_fit_range = option["show_single_fit_range"]
+            show_single_fit_range = option.show_single_fit_range
             if show_single_fit_range is not None:
-                show_single_fit_range = show_single_fit_range.split(", ")
-                show_single_fit_range = [float(i) for i in show_single_fit_range]
                 h.GetXaxis().SetRangeUser(show_single_fit_range[0], show_single_fit_range[1])
             h.Draw()
-            fun.Draw("same")
+            fun.DrawCopy("same")
             if projection_interval is not None:
                 draw_label("Projection interval: " + f"{projection_interval[0]:.2f}, {projection_interval[1]:.2f}, {projection_interval[2]}")
             draw_label(h.GetTitle(), 0.77, 0.85)
@@ -545,12 +1107,12 @@ class HyperloopOutput:
             can.Modified()
             can.Update()
             input("Press enter to continue")
-        parameter_index = int(option["parameterindex"])
+        parameter_index = option.parameter_index
         print("Getting the input parameter", parameter_index, fun.GetParName(parameter_index))
         return fun.GetParameter(parameter_index), fun.GetParError(parameter_index), extra
 
     def draw(self, name, x_range=None, y_range=None, opt=""):
-        h = self.get(name)
+        h = self.get(name, as_root=True)
         if not h:
             return None
         can = draw_nice_canvas(name, replace=False)
@@ -579,48 +1141,36 @@ class HyperloopOutput:
         vmsg("Drawn", name, "for run", self.get_run(), "x_range", x_range, "y_range", y_range)
         return can
 
-    def fill_histo(self, h_trending, name, quantity="mean", option=None):
+    def compute_quantity(self, name, quantity="mean", option=None, xtitle="Run number"):
         """
-        This function fills the histogram h_trending with the quantity specified of the object asked.
+        Computes the quantity specified of the object asked.
+        Returns the value, its error, the title of the quantity and an extra description (or None).
         """
-        x = f"{self.get_run()}"
-        ib = int(h_trending.GetEntries()) + 1
-        if h_trending.GetXaxis().GetTitle() == "":
-            h_trending.SetBit(TH1.kNoStats)
-            h_trending.GetXaxis().SetTitle("Run number")
-        ytitle = None
-        if h_trending.GetYaxis().GetTitle() == "" and quantity is not None:
-            ytitle = self.get(name).GetTitle()
-        h_trending.GetXaxis().SetBinLabel(ib, x)
         extra = None
-        y = 0
-        ye = 0
-        if quantity is None:
-            y = 0
-            ye = 0
-            ytitle = "None"
-        elif quantity == "mean":
-            if ytitle is not None:
-                ytitle = f"<{ytitle}>"
+        if quantity == "mean":
+            ytitle = f"<{self.get(name).GetTitle()}>"
             y, ye = self.average(name)
         elif quantity == "valueat1":
-            if ytitle is not None:
-                ytitle = f"Value at 1" + h_trending.GetXaxis().GetTitle()
+            ytitle = f"Value at 1" + xtitle
             y, ye = self.valueat1(name)
         elif quantity == "functionfit":
-            if ytitle is not None:
-                ytitle = option["treding_title"].strip("\"")
+            from trend_plan import section_plan
+            ytitle = section_plan(option, name).title
             y, ye, extra = self.functionfit(name, option)
+            if extra is not None:
+                extra = extra.GetTitle()
         else:
             raise ValueError(f"Quantity {quantity} not recognized")
+        # Only plain numbers and strings are kept, the ROOT objects can be released
+        return float(y), float(ye), ytitle, extra
 
-        if ytitle is not None:
-            h_trending.GetYaxis().SetTitle(ytitle)
-        h_trending.SetBinContent(ib, y)
-        h_trending.SetBinError(ib, ye)
-        if extra is not None:
-            h_trending.GetListOfFunctions().Add(extra)
-        return ib
+    def fill_histo(self, h_trending, name, quantity="mean", option=None):
+        """
+        This function fills the histogram h_trending with the quantity specified of the object asked.
+        """
+        if quantity is None:
+            return fill_trend_bin(h_trending, self.get_run(), None)
+        return fill_trend_bin(h_trending, self.get_run(), self.compute_quantity(name, quantity, option))
 
     def __lt__(self, other):
         return self.run_number < other.run_number
@@ -637,34 +1187,333 @@ def get_run_per_run_files(train_id=126264,
         fatal_msg("Cannot find key file", key_file)
     if not os.path.isfile(cert_file):
         fatal_msg("Cannot find cert file", cert_file)
-    if not os.path.isfile(out_name):
-        download_cmd = f"curl --key {key_file} --cert {cert_file} --insecure {alien_path}{train_id} -o {out_name}"
-        run_cmd(download_cmd)
+    data = get_fetcher(key_file=key_file, cert_file=cert_file).fetch(train_id, base_url=alien_path, out_path=out_path)
+    key = "mergeResults" if list_merged_files else "jobResults"
+    if key not in data:
+        print(data.keys())
+        fatal_msg("Cannot find key", key, "in json file", out_name)
     sub_file_list = []
-    with open(out_name) as json_data:
-        import json
-        data = json.load(json_data)
-        key = "mergeResults" if list_merged_files else "jobResults"
-        if key not in data:
-            print(data.keys())
-            fatal_msg("Cannot find key", key, "in json file", out_name)
-        to_list = data[key]
-        for i in to_list:
-            sub_file_list.append(HyperloopOutput(i, out_path=out_path, full_json=data))
+    for i in data[key]:
+        sub_file_list.append(HyperloopOutput(i, out_path=out_path, full_json=data, train_id=train_id))
     msg("Found", len(sub_file_list), "files to download")
     if not list_merged_files:
         sub_file_list.sort()
     return sub_file_list
 
 
-def download_file(i):
-    return i.copy_from_alien(overwrite=False)
+def local_outputs(train_id, out_path="/tmp/", merged=False):
+    """
+    Returns the outputs of a train available locally as catalog entries (with `run`, `dataset_name` and `local_path`).
+    The catalogued outputs are completed with the files of the train found on disk but not in the catalog,
+    if nothing is catalogued all the files of the train are returned.
+    """
+    entries = [i for i in get_catalog(out_path).lookup(train_id) if (i["run"] is None) == merged]
+    try:
+        outputs = get_run_per_run_files(train_id=train_id, list_merged_files=merged, out_path=out_path)
+    except RuntimeError:
+        if len(entries) == 0:
+            raise
+        wmsg("Cannot list the files of train", train_id, "using the", len(entries),
+             "catalogued outputs only, outputs downloaded but not catalogued are missing")
+        return entries
+    # The local names of the outputs not fully merged depend on their merge stage
+    resolve_merge_stages(outputs)
+    if len(entries) == 0:
+        return [{"run": i.get_run(), "dataset_name": i.get_dataset_name(), "local_path": i.out_filename()} for i in outputs]
+    catalogued = set(i["local_path"] for i in entries)
+    not_catalogued = [i for i in outputs
+                      if i.out_filename() is not None and i.out_filename() not in catalogued and os.path.isfile(i.out_filename())]
+    if len(not_catalogued) > 0:
+        wmsg("Found", len(not_catalogued), "downloaded outputs of train", train_id, "not in the catalog, runs",
+             [i.get_run() for i in not_catalogued])
+        entries += [{"run": i.get_run(), "dataset_name": i.get_dataset_name(), "local_path": i.out_filename()} for i in not_catalogued]
+        entries.sort(key=lambda x: x["run"] if x["run"] is not None else -1)
+    return entries
+
+
+def fill_trend_bin(h_trending, run, result):
+    """
+    Fills the next bin of the histogram h_trending with the result of `HyperloopOutput.compute_quantity` for a run.
+    If the result is None the bin is filled with 0 (run skipped).
+    """
+    from ROOT import TH1, TNamed
+    x = f"{run}"
+    ib = int(h_trending.GetEntries()) + 1
+    if h_trending.GetXaxis().GetTitle() == "":
+        h_trending.SetBit(TH1.kNoStats)
+        h_trending.GetXaxis().SetTitle("Run number")
+    h_trending.GetXaxis().SetBinLabel(ib, x)
+    extra = None
+    if result is None:
+        y = 0
+        ye = 0
+        ytitle = "None"
+    else:
+        y, ye, ytitle, extra = result
+        if h_trending.GetYaxis().GetTitle() != "":
+            ytitle = None
+    if ytitle is not None:
+        h_trending.GetYaxis().SetTitle(ytitle)
+    h_trending.SetBinContent(ib, y)
+    h_trending.SetBinError(ib, ye)
+    if extra is not None:
+        h_trending.GetListOfFunctions().Add(TNamed("projection_interval", extra))
+    return ib
+
+
+def enable_root_thread_safety():
+    """
+    ROOT is used from the download threads (remote reads, resumed downloads) while the trending can be using it,
+    it has to be made thread safe before the threads start
+    """
+    try:
+        import ROOT
+    except ImportError:
+        vmsg("ROOT is not available, the downloads cannot be resumed")
+        return
+    ROOT.EnableThreadSafety()
+
+
+def download_file(i, overwrite=False, retries=2, backoff=5.):
+    """
+    Downloads one HyperloopOutput going through one download-and-verify cycle per attempt.
+    Failed attempts are retried up to `retries` times with an exponential backoff (in seconds).
+    Returns the local file name or None if all attempts failed.
+    """
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            wait = backoff * 2**(attempt - 1)
+            wmsg("Retrying download of run", i.get_run(), f"in {wait:.0f} s", f"(attempt {attempt + 1}/{retries + 1})")
+            time.sleep(wait)
+        try:
+            d = i.copy_from_alien(overwrite=overwrite)
+        except Exception as e:
+            wmsg("Download of run", i.get_run(), "failed with", e)
+            d = None
+        if d is not None:
+            return d
+        if DRY_MODE_RUNNING:
+            # Nothing is copied in dry mode, there is nothing to retry
+            return None
+        # A failed attempt leaves a non sane file behind, it has to be replaced
+        overwrite = True
+    return None
 
 
 def download_derived_data(i):
     return i.copy_from_alien_derived_data(overwrite=False)
 
 
+def iter_downloads(list_of_hl_output,
+                   jobs=1,
+                   overwrite=False,
+                   retries=2,
+                   backoff=5.):
+    """
+    Downloads all the HyperloopOutput in the list with a pool of at most `jobs` concurrent transfers.
+    The transfers start right away, the returned iterator yields each HyperloopOutput with its local file name
+    (None if the download failed) as soon as it is done.
+    """
+    jobs = max(1, jobs)
+    if jobs > 1:
+        # Interrupted downloads are resumed with ROOT in the pool
+        enable_root_thread_safety()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = {executor.submit(download_file, i, overwrite, retries, backoff): i for i in list_of_hl_output}
+
+    def completed():
+        bar = None
+        if tqdm is not None:
+            bar = tqdm.tqdm(total=len(list_of_hl_output), bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}')
+        try:
+            for future in as_completed(futures):
+                if bar is not None:
+                    bar.update(1)
+                yield futures[future], future.result()
+        finally:
+            executor.shutdown(wait=True)
+            if bar is not None:
+                bar.close()
+    return completed()
+
+
+def download_all(list_of_hl_output,
+                 jobs=1,
+                 overwrite=False,
+                 retries=2,
+                 backoff=5.):
+    """
+    Downloads all the HyperloopOutput in the list with a pool of at most `jobs` concurrent transfers.
+    Returns a dictionary with the outcome of each file: {HyperloopOutput: local file name or None}
+    """
+    results = {}
+    for i, d in iter_downloads(list_of_hl_output, jobs=jobs, overwrite=overwrite, retries=retries, backoff=backoff):
+        results[i] = d
+    failed = [i.get_run() for i in results if results[i] is None]
+    msg("Downloaded", len(results) - len(failed), "out of", len(results), "files")
+    if len(failed) > 0:
+        wmsg("Failed downloads for runs", failed)
+    return results
+
+
+def list_derived_data_files(list_of_hl_output,
+                            out_file="/tmp/list_of_derived_data.txt",
+                            resume=True):
+    """
+    Lists the derived data of all the runs concurrently, writing them to `out_file` as soon as each run is listed.
+    The runs completely listed are tracked, with their train, in `out_file`.done so that an interrupted listing
+    of the same train can be resumed. The listing of another train starts again from scratch.
+    Returns the list of derived data files.
+    """
+    done_file = out_file + ".done"
+    train_id = f"{list_of_hl_output[0].train_id}" if len(list_of_hl_output) > 0 else None
+    listed = []
+    done_runs = set()
+    done = []
+    if resume and os.path.isfile(out_file) and os.path.isfile(done_file):
+        with open(done_file) as f:
+            done = [i.split() for i in f if i.strip() != ""]
+        if any(len(i) != 4 or i[0] != train_id for i in done):
+            msg("Listing of derived data in", out_file, "is not for train", train_id, "starting again")
+            resume = False
+    if resume and os.path.isfile(out_file) and os.path.isfile(done_file):
+        with open(out_file) as f:
+            listed = [i.strip() for i in f if i.strip() != ""]
+        done_runs = set(i[1] for i in done)
+        msg("Resuming listing of derived data,", len(done_runs), "runs already listed")
+    else:
+        open(out_file, "w").close()
+        open(done_file, "w").close()
+    already_listed = set(listed)
+    to_list = [i for i in list_of_hl_output if str(i.get_run()) not in done_runs]
+    with open(out_file, "a") as f, open(done_file, "a") as fdone:
+        futures = {get_runner().submit_coroutine(i.find_derived_data_async(with_size=True)): i for i in to_list}
+        for future in as_completed(futures):
+            i = futures[future]
+            found = future.result()
+            if found is None:
+                wmsg("Could not list derived data for run", i.get_run())
+                continue
+            for j in found:
+                j = f"alien://{j[0]}"
+                if j in already_listed:
+                    continue
+                already_listed.add(j)
+                listed.append(j)
+                f.write(f"{j}\n")
+            f.flush()
+            total_size = sum(j[1] for j in found)
+            fdone.write(f"{train_id} {i.get_run()} {len(found)} {total_size}\n")
+            fdone.flush()
+            msg("Run", i.get_run(), "has", len(found), "AO2D files for", f"{total_size/1024/1024/1024:.2f} GB")
+    msg("Listed", len(listed), "derived data files in", out_file)
+    return listed
+
+
+def plan_downloads(list_of_hl_output,
+                   out_path="/tmp/",
+                   disk_budget=None,
+                   priority_runs=None,
+                   overwrite=False,
+                   keep_trains=None,
+                   jobs=1):
+    """
+    Plans the downloads of a list of HyperloopOutput against the free disk space and the disk budget (in bytes)
+    of the output path. If the space is not enough the least recently used files of other trains are evicted.
+    The files already present are checked with a pool of `jobs` workers and kept in the catalog.
+    The files to download are ordered with the `priority_runs` first and then from the most recent run.
+    Returns the files to download (only those that fit) and the ones already present.
+    """
+    import shutil
+    present = []
+    to_download = list(list_of_hl_output)
+    if not overwrite:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            sane = list(executor.map(lambda x: x.is_sane(throw_fatal=False), list_of_hl_output))
+        present = [i for i, j in zip(list_of_hl_output, sane) if j]
+        to_download = [i for i, j in zip(list_of_hl_output, sane) if not j]
+    for i in present:
+        i.keep_present()
+    priority_runs = priority_runs or []
+    to_download.sort(key=lambda x: (x.get_run() not in priority_runs, -(x.get_run() or 0)))
+    needed = sum(i.get_alien_file_size() for i in to_download)
+    catalog = get_catalog(out_path)
+
+    def available_space():
+        space = shutil.disk_usage(catalog.out_path).free
+        if disk_budget is not None:
+            space = min(space, disk_budget - catalog.total_size())
+        return space
+    space = available_space()
+    msg("Planning", len(to_download), "downloads for", f"{needed/1024/1024/1024:.2f} GB,",
+        f"{space/1024/1024/1024:.2f} GB available")
+    if needed > space:
+        freed = catalog.evict(needed - space, keep_trains=keep_trains)
+        msg("Evicted", f"{freed/1024/1024/1024:.2f} GB", "of least recently used outputs")
+        space = available_space()
+    if needed > space:
+        planned = []
+        for i in to_download:
+            if i.get_alien_file_size() > space:
+                continue
+            space -= i.get_alien_file_size()
+            planned.append(i)
+        wmsg("Not enough disk space, skipping the download of runs", [i.get_run() for i in to_download if i not in planned])
+        to_download = planned
+    return to_download, present
+
+
+def stream_downloads(list_of_hl_output,
+                     hyperloop_train_id=None,
+                     out_path="/tmp/",
+                     overwrite=False,
+                     jobs=1,
+                     retries=2,
+                     objects=None,
+                     disk_budget=None,
+                     priority_runs=None):
+    """
+    Yields each HyperloopOutput of the list with its local file name (None if it could not be obtained)
+    as soon as the file is available: the files already present first, then each download once verified.
+    If `objects` is given only these objects are read from the remote files.
+    """
+    resolve_merge_stages(list_of_hl_output)
+    if objects is not None:
+        # Reading only the requested objects instead of the full files
+        if jobs > 1:
+            enable_root_thread_safety()
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {executor.submit(i.fetch_objects, objects, overwrite): i for i in list_of_hl_output}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        return
+
+    alien_metadata.prefetch(list_of_hl_output, tags={"train_id": hyperloop_train_id})
+    to_download, present = plan_downloads(list_of_hl_output,
+                                          out_path=out_path,
+                                          disk_budget=disk_budget,
+                                          priority_runs=priority_runs,
+                                          overwrite=overwrite,
+                                          keep_trains=[hyperloop_train_id],
+                                          jobs=jobs)
+    # The transfers run while the files already present are processed
+    downloads = iter_downloads(to_download, jobs=jobs, overwrite=overwrite, retries=retries)
+    for i in present:
+        msg("File", f"`{i.out_filename()}`", "already present, skipping for download")
+        yield i, i.out_filename()
+    for i in list_of_hl_output:
+        if i not in present and i not in to_download:
+            yield i, None
+    failed = []
+    for i, d in downloads:
+        if d is None:
+            failed.append(i.get_run())
+        yield i, d
+    msg("Downloaded", len(to_download) - len(failed), "out of", len(to_download), "files")
+    if len(failed) > 0:
+        wmsg("Failed downloads for runs", failed)
+
+
 def process_one_hyperloop_id(hyperloop_train_id=126264,
                              out_path="/tmp/",
                              overwrite=False,
@@ -673,7 +1522,11 @@ def process_one_hyperloop_id(hyperloop_train_id=126264,
                              jobs=1,
                              key_file="/tmp/tokenkey_1000.pem",
                              cert_file="/tmp/tokencert_1000.pem",
-                             list_derived_data=False):
+                             list_derived_data=False,
+                             retries=2,
+                             objects=None,
+                             disk_budget=None,
+                             priority_runs=None):
     # Getting input for single
     list_of_hl_output = get_run_per_run_files(train_id=hyperloop_train_id,
                                               out_path=out_path,
@@ -681,26 +1534,20 @@ def process_one_hyperloop_id(hyperloop_train_id=126264,
                                               key_file=key_file,
                                               cert_file=cert_file)
     if list_derived_data:
-        total_list = []
-        for i in list_of_hl_output:
-            print(i)
-            total_list.append(i.find_derived_data())
-        print(total_list)
-        with open("/tmp/list_of_derived_data.txt", "w") as f:
-            for i in total_list:
-                for j in i:
-                    f.write(f"alien://{j}\n")
+        list_derived_data_files(list_of_hl_output, resume=not overwrite)
         return ""
 
-    downloaded = []
-    if jobs > 1:
-        with Pool() as pool:
-            pool.map(download_file, list_of_hl_output)
-    for i in tqdm.tqdm(list_of_hl_output, bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}'):
-        d = i.copy_from_alien(overwrite=overwrite)
-        if d is None:
-            continue
-        downloaded.append(d)
+    results = dict(stream_downloads(list_of_hl_output,
+                                    hyperloop_train_id=hyperloop_train_id,
+                                    out_path=out_path,
+                                    overwrite=overwrite,
+                                    jobs=jobs,
+                                    retries=retries,
+                                    objects=objects,
+                                    disk_budget=disk_budget,
+                                    priority_runs=priority_runs))
+    # Keeping the order of the input list
+    downloaded = [results[i] for i in list_of_hl_output if results.get(i, None) is not None]
     print("Downloaded for ID", hyperloop_train_id, "=", downloaded)
     return " ".join(downloaded)
 
@@ -740,18 +1587,55 @@ def main():
                         type=int,
                         default=1,
                         help="Parallel jobs to run. Default: `1`")
+    parser.add_argument("--retries", "-r",
+                        type=int,
+                        default=2,
+                        help="Number of retries for each failed download. Default: `2`")
     parser.add_argument("--cert_file", "-c",
                         default="/tmp/tokencert_1000.pem",
                         help="Certificate file for authentication")
     parser.add_argument("--list_derived_data", "-L", "--list_aods",
                         action="store_true",
                         help="List the derived data produced by an hyperloop train")
+    parser.add_argument("--objects_from_ini", "--ini",
+                        default=None,
+                        help="Trending configuration, if given only the objects it requests are read from the remote files. Default: `None`")
+    parser.add_argument("--trace",
+                        default=None,
+                        help="File where to record a trace of the grid commands, summarize it with `./grid_commands.py TRACE`. Default: `None`")
+    parser.add_argument("--disk_budget", "-B",
+                        type=float,
+                        default=None,
+                        help="Disk budget in GB for the downloaded outputs, older trains are evicted to stay within it. Default: `None`")
+    parser.add_argument("--priority_runs", "-P",
+                        type=int,
+                        nargs="+",
+                        default=None,
+                        help="Runs to download first. Default: `None`")
+    parser.add_argument("--alien_session", "-S",
+                        action="store_true",
+                        help="Run the alien metadata commands through one persistent alien session. Default: `False`")
+    parser.add_argument("--remote_prefix",
+                        default=None,
+                        help="Prefix to open the remote files for object reads (e.g. `root://localhost:1094/`). Default: alien")
     args = parser.parse_args()
     if args.verbose:
         set_verbose_mode()
     if args.drymode:
         set_dry_mode()
-
+    if args.trace is not None:
+        set_trace_file(args.trace)
+    if args.alien_session:
+        enable_alien_session()
+    if args.remote_prefix is not None:
+        set_remote_read_prefix(args.remote_prefix)
+    objects = None
+    if args.objects_from_ini is not None:
+        objects = objects_from_ini(args.objects_from_ini)
+
+    if len(args.hyperloop_train_ids) > 1:
+        get_fetcher(key_file=args.key_file, cert_file=args.cert_file).fetch_many(args.hyperloop_train_ids,
+                                                                               out_path=args.out_path)
     files_downloaded = []
     for i in args.hyperloop_train_ids:
         files_downloaded.append(process_one_hyperloop_id(hyperloop_train_id=i,
@@ -762,7 +1646,11 @@ def main():
                                                          download_merged=args.download_merged,
                                                          key_file=args.key_file,
                                                          cert_file=args.cert_file,
-                                                         list_derived_data=args.list_derived_data))
+                                                         list_derived_data=args.list_derived_data,
+                                                         retries=args.retries,
+                                                         objects=objects,
+                                                         disk_budget=None if args.disk_budget is None else args.disk_budget*1024*1024*1024,
+                                                         priority_runs=args.priority_runs))
     print("Files downloaded:")
     print(" ".join(files_downloaded))
 
@@ -6,6 +6,7 @@ Script to assign filesnames to period
 """
 
 import download_hyperloop_per_run
+from hyperloop_catalog import is_valid
 import argparse
 from shutil import copyfile
 import os
@@ -14,23 +15,26 @@ import os
 def main(hyperloop_train,
          copy_with_period=True,
          runs=None,
-         merged=False):
-    l = download_hyperloop_per_run.get_run_per_run_files(train_id=hyperloop_train,
-                                                         list_merged_files=merged)
+         merged=False,
+         out_path="/tmp/"):
+    if not copy_with_period:
+        return
+    entries = download_hyperloop_per_run.local_outputs(hyperloop_train, out_path=out_path, merged=merged)
     list_of_files = []
-    for i in l:
-        p = i.get_dataset_name()
-        if not copy_with_period:
-            continue
-        r = i.get_run()
+    for i in entries:
+        p = i["dataset_name"]
+        r = i["run"]
         if r is not None:
             if runs is not None:
                 print(runs)
                 if r not in runs:
                     continue
-        l = i.out_filename()
+        l = i["local_path"]
         if l is None:
             continue
+        if "size" in i and not is_valid(i):
+            print("Skipping", l, "the file is not valid")
+            continue
         os.makedirs("/tmp/PerPeriods/", exist_ok=True)
         if r is not None:
             p = f"/tmp/PerPeriods/AnalysisResults_{p}_Run{r}.root"
@@ -6,20 +6,23 @@ Script to assign filesnames to run number as tags
 """
 
 import download_hyperloop_per_run
+from hyperloop_catalog import is_valid
 import argparse
 
 
-
-def main(hyperloop_train, request_run_number=None):
-    l = download_hyperloop_per_run.get_run_per_run_files(train_id=hyperloop_train)
+def main(hyperloop_train, request_run_number=None, out_path="/tmp/"):
     list_of_files = []
     list_of_runs = []
-    for i in l:
+    # Using what is already downloaded, completed with the train listing
+    for i in download_hyperloop_per_run.local_outputs(hyperloop_train, out_path=out_path):
         if request_run_number is not None:
-            if i.get_run() not in request_run_number:
+            if i["run"] not in request_run_number:
                 continue
-        list_of_files.append("/tmp/"+i.local_file_position())
-        list_of_runs.append(f"\"Run {i.get_run()}\"")
+        if "size" in i and not is_valid(i):
+            print("Skipping run", i["run"], "file", i["local_path"], "is not valid")
+            continue
+        list_of_files.append(i["local_path"])
+        list_of_runs.append(f"\"Run {i['run']}\"")
     list_of_files = " ".join(list_of_files)
     list_of_runs = " ".join(list_of_runs)
     print(f"{list_of_files} -t {list_of_runs}")
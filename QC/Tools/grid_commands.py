@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+"""
+Asynchronous runner for the grid command line tools (alien_ls, alien_stat, alien_find, alien_cp, ...).
+All commands run as asyncio subprocesses on one event loop living in a background thread,
+a global semaphore bounds how many of them run at the same time.
+Commands can be awaited from coroutines running on the loop, or submitted and waited for from synchronous code.
+The metadata commands can be sent through a persistent alien session (see `enable_alien_session`)
+instead of starting a new client process, and redoing the token handshake, for each of them.
+Each command (and any other block traced with `traced`) can be recorded as a JSON line in a trace file,
+the trace is summarized with `./grid_commands.py TRACE_FILE`.
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Maximum number of commands running at the same time
+max_concurrent_commands = 16
+# Default timeout in seconds per command, None means no timeout
+default_timeouts = {"alien_ls": 300,
+                    "alien_stat": 120,
+                    "alien_find": 900,
+                    "alien_cp": None}
+
+
+# Trace file for the command records, None means no tracing
+trace_file = os.environ.get("GRID_TRACE_FILE", None)
+trace_lock = threading.Lock()
+
+
+def set_trace_file(file_name):
+    global trace_file
+    trace_file = file_name
+    print("Tracing grid commands to", file_name)
+
+
+def record_trace(kind, start, duration, nbytes=0, exit_code=0, cmd=None, run=None, train_id=None):
+    """
+    Appends one record to the trace file
+    """
+    if trace_file is None:
+        return
+    record = {"kind": kind,
+              "start": start,
+              "duration": duration,
+              "bytes": nbytes,
+              "exit_code": exit_code,
+              "run": run,
+              "train_id": train_id}
+    if cmd is not None:
+        record["cmd"] = " ".join(cmd)
+    with trace_lock:
+        with open(trace_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+@contextmanager
+def traced(kind, **tags):
+    """
+    Traces a block of code that is not a command (e.g. HTTP requests or ROOT reads).
+    Yields a dictionary where the bytes moved can be set as `record["bytes"]`.
+    """
+    record = {"bytes": 0}
+    start = time.time()
+    exit_code = 0
+    try:
+        yield record
+    except BaseException:
+        exit_code = 1
+        raise
+    finally:
+        record_trace(kind, start, time.time() - start, nbytes=record["bytes"], exit_code=exit_code, **tags)
+
+
+def bytes_moved(cmd, stdout):
+    """
+    Bytes moved by a command: the size of the destination for copies, the size of the output otherwise
+    """
+    if os.path.basename(cmd[0]) == "alien_cp":
+        for i in cmd[1:]:
+            if i.startswith("file:"):
+                i = i.replace("file://", "").replace("file:", "")
+                if os.path.isfile(i):
+                    return os.path.getsize(i)
+        return 0
+    if stdout is None:
+        return 0
+    return len(stdout)
+
+
+class AlienPyClient:
+    """
+    Alien client keeping one authenticated connection open through the `alienpy` module.
+    Any object with the same `run` method can be used as client of an `AlienSession` (e.g. a fake client for tests).
+    """
+
+    def __init__(self):
+        from alienpy import alien
+        self.alien = alien
+        self.wb = alien.InitConnection()
+
+    def run(self, args):
+        """
+        Runs a command given as for the command line tools (e.g. ["alien_ls", "/alice"]),
+        returns the exit code, the standard output and the standard error as strings
+        """
+        cmd = os.path.basename(args[0]).replace("alien_", "", 1)
+        args = list(args[1:])
+        if cmd != "cp":
+            args = [i.replace("alien://", "", 1) for i in args]
+        as_json = "-json" in args
+        if as_json:
+            args.remove("-json")
+        ret = self.alien.ProcessInput(self.wb, cmd, args)
+        if as_json:
+            return ret.exitcode, json.dumps(ret.ansdict), ret.err
+        return ret.exitcode, ret.out, ret.err
+
+
+# Commands sent through the alien session when it is enabled
+session_commands = ["alien_ls", "alien_stat", "alien_find", "alien_home"]
+
+
+class AlienSession:
+    def __init__(self, client=None, commands=session_commands):
+        """
+        Persistent alien session, the commands are executed one after the other on a single client.
+        If `client` is None an `AlienPyClient` is created at the first command.
+        If the client cannot be created, or a command fails or times out, the session is abandoned and
+        the commands go back to separate processes.
+        """
+        self.client = client
+        self.commands = set(commands)
+        self.broken = False
+        # The client is used from a single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="alien_session")
+
+    def handles(self, cmd):
+        return not self.broken and os.path.basename(cmd[0]) in self.commands
+
+    def run_sync(self, cmd):
+        if self.client is None:
+            self.client = AlienPyClient()
+        exit_code, stdout, stderr = self.client.run(cmd)
+        return subprocess.CompletedProcess(cmd, exit_code, (stdout or "").encode(), (stderr or "").encode())
+
+    async def run_async(self, cmd, timeout=None):
+        """
+        Runs a command on the session, returns None if the session cannot be used (the command has to be run as a process)
+        """
+        try:
+            return await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(self.executor, self.run_sync, cmd), timeout)
+        except asyncio.TimeoutError:
+            self.broken = True
+            print("Command", " ".join(cmd), f"timed out after {timeout} s on the alien session, not using the session anymore")
+            return subprocess.CompletedProcess(cmd, -1, b"", f"Timeout after {timeout} s".encode())
+        except Exception as e:
+            self.broken = True
+            if self.client is None:
+                print("Cannot open the alien session:", e, "running the commands as separate processes")
+            else:
+                # e.g. the connection dropped, this command and the next ones run as separate processes
+                print("Command", " ".join(cmd), "failed on the alien session:", e, "running the commands as separate processes")
+            return None
+
+    def close(self):
+        if self.client is not None and hasattr(self.client, "close"):
+            self.client.close()
+        self.executor.shutdown(wait=False)
+
+
+alien_session = None
+
+
+def enable_alien_session(client=None, commands=session_commands):
+    """
+    Sends the given commands through a persistent alien session
+    """
+    global alien_session
+    if alien_session is not None:
+        alien_session.close()
+    alien_session = AlienSession(client=client, commands=commands)
+    return alien_session
+
+
+class CommandRunner:
+    def __init__(self, max_concurrent=max_concurrent_commands):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="grid_commands", daemon=True)
+        self.thread.start()
+        self.max_concurrent = max_concurrent
+
+        async def make_semaphore():
+            return asyncio.Semaphore(max_concurrent)
+        self.semaphore = self.submit_coroutine(make_semaphore()).result()
+
+    async def run_async(self, cmd, timeout="default", tags=None):
+        """
+        Runs a command given as list of arguments, returns a `subprocess.CompletedProcess`.
+        On timeout the command is killed and the return code is -1.
+        If the awaiting task is cancelled the command is killed.
+        `tags` (run and train_id) are added to the trace record.
+        """
+        tags = tags or {}
+        kind = os.path.basename(cmd[0])
+        if timeout == "default":
+            timeout = default_timeouts.get(kind, None)
+        if alien_session is not None and alien_session.handles(cmd):
+            start = time.time()
+            result = await alien_session.run_async(cmd, timeout=timeout)
+            if result is not None:
+                record_trace(f"{kind}[session]", start, time.time() - start,
+                             nbytes=bytes_moved(cmd, result.stdout),
+                             exit_code=result.returncode,
+                             cmd=cmd,
+                             **tags)
+                return result
+        async with self.semaphore:
+            start = time.time()
+            proc = await asyncio.create_subprocess_exec(*cmd,
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                result = subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                result = subprocess.CompletedProcess(cmd, -1, b"", f"Timeout after {timeout} s".encode())
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                record_trace(kind, start, time.time() - start, exit_code=-2, cmd=cmd, **tags)
+                raise
+        record_trace(kind, start, time.time() - start,
+                     nbytes=bytes_moved(cmd, result.stdout),
+                     exit_code=result.returncode,
+                     cmd=cmd,
+                     **tags)
+        return result
+
+    def submit_coroutine(self, coroutine):
+        """
+        Schedules a coroutine on the runner loop, returns a `concurrent.futures.Future` (that can be cancelled)
+        """
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("Cannot wait for a command from the runner loop, await it instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run_coroutine(self, coroutine):
+        return self.submit_coroutine(coroutine).result()
+
+    def submit(self, cmd, timeout="default", tags=None):
+        return self.submit_coroutine(self.run_async(cmd, timeout=timeout, tags=tags))
+
+    def run(self, cmd, timeout="default", tags=None):
+        return self.submit(cmd, timeout=timeout, tags=tags).result()
+
+    def run_many(self, cmds, timeout="default", tags=None):
+        """
+        Runs all the commands concurrently, returns the results in the same order
+        """
+        futures = [self.submit(i, timeout=timeout, tags=tags) for i in cmds]
+        try:
+            return [i.result() for i in futures]
+        except BaseException:
+            for i in futures:
+                i.cancel()
+            raise
+
+
+runner = None
+runner_lock = threading.Lock()
+
+
+def get_runner():
+    """
+    Returns the runner of the process, created at the first use
+    """
+    global runner
+    with runner_lock:
+        if runner is None:
+            runner = CommandRunner(max_concurrent_commands)
+    return runner
+
+
+def set_max_concurrent_commands(n):
+    """
+    Sets the maximum number of concurrent commands, to be called before the first command is run
+    """
+    global max_concurrent_commands
+    if runner is not None:
+        raise RuntimeError("The command runner is already running")
+    max_concurrent_commands = n
+
+
+def busy_time(intervals):
+    """
+    Time covered by the union of the (start, end) intervals
+    """
+    total = 0
+    current_start = None
+    current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start = start
+            current_end = end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def summarize_trace(file_name, top=10):
+    """
+    Prints the time spent per kind of command, the slowest commands and the effective transfer throughput
+    """
+    with open(file_name) as f:
+        records = [json.loads(i) for i in f if i.strip() != ""]
+    if len(records) == 0:
+        print("No records in", file_name)
+        return
+    wall_time = max(i["start"] + i["duration"] for i in records) - min(i["start"] for i in records)
+    print(f"{len(records)} records spanning {wall_time:.1f} s of wall clock time")
+    kinds = {}
+    for i in records:
+        kinds.setdefault(i["kind"], []).append(i)
+    print(f"{'kind':<15} {'calls':>7} {'failed':>7} {'total (s)':>10} {'busy (s)':>10} {'mean (s)':>9} {'max (s)':>9} {'MB':>10} {'MB/s':>8}")
+    for kind in sorted(kinds, key=lambda x: -sum(i["duration"] for i in kinds[x])):
+        k = kinds[kind]
+        total = sum(i["duration"] for i in k)
+        busy = busy_time([(i["start"], i["start"] + i["duration"]) for i in k])
+        nbytes = sum(i["bytes"] for i in k)
+        failed = len([i for i in k if i["exit_code"] != 0])
+        # Effective throughput: bytes over the time in which at least one command of this kind was running
+        throughput = nbytes / busy / 1024 / 1024 if busy > 0 else 0
+        print(f"{kind:<15} {len(k):>7} {failed:>7} {total:>10.1f} {busy:>10.1f} {total/len(k):>9.2f} {max(i['duration'] for i in k):>9.2f} {nbytes/1024/1024:>10.1f} {throughput:>8.2f}")
+    print(f"Top {top} slowest:")
+    for i in sorted(records, key=lambda x: -x["duration"])[:top]:
+        print(f"  {i['duration']:8.2f} s {i['kind']:<15} run {i['run']} train {i['train_id']} {i.get('cmd', '')}")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Summary of a grid command trace file")
+    parser.add_argument("trace_file",
+                        help="Trace file (JSON lines) to summarize")
+    parser.add_argument("--top", "-t",
+                        type=int,
+                        default=10,
+                        help="Number of slowest records to show. Default: `10`")
+    args = parser.parse_args()
+    summarize_trace(args.trace_file, top=args.top)
+
+
+if __name__ == "__main__":
+    main()
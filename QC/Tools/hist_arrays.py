@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+NumPy backend for the histogram statistics used in the trending.
+Histograms are converted to `ArrayHisto` (contents, errors and edges as arrays, with the underflow and overflow bins
+at the first and last position as in ROOT) and the quantities are computed for many histograms at once:
+`batch_mean`, `batch_value_at` and `batch_integral` return arrays with one entry per histogram.
+`ArrayHisto` also has the PyROOT methods used in the trending (`GetMean`, `GetBinContent`, `GetXaxis().FindBin`, ...)
+so that histograms read without ROOT (`from_uproot`) can be used in place of the ROOT ones.
+"""
+
+import numpy as np
+
+
+class ArrayAxis:
+    """
+    Axis of an `ArrayHisto` with the methods of `TAxis`
+    """
+
+    def __init__(self, edges, title=""):
+        self.edges = edges
+        self.title = title
+
+    def GetTitle(self):
+        return self.title
+
+    def GetNbins(self):
+        return len(self.edges) - 1
+
+    def GetBinLowEdge(self, b):
+        return float(self.edges[b - 1])
+
+    def GetBinUpEdge(self, b):
+        return float(self.edges[b])
+
+    def GetBinCenter(self, b):
+        return 0.5 * (self.GetBinLowEdge(b) + self.GetBinUpEdge(b))
+
+    def GetXmin(self):
+        return float(self.edges[0])
+
+    def GetXmax(self):
+        return float(self.edges[-1])
+
+    def FindBin(self, x):
+        return int(np.searchsorted(self.edges, x, side="right"))
+
+
+class ArrayHisto:
+    def __init__(self, contents, errors, edges, name="", title="", entries=None, stats=None, x_title=""):
+        """
+        One dimensional histogram as arrays.
+        `contents` and `errors` have the underflow and overflow bins (size nbins + 2), `edges` has size nbins + 1.
+        `stats` are the ROOT statistics [sum w, sum w^2, sum w x, sum w x^2], if None they are computed from the bins.
+        """
+        self.contents = np.asarray(contents, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.edges = np.asarray(edges, dtype=float)
+        if self.contents.shape != self.errors.shape or len(self.contents) != len(self.edges) + 1:
+            raise ValueError(f"Inconsistent shapes for {name}: {self.contents.shape} contents, {self.errors.shape} errors, {self.edges.shape} edges")
+        self.name = name
+        self.title = title
+        self.entries = entries if entries is not None else float(self.contents.sum())
+        self.stats = np.asarray(stats, dtype=float) if stats is not None else None
+        self.x_title = x_title
+
+    def centers(self):
+        return 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def bin_stats(self):
+        """
+        Statistics computed from the bin contents (without underflow and overflow)
+        """
+        c = self.contents[1:-1]
+        x = self.centers()
+        return np.array([c.sum(), (self.errors[1:-1]**2).sum(), (c * x).sum(), (c * x * x).sum()])
+
+    def find_bin(self, x):
+        """
+        Bin of x as in ROOT: 0 is the underflow, nbins + 1 the overflow
+        """
+        return int(np.searchsorted(self.edges, x, side="right"))
+
+    # Methods of TH1
+    def GetName(self):
+        return self.name
+
+    def GetTitle(self):
+        return self.title
+
+    def ClassName(self):
+        return "TH1D"
+
+    def InheritsFrom(self, class_name):
+        return class_name in ["TH1", "TH1D", "TNamed", "TObject"]
+
+    def GetDimension(self):
+        return 1
+
+    def GetEntries(self):
+        return self.entries
+
+    def GetNbinsX(self):
+        return len(self.edges) - 1
+
+    def GetXaxis(self):
+        return ArrayAxis(self.edges, self.x_title)
+
+    def GetBinContent(self, b):
+        return float(self.contents[b])
+
+    def GetBinError(self, b):
+        return float(self.errors[b])
+
+    def GetMean(self):
+        return float(batch_mean([self])[0][0])
+
+    def GetMeanError(self):
+        return float(batch_mean([self])[1][0])
+
+    def Integral(self, first=1, last=None):
+        if last is None:
+            last = self.GetNbinsX()
+        return float(self.contents[first:last + 1].sum())
+
+    def to_root(self):
+        """
+        Converts back to a ROOT TH1D, e.g. to fit or draw it
+        """
+        from ROOT import TH1D
+        h = TH1D(self.name, self.title, self.GetNbinsX(), self.edges)
+        h.SetDirectory(0)
+        h.GetXaxis().SetTitle(self.x_title)
+        for i in range(len(self.contents)):
+            h.SetBinContent(i, self.contents[i])
+            h.SetBinError(i, self.errors[i])
+        h.SetEntries(self.entries)
+        return h
+
+
+# Type of the bin contents of the ROOT histograms, from the array they inherit from
+root_array_types = [("TArrayD", np.float64), ("TArrayF", np.float32), ("TArrayI", np.int32),
+                    ("TArrayL64", np.int64), ("TArrayS", np.int16), ("TArrayC", np.int8)]
+
+
+def root_stats(h):
+    """
+    ROOT statistics [sum w, sum w^2, sum w x, sum w x^2] of a one dimensional histogram, read with a single `GetStats`
+    """
+    # TH1::GetStats fills 4 values for one dimensional histograms, more for profiles
+    stats = np.zeros(13)
+    h.GetStats(stats)
+    return stats[:4]
+
+
+def from_root(h):
+    """
+    Converts a ROOT one dimensional histogram into an `ArrayHisto`, the contents, errors and edges are copied
+    from the ROOT buffers in bulk
+    """
+    if isinstance(h, ArrayHisto):
+        return h
+    n = h.GetNbinsX()
+    axis = h.GetXaxis()
+    dtype = next((t for c, t in root_array_types if h.InheritsFrom(c)), np.float64)
+    contents = np.frombuffer(h.GetArray(), dtype=dtype, count=n + 2).astype(float)
+    sumw2 = h.GetSumw2()
+    if sumw2.GetSize() > 0:
+        errors = np.sqrt(np.frombuffer(sumw2.GetArray(), dtype=np.float64, count=n + 2))
+    else:
+        errors = np.sqrt(np.abs(contents))
+    xbins = axis.GetXbins()
+    if xbins.GetSize() > 0:
+        edges = np.frombuffer(xbins.GetArray(), dtype=np.float64, count=n + 1).copy()
+    else:
+        edges = np.linspace(axis.GetXmin(), axis.GetXmax(), n + 1)
+    return ArrayHisto(contents, errors, edges,
+                      name=h.GetName(),
+                      title=h.GetTitle(),
+                      entries=h.GetEntries(),
+                      stats=root_stats(h),
+                      x_title=axis.GetTitle())
+
+
+def from_uproot(h):
+    """
+    Converts a one dimensional histogram read with uproot into an `ArrayHisto`, returns None for other objects
+    """
+    if not hasattr(h, "values") or not hasattr(h, "axes") or len(h.axes) != 1 or "TProfile" in h.classname:
+        return None
+    stats = None
+    if h.has_member("fTsumw"):
+        stats = [h.member("fTsumw"), h.member("fTsumw2"), h.member("fTsumwx"), h.member("fTsumwx2")]
+    return ArrayHisto(h.values(flow=True), h.errors(flow=True), h.axis().edges(),
+                      name=h.member("fName"),
+                      title=h.member("fTitle"),
+                      entries=h.member("fEntries"),
+                      stats=stats,
+                      x_title=h.axis().member("fTitle"))
+
+
+def is_convertible(h):
+    """
+    Checks if a ROOT object can be converted, only one dimensional histograms (not profiles) are
+    """
+    return h.InheritsFrom("TH1") and h.GetDimension() == 1 and not h.InheritsFrom("TProfile")
+
+
+def same_binning(histos):
+    return all(len(h.edges) == len(histos[0].edges) and np.array_equal(h.edges, histos[0].edges) for h in histos)
+
+
+def batch_mean(histos):
+    """
+    Mean and error on the mean of each histogram, as `TH1::GetMean` and `TH1::GetMeanError` with no axis range set
+    """
+    return mean_from_stats([h.stats if h.stats is not None and h.stats[0] != 0 else h.bin_stats() for h in histos])
+
+
+def mean_from_stats(stats):
+    """
+    Mean and error on the mean from the statistics of each histogram ([sum w, sum w^2, sum w x, sum w x^2])
+    """
+    sumw, sumw2, sumwx, sumwx2 = np.asarray(stats, dtype=float).reshape(-1, 4).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(sumw != 0, sumwx / sumw, 0.)
+        std_dev = np.sqrt(np.abs(np.where(sumw != 0, sumwx2 / sumw, 0.) - mean * mean))
+        effective_entries = np.where(sumw2 != 0, sumw * sumw / sumw2, 0.)
+        mean_error = np.where(effective_entries > 0, std_dev / np.sqrt(effective_entries), 0.)
+    return mean, mean_error
+
+
+def batch_value_at(histos, x):
+    """
+    Content and error of the bin containing x in each histogram
+    """
+    if same_binning(histos):
+        b = histos[0].find_bin(x)
+        return np.array([h.contents[b] for h in histos]), np.array([h.errors[b] for h in histos])
+    bins = [h.find_bin(x) for h in histos]
+    return np.array([h.contents[b] for h, b in zip(histos, bins)]), np.array([h.errors[b] for h, b in zip(histos, bins)])
+
+
+def batch_integral(histos, x_min=None, x_max=None):
+    """
+    Sum of the bin contents (and its error) between the bins containing x_min and x_max, all bins if not given.
+    The underflow and overflow are not included unless the range extends to them.
+    """
+    def bin_range(h):
+        first = 1 if x_min is None else h.find_bin(x_min)
+        last = len(h.edges) - 1 if x_max is None else h.find_bin(x_max)
+        return first, last + 1
+    if same_binning(histos):
+        first, last = bin_range(histos[0])
+        contents = np.stack([h.contents for h in histos])[:, first:last]
+        errors = np.stack([h.errors for h in histos])[:, first:last]
+        return contents.sum(axis=1), np.sqrt((errors**2).sum(axis=1))
+    integrals = []
+    errors = []
+    for h in histos:
+        first, last = bin_range(h)
+        integrals.append(h.contents[first:last].sum())
+        errors.append(np.sqrt((h.errors[first:last]**2).sum()))
+    return np.array(integrals), np.array(errors)
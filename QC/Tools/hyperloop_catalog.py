@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""
+Local catalog of the Hyperloop outputs downloaded with `download_hyperloop_per_run.py`.
+The catalog is a SQLite database in the output path, it records for each train and run the local and remote path,
+the size and checksum of the file, the merge state, the dataset name and the download time.
+Example usage: `./hyperloop_catalog.py TRAIN_ID` to list what is available locally and whether it is valid
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+catalog_file_name = "hyperloop_catalog.sqlite"
+columns = ["train_id", "run", "local_path", "remote_path", "size", "checksum", "merge_state", "dataset_name", "download_time", "last_access"]
+
+
+class HyperloopCatalog:
+    def __init__(self, out_path="/tmp/"):
+        self.out_path = os.path.abspath(out_path)
+        os.makedirs(self.out_path, exist_ok=True)
+        self.db_path = os.path.join(self.out_path, catalog_file_name)
+        # The catalog is shared among the download threads and the extraction worker processes:
+        # with the write-ahead log the readers do not block the writer, and the writers wait for each other
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS outputs (
+                               train_id INTEGER NOT NULL,
+                               run INTEGER,
+                               local_path TEXT NOT NULL,
+                               remote_path TEXT NOT NULL,
+                               size INTEGER,
+                               checksum TEXT,
+                               merge_state TEXT,
+                               dataset_name TEXT,
+                               download_time REAL,
+                               last_access REAL,
+                               PRIMARY KEY (train_id, local_path))""")
+            # Catalogs created before the access time was tracked
+            if "last_access" not in [i[1] for i in self.db.execute("PRAGMA table_info(outputs)")]:
+                self.db.execute("ALTER TABLE outputs ADD COLUMN last_access REAL")
+            self.db.execute("CREATE INDEX IF NOT EXISTS outputs_run ON outputs (train_id, run)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS outputs_local_path ON outputs (local_path)")
+
+    def record(self, train_id, run, local_path, remote_path, size, checksum=None, merge_state=None, dataset_name=None):
+        with self.lock, self.db:
+            self.db.execute(f"INSERT OR REPLACE INTO outputs ({', '.join(columns)}) VALUES ({', '.join(['?']*len(columns))})",
+                            (train_id, run, local_path, remote_path, size, checksum, merge_state, dataset_name, time.time(), time.time()))
+
+    def touch(self, local_path):
+        """
+        Marks the file as used now, for the least recently used eviction
+        """
+        with self.lock, self.db:
+            self.db.execute("UPDATE outputs SET last_access = ? WHERE local_path = ?", (time.time(), local_path))
+
+    def forget(self, local_path):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM outputs WHERE local_path = ?", (local_path,))
+
+    def lookup(self, train_id, runs=None):
+        """
+        Returns the entries of a train as dictionaries, sorted by run number.
+        If `runs` is given only the entries of these runs are returned.
+        """
+        query = "SELECT * FROM outputs WHERE train_id = ?"
+        args = [train_id]
+        if runs is not None:
+            runs = [int(i) for i in runs]
+            query += f" AND run IN ({', '.join(['?']*len(runs))})"
+            args += runs
+        query += " ORDER BY run"
+        with self.lock:
+            return [dict(i) for i in self.db.execute(query, args)]
+
+    def lookup_local(self, local_path):
+        with self.lock:
+            r = self.db.execute("SELECT * FROM outputs WHERE local_path = ?", (local_path,)).fetchone()
+        if r is None:
+            return None
+        return dict(r)
+
+    def total_size(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM outputs").fetchone()[0]
+
+    def evict(self, size_to_free, keep_trains=None):
+        """
+        Removes the least recently used files, of trains other than `keep_trains`, until `size_to_free` bytes are freed.
+        Returns the number of bytes freed.
+        """
+        query = "SELECT * FROM outputs"
+        keep_trains = keep_trains or []
+        if len(keep_trains) > 0:
+            query += f" WHERE train_id NOT IN ({', '.join(['?']*len(keep_trains))})"
+        query += " ORDER BY COALESCE(last_access, download_time)"
+        with self.lock:
+            entries = [dict(i) for i in self.db.execute(query, list(keep_trains))]
+        freed = 0
+        for i in entries:
+            if freed >= size_to_free:
+                break
+            if os.path.isfile(i["local_path"]):
+                freed += os.path.getsize(i["local_path"])
+                os.remove(i["local_path"])
+            print("Evicted run", i["run"], "of train", i["train_id"], i["local_path"])
+            self.forget(i["local_path"])
+        return freed
+
+    def trains(self):
+        with self.lock:
+            return [i[0] for i in self.db.execute("SELECT DISTINCT train_id FROM outputs ORDER BY train_id")]
+
+    def close(self):
+        self.db.close()
+
+
+def is_valid(entry):
+    """
+    Checks that the file of a catalog entry is still there with the recorded size
+    """
+    if entry is None or not os.path.isfile(entry["local_path"]):
+        return False
+    if entry["size"] is None:
+        return False
+    return os.path.getsize(entry["local_path"]) == entry["size"]
+
+
+catalogs = {}
+
+
+def get_catalog(out_path="/tmp/"):
+    """
+    Returns the catalog of the output path, opening it only once per process
+    """
+    out_path = os.path.abspath(out_path)
+    if out_path not in catalogs:
+        catalogs[out_path] = HyperloopCatalog(out_path)
+    return catalogs[out_path]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("hyperloop_train_ids",
+                        help="Train ID to consider, if not given all trains in the catalog are listed",
+                        nargs="*",
+                        type=int)
+    parser.add_argument("--out_path", "-o",
+                        default="/tmp/",
+                        help="Output path where the catalog is located. Default: `/tmp/`")
+    parser.add_argument("--runs", "-r",
+                        help="Runs to consider", nargs="+", type=int, default=None)
+    args = parser.parse_args()
+    catalog = get_catalog(args.out_path)
+    train_ids = args.hyperloop_train_ids
+    if len(train_ids) == 0:
+        train_ids = catalog.trains()
+    for i in train_ids:
+        entries = catalog.lookup(i, runs=args.runs)
+        print("Train", i, "has", len(entries), "outputs in the catalog")
+        for j in entries:
+            print(f"  Run {j['run']} {j['dataset_name']} {j['local_path']} {j['size']} bytes",
+                  "valid" if is_valid(j) else "NOT VALID")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""
+Fetching of the Hyperloop train information (JSON) from the Hyperloop web server.
+Connections are persistent and authenticated with the grid token (client certificate),
+the JSON is cached in the output path and revalidated with the server (ETag/Last-Modified) once its time to live expired.
+Parsed trains are kept in memory so that repeated calls do not go to disk nor to the server.
+Example usage: `./hyperloop_trains.py TRAIN_ID1 TRAIN_ID2`
+"""
+
+import os
+import ssl
+import json
+import time
+import threading
+import http.client
+import urllib.parse
+from email.utils import formatdate
+from concurrent.futures import ThreadPoolExecutor
+from grid_commands import traced
+
+default_url = "https://alimonitor.cern.ch/alihyperloop-data/trains/train.jsp?train_id="
+
+
+class TrainFetcher:
+    def __init__(self,
+                 key_file="/tmp/tokenkey_1000.pem",
+                 cert_file="/tmp/tokencert_1000.pem",
+                 ttl=600,
+                 verify=False,
+                 ca_file=None,
+                 timeout=60):
+        """
+        Fetcher of the train JSON.
+        `ttl` is the time in seconds after which a cached train is revalidated with the server.
+        If `verify` is False the server certificate is not checked (as `curl --insecure`).
+        """
+        self.context = ssl.create_default_context(cafile=ca_file)
+        if not verify:
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+        if cert_file is not None:
+            self.context.load_cert_chain(cert_file, key_file)
+        self.ttl = ttl
+        self.timeout = timeout
+        # One persistent connection per host and thread
+        self.local = threading.local()
+        self.memo = {}
+        self.lock = threading.Lock()
+
+    def connection(self, host, port):
+        if not hasattr(self.local, "connections"):
+            self.local.connections = {}
+        if (host, port) not in self.local.connections:
+            self.local.connections[(host, port)] = http.client.HTTPSConnection(host, port,
+                                                                               context=self.context,
+                                                                               timeout=self.timeout)
+        return self.local.connections[(host, port)]
+
+    def request(self, url, headers=None):
+        """
+        GET request on a pooled connection, returns the status, the headers and the body of the response.
+        Connections closed by the server are reopened once.
+        """
+        url = urllib.parse.urlsplit(url)
+        path = url.path
+        if url.query:
+            path += "?" + url.query
+        for attempt in range(2):
+            conn = self.connection(url.hostname, url.port or 443)
+            try:
+                conn.request("GET", path, headers=headers or {})
+                response = conn.getresponse()
+                return response.status, response, response.read()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                del self.local.connections[(url.hostname, url.port or 443)]
+                if attempt > 0:
+                    raise RuntimeError(f"Cannot fetch {url.geturl()}: {e}")
+
+    def fetch(self, train_id, base_url=default_url, out_path="/tmp/", force=False):
+        """
+        Returns the parsed JSON of the train, using the in memory and on disk caches when still valid
+        """
+        out_name = os.path.join(out_path, f"HyperloopID_{train_id}.json")
+        meta_name = out_name + ".meta"
+        now = time.time()
+        with self.lock:
+            if not force and out_name in self.memo and now - self.memo[out_name][0] < self.ttl:
+                return self.memo[out_name][1]
+        meta = {}
+        if os.path.isfile(out_name):
+            meta = {"fetched": os.path.getmtime(out_name)}
+            if os.path.isfile(meta_name):
+                with open(meta_name) as f:
+                    meta = json.load(f)
+        headers = {}
+        if meta and not force:
+            if now - meta["fetched"] < self.ttl:
+                return self.load(out_name, meta["fetched"])
+            if "etag" in meta:
+                headers["If-None-Match"] = meta["etag"]
+            headers["If-Modified-Since"] = meta.get("last_modified", formatdate(meta["fetched"], usegmt=True))
+        try:
+            with traced("https", train_id=train_id) as record:
+                status, response, body = self.request(f"{base_url}{train_id}", headers=headers)
+                record["bytes"] = len(body)
+        except RuntimeError as e:
+            if not meta:
+                raise
+            print("Cannot revalidate train", train_id, "using the cached version", out_name, e)
+            return self.load(out_name, now)
+        if status == 304:
+            meta["fetched"] = now
+        elif status == 200:
+            os.makedirs(out_path, exist_ok=True)
+            with open(out_name + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(out_name + ".tmp", out_name)
+            meta = {"fetched": now}
+            if response.getheader("ETag") is not None:
+                meta["etag"] = response.getheader("ETag")
+            if response.getheader("Last-Modified") is not None:
+                meta["last_modified"] = response.getheader("Last-Modified")
+            with self.lock:
+                self.memo.pop(out_name, None)
+        else:
+            if not meta:
+                raise RuntimeError(f"Cannot fetch train {train_id}, server replied {status}")
+            print("Cannot revalidate train", train_id, "server replied", status, "using the cached version", out_name)
+        with open(meta_name, "w") as f:
+            json.dump(meta, f)
+        return self.load(out_name, meta["fetched"])
+
+    def load(self, out_name, fetched):
+        with self.lock:
+            if out_name not in self.memo or self.memo[out_name][0] < os.path.getmtime(out_name):
+                with open(out_name) as f:
+                    self.memo[out_name] = [fetched, json.load(f)]
+            self.memo[out_name][0] = fetched
+            return self.memo[out_name][1]
+
+    def fetch_many(self, train_ids, base_url=default_url, out_path="/tmp/", jobs=4):
+        """
+        Fetches several trains concurrently, returns a dictionary {train_id: parsed JSON}
+        """
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            data = executor.map(lambda x: self.fetch(x, base_url=base_url, out_path=out_path), train_ids)
+            return dict(zip(train_ids, data))
+
+
+fetchers = {}
+
+
+def get_fetcher(key_file="/tmp/tokenkey_1000.pem",
+                cert_file="/tmp/tokencert_1000.pem",
+                **kwargs):
+    """
+    Returns the fetcher for the given credentials, created only once per process
+    """
+    if (key_file, cert_file) not in fetchers:
+        fetchers[(key_file, cert_file)] = TrainFetcher(key_file=key_file, cert_file=cert_file, **kwargs)
+    return fetchers[(key_file, cert_file)]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("hyperloop_train_ids",
+                        help="Train ID to consider",
+                        nargs="+",
+                        type=int)
+    parser.add_argument("--out_path", "-o",
+                        default="/tmp/",
+                        help="Output path where the train JSON are cached. Default: `/tmp/`")
+    parser.add_argument("--url", "-u",
+                        default=default_url,
+                        help=f"URL of the train information, the train ID is appended. Default: `{default_url}`")
+    parser.add_argument("--key_file", "-k",
+                        default="/tmp/tokenkey_1000.pem",
+                        help="Key file for authentication")
+    parser.add_argument("--cert_file", "-c",
+                        default="/tmp/tokencert_1000.pem",
+                        help="Certificate file for authentication")
+    parser.add_argument("--force", "-f",
+                        action="store_true",
+                        help="Fetch the trains even if the cached version is still valid")
+    args = parser.parse_args()
+    fetcher = get_fetcher(key_file=args.key_file, cert_file=args.cert_file)
+    if args.force:
+        for i in args.hyperloop_train_ids:
+            fetcher.fetch(i, base_url=args.url, out_path=args.out_path, force=True)
+    data = fetcher.fetch_many(args.hyperloop_train_ids, base_url=args.url, out_path=args.out_path)
+    for i in data:
+        print("Train", i, "has", len(data[i].get("jobResults", [])), "job results and",
+              len(data[i].get("mergeResults", [])), "merge results")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,23 +4,33 @@
 Script to merge run list from a HL train
 """
 
-from download_hyperloop_per_run import get_run_per_run_files
+from download_hyperloop_per_run import get_run_per_run_files, resolve_merge_stages
+from hyperloop_catalog import get_catalog, is_valid
 
 
-def merge_run_list(hyperloop_train_id, runs):
-    hl = get_run_per_run_files(train_id=hyperloop_train_id)
+def merge_run_list(hyperloop_train_id, runs, out_path="/tmp/"):
     list_to_merge = []
-    for i in hl:
-        if str(i.get_run()) in runs:
-            print("Adding", i)
-            list_to_merge.append(i)
-        if len(list_to_merge) == len(runs):
-            break
-        print(i)
+    entries = get_catalog(out_path).lookup(hyperloop_train_id, runs=runs)
+    if len(entries) == len(runs):
+        for i in entries:
+            if not is_valid(i):
+                raise ValueError(f"File {i['local_path']} for run {i['run']} is not valid, download it again")
+            print("Adding", i["local_path"])
+            list_to_merge.append(i["local_path"])
+    else:
+        hl = [i for i in get_run_per_run_files(train_id=hyperloop_train_id, out_path=out_path) if str(i.get_run()) in runs]
+        resolve_merge_stages(hl)
+        for i in hl:
+            if str(i.get_run()) in runs:
+                print("Adding", i)
+                list_to_merge.append(i.out_filename())
+            if len(list_to_merge) == len(runs):
+                break
+            print(i)
 
     merge_command = f"hadd /tmp/merged_hl{hyperloop_train_id}_{'_'.join(runs)}.root"
     for i in list_to_merge:
-        merge_command += f" {i.out_filename()}"
+        merge_command += f" {i}"
     print(merge_command)
 
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+"""
+Store of the metadata of the runs (period, interaction rate, fill and beam type) used in the trending.
+The metadata are kept in a CSV file (`run_metadata.csv` next to this script by default) and loaded only when first used
+into arrays sorted by run number, with an index from run number to row for the lookups.
+New runs and periods are added with a bulk import of CSV files with the same columns (missing columns are left empty):
+`./run_metadata.py --import new_runs.csv`
+Example usage: `./run_metadata.py` to print the periods, `./run_metadata.py 544013 544028` to print the metadata of some runs
+"""
+
+import os
+import csv
+import threading
+import numpy as np
+
+default_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_metadata.csv")
+columns = ["run", "period", "rate", "fill", "beam_type"]
+
+
+class RunMetadata:
+    def __init__(self, file_name=default_file):
+        """
+        Metadata of the runs stored in `file_name`, read at the first lookup
+        """
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.runs = None
+        self.rate = None
+        self.fill = None
+        # Indices in `period_names` and `beam_type_names`, -1 if not known
+        self.period = None
+        self.beam_type = None
+        self.period_names = []
+        self.beam_type_names = []
+        self.index = {}
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            rows = []
+            if os.path.isfile(self.file_name):
+                rows = read_rows(self.file_name)
+            self.build(rows)
+            self.loaded = True
+
+    def build(self, rows):
+        """
+        Builds the tables from the rows (dictionaries with the `columns` as keys), the last row of a run wins
+        """
+        by_run = {}
+        for i in rows:
+            by_run[int(i["run"])] = i
+        self.runs = np.array(sorted(by_run), dtype=np.int64)
+        self.rate = np.full(len(self.runs), np.nan)
+        self.fill = np.full(len(self.runs), -1, dtype=np.int64)
+        self.period = np.full(len(self.runs), -1, dtype=np.int32)
+        self.beam_type = np.full(len(self.runs), -1, dtype=np.int32)
+        self.period_names = []
+        self.beam_type_names = []
+        self.index = {}
+        for row, run in enumerate(self.runs.tolist()):
+            i = by_run[run]
+            self.index[run] = row
+            if i.get("rate") not in [None, ""]:
+                self.rate[row] = float(i["rate"])
+            if i.get("fill") not in [None, ""]:
+                self.fill[row] = int(i["fill"])
+            if i.get("period"):
+                if i["period"] not in self.period_names:
+                    self.period_names.append(i["period"])
+                self.period[row] = self.period_names.index(i["period"])
+            if i.get("beam_type"):
+                if i["beam_type"] not in self.beam_type_names:
+                    self.beam_type_names.append(i["beam_type"])
+                self.beam_type[row] = self.beam_type_names.index(i["beam_type"])
+
+    def row(self, run):
+        if not self.loaded:
+            self.load()
+        return self.index.get(int(run))
+
+    def __contains__(self, run):
+        return self.row(run) is not None
+
+    def __len__(self):
+        if not self.loaded:
+            self.load()
+        return len(self.runs)
+
+    def get_rate(self, run, default=None):
+        """
+        Interaction rate of the run, `default` if not known
+        """
+        row = self.row(run)
+        if row is None or np.isnan(self.rate[row]):
+            return default
+        return float(self.rate[row])
+
+    def get_period(self, run, default=None):
+        row = self.row(run)
+        if row is None or self.period[row] < 0:
+            return default
+        return self.period_names[self.period[row]]
+
+    def get_fill(self, run, default=None):
+        row = self.row(run)
+        if row is None or self.fill[row] < 0:
+            return default
+        return int(self.fill[row])
+
+    def get_beam_type(self, run, default=None):
+        row = self.row(run)
+        if row is None or self.beam_type[row] < 0:
+            return default
+        return self.beam_type_names[self.beam_type[row]]
+
+    def lookup(self, run):
+        """
+        All the metadata of a run as a dictionary, None if the run is not known
+        """
+        if run not in self:
+            return None
+        return {"run": int(run),
+                "period": self.get_period(run),
+                "rate": self.get_rate(run),
+                "fill": self.get_fill(run),
+                "beam_type": self.get_beam_type(run)}
+
+    def rates(self):
+        """
+        Dictionary run -> interaction rate of the runs with a known rate
+        """
+        if not self.loaded:
+            self.load()
+        known = ~np.isnan(self.rate)
+        return dict(zip(self.runs[known].tolist(), self.rate[known].tolist()))
+
+    def periods(self):
+        """
+        Dictionary period -> list of runs
+        """
+        if not self.loaded:
+            self.load()
+        return {k: self.runs[self.period == i].tolist() for i, k in enumerate(self.period_names)}
+
+    def rows(self):
+        if not self.loaded:
+            self.load()
+        return [self.lookup(i) for i in self.runs.tolist()]
+
+    def add(self, rows, write=True):
+        """
+        Adds (or updates) the metadata of many runs at once, empty fields of the new rows keep the known values
+        """
+        merged = {i["run"]: i for i in self.rows()}
+        for i in rows:
+            run = int(i["run"])
+            old = merged.get(run, {"run": run})
+            merged[run] = {k: (i[k] if i.get(k) not in [None, ""] else old.get(k)) for k in columns}
+            merged[run]["run"] = run
+        with self.lock:
+            self.build(list(merged.values()))
+        if write:
+            self.write()
+        return len(rows)
+
+    def import_csv(self, file_name, write=True):
+        return self.add(read_rows(file_name), write=write)
+
+    def write(self, file_name=None):
+        if file_name is None:
+            file_name = self.file_name
+        tmp_file_name = file_name + ".tmp"
+        with open(tmp_file_name, "w", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=columns, lineterminator="\n")
+            w.writeheader()
+            for i in self.rows():
+                w.writerow({k: ("" if i[k] is None else i[k]) for k in columns})
+        os.replace(tmp_file_name, file_name)
+
+
+def read_rows(file_name):
+    with open(file_name, newline="") as f:
+        rows = [i for i in csv.DictReader(f) if i.get("run", "").strip() != ""]
+    for i in rows:
+        for k in columns:
+            i[k] = (i.get(k) or "").strip()
+    return rows
+
+
+stores = {}
+
+
+def get_run_metadata(file_name=default_file):
+    """
+    Returns the store of the metadata file, created only once per process
+    """
+    file_name = os.path.abspath(file_name)
+    if file_name not in stores:
+        stores[file_name] = RunMetadata(file_name)
+    return stores[file_name]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("runs",
+                        type=int,
+                        nargs="*",
+                        help="Runs to print the metadata of")
+    parser.add_argument("--file", "-f",
+                        default=default_file,
+                        help=f"CSV file of the metadata. Default: `{default_file}`")
+    parser.add_argument("--import", "-i",
+                        dest="import_files",
+                        nargs="+",
+                        default=[],
+                        help="CSV files to import (columns: " + ", ".join(columns) + ")")
+    args = parser.parse_args()
+    store = get_run_metadata(args.file)
+    for i in args.import_files:
+        print("Imported", store.import_csv(i), "runs from", i)
+    for i in args.runs:
+        print(i, store.lookup(i))
+    if len(args.runs) == 0:
+        print(len(store), "runs in", store.file_name)
+        for k, v in store.periods().items():
+            print(f"  {k}: {len(v)} runs", v)
+
+
+if __name__ == "__main__":
+    main()
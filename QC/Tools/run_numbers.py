@@ -1,272 +1,11 @@
 #!/usr/bin/env python3
 
-rates = {}
+"""
+Interaction rates and periods of the runs, kept for the scripts using `from run_numbers import *`.
+The values are now in the run metadata store, see `run_metadata.py`, add new runs there with `./run_metadata.py --import`.
+"""
 
-rates[544013] = 6278.43
-rates[544028] = 30336.7
-rates[544032] = 23718.5
-rates[544033] = 4957.46
-rates[544091] = 29326.7
-rates[544095] = 25101.8
-rates[544098] = 18005.6
-rates[544116] = 38342
-rates[544121] = 22543.5
-rates[544122] = 16559.5
-rates[544123] = 11629.7
-rates[544124] = 6610.2
-rates[544126] = 51.437
-rates[544167] = 45633.8
-rates[544180] = 45755.2
-rates[544184] = 32927.3
-rates[544185] = 28727.2
-rates[544384] = 41927
-rates[544389] = 26876.1
-rates[544390] = 17959.1
-rates[544391] = 14724.2
-rates[544392] = 12663.5
-rates[544418] = 10200.2
-rates[544420] = 5373.17
-rates[544434] = 4385.37
-rates[544451] = 27927.2
-rates[544454] = 19440.6
-rates[544474] = 29367.4
-rates[544475] = 19438.5
-rates[544476] = 16104.7
-rates[544477] = 13211.6
-rates[544490] = 43111.7
-rates[544491] = 24276.6
-rates[544492] = 15135.7
-rates[544508] = 39628
-rates[544510] = 29528.7
-rates[544511] = 21593.6
-rates[544512] = 18389.5
-rates[544513] = 16239.1
-rates[544514] = 15066
-rates[544515] = 13300.4
-rates[544516] = 12546.1
-rates[544518] = 10720.7
+from run_metadata import get_run_metadata
 
-
-rates[526383] = 135090.9
-rates[526391] = 128295.2
-rates[526432] = 139097.7
-rates[526463] = 556037.6
-rates[526465] = 647940.6
-rates[526466] = 581245.0
-rates[526467] = 644801.4
-rates[526468] = 542124.5
-rates[526486] = 667735.5
-rates[526505] = 642675.3
-rates[526508] = 1328545.1
-rates[526510] = 1327872.2
-rates[526512] = 670382.0
-rates[526525] = 646199.1
-rates[526526] = 657189.1
-rates[526528] = 668096.3
-rates[526529] = 12431.3
-rates[526530] = 131371.3
-rates[526532] = 611121.9
-rates[526533] = 1219968.1
-rates[526534] = 1277070.6
-rates[526559] = 653969.2
-rates[526596] = 652235.3
-rates[526606] = 646675.5
-rates[526612] = 657436.7
-rates[526638] = 496995.7
-rates[526639] = 659438.7
-rates[526641] = 658453.4
-rates[526643] = 649255.1
-rates[526647] = 658434.1
-rates[526649] = 647133.3
-rates[526689] = 1114.4
-rates[526712] = 1366178.4
-rates[526713] = 648237.8
-rates[526714] = 578066.3
-rates[526715] = 587026.9
-rates[526716] = 603033.2
-rates[526719] = 647133.5
-rates[526720] = 543259.6
-rates[526776] = 654908.9
-rates[526802] = 239605.0
-rates[526806] = 375262.1
-rates[526860] = 674676.5
-rates[526865] = 673364.4
-rates[526886] = 674569.6
-rates[526926] = 899782.7
-rates[526927] = 1057552.5
-rates[526928] = 1364644.2
-rates[526929] = 1359681.7
-rates[526934] = 1396775.3
-rates[526935] = 1385422.7
-rates[526937] = 1388258.5
-rates[526938] = 668449.1
-rates[526963] = 456317.2
-rates[526964] = 665717.9
-rates[526966] = 605921.2
-rates[526967] = 681115.2
-rates[526968] = 682428.0
-rates[527015] = 625618.2
-rates[527016] = 664684.1
-rates[527028] = 670443.9
-rates[527031] = 594697.2
-rates[527033] = 612874.9
-rates[527034] = 655610.7
-rates[527038] = 663204.3
-rates[527039] = 666230.6
-rates[527041] = 663919.0
-rates[527057] = 675826.8
-rates[527076] = 601509.3
-rates[527108] = 454774.4
-rates[527109] = 650649.6
-rates[527228] = 680510.2
-rates[527237] = 674723.6
-rates[527239] = 639824.9
-rates[527240] = 653360.9
-rates[527259] = 522318.6
-rates[527260] = 663800.5
-rates[527261] = 601709.3
-rates[527262] = 564506.0
-rates[527345] = 498781.1
-rates[527347] = 614221.4
-rates[527349] = 595715.0
-rates[527446] = 681393.8
-rates[527518] = 661727.4
-rates[527522] = 669760.7
-rates[527523] = 675064.0
-rates[527671] = 115824.9
-rates[527690] = 676534.2
-rates[527694] = 675308.7
-rates[527731] = 665024.0
-rates[527734] = 675835.2
-rates[527736] = 635082.3
-rates[527777] = 94024.7
-rates[527799] = 132364.6
-rates[527821] = 665321.4
-rates[527825] = 670214.5
-rates[527826] = 679538.0
-rates[527828] = 678644.7
-rates[527848] = 640696.9
-rates[527850] = 668208.3
-rates[527852] = 674412.6
-rates[527863] = 675776.0
-rates[527864] = 662754.5
-rates[527865] = 656851.8
-rates[527869] = 675482.7
-rates[527871] = 673836.6
-rates[527895] = 662598.2
-rates[527897] = 668821.7
-rates[527898] = 664229.1
-rates[527899] = 674544.5
-rates[527902] = 676369.6
-rates[527940] = 636907.3
-rates[527944] = 584544.5
-rates[527963] = 572921.5
-rates[527965] = 556385.4
-rates[527966] = 510313.6
-rates[527967] = 637933.8
-rates[527976] = 669681.8
-rates[527978] = 656954.9
-rates[527979] = 670370.6
-rates[528021] = 587660.7
-rates[528026] = 656935.6
-rates[528036] = 663216.8
-rates[528093] = 591100.8
-rates[528094] = 639684.4
-rates[528097] = 565779.4
-rates[528105] = 653021.8
-rates[528107] = 679994.7
-rates[528109] = 663885.5
-rates[528110] = 643939.8
-rates[528231] = 517097.0
-rates[528232] = 679369.7
-rates[528233] = 674822.7
-rates[528263] = 646638.0
-rates[528266] = 656578.7
-rates[528290] = 3143946.1
-rates[528292] = 673176.3
-rates[528294] = 664300.0
-rates[528316] = 661380.7
-rates[528319] = 669082.9
-rates[528328] = 672638.6
-rates[528329] = 661027.0
-rates[528330] = 559106.6
-rates[528332] = 675136.8
-rates[528336] = 658887.1
-rates[528347] = 662234.9
-rates[528359] = 644596.8
-rates[528379] = 674769.7
-rates[528381] = 671461.9
-rates[528386] = 677961.4
-rates[528448] = 672099.7
-rates[528451] = 616403.9
-rates[528461] = 659566.6
-rates[528463] = 533781.4
-rates[528471] = 3980.0
-rates[528487] = 788305.9
-rates[528507] = 1506685.0
-rates[528509] = 1541712.6
-rates[528513] = 2405312.6
-rates[528514] = 2414330.4
-rates[528523] = 3237596.4
-rates[528524] = 3972.2
-rates[528528] = 3945.1
-rates[528529] = 425734.2
-rates[528530] = 628617.6
-rates[528531] = 679729.0
-rates[528534] = 672412.0
-rates[528537] = 671915.5
-rates[528543] = 655323.3
-
-
-if 0:
-    rates[544013] = 7978.71
-    rates[544028] = 30498.8
-    rates[544032] = 26943.9
-    rates[544033] = 18413.2
-    rates[544091] = 31151.7
-    rates[544095] = 26522.3
-    rates[544098] = 22626.2
-    rates[544116] = 38999.9
-    rates[544121] = 27147.2
-    rates[544122] = 18279.4
-    rates[544123] = 14585
-    rates[544124] = 8566.13
-    rates[544126] = 50.3408
-    rates[544167] = 45878.9
-    rates[544180] = 45990.2
-    rates[544184] = 35432.5
-    rates[544185] = 29917.9
-    rates[544384] = 43731.4
-    rates[544389] = 35029.7
-    rates[544390] = 19252.5
-    rates[544391] = 16126.3
-    rates[544392] = 13118.5
-    rates[544418] = 10316
-    rates[544420] = 9951.05
-    rates[544434] = 11335.9
-    rates[544451] = 29995.9
-    rates[544454] = 23697.6
-    rates[544474] = 41617
-    rates[544475] = 20094.3
-    rates[544476] = 18370.9
-    rates[544477] = 13493.6
-    rates[544490] = 47195.4
-    rates[544491] = 37349.5
-    rates[544492] = 15438.7
-    rates[544508] = 38571.5
-    rates[544510] = 33180
-    rates[544511] = 23339.7
-    rates[544512] = 19065.6
-    rates[544513] = 16425.5
-    rates[544514] = 15711.8
-    rates[544515] = 13622.3
-    rates[544516] = 12727
-    rates[544518] = 11788.2
-
-
-periods = {}
-periods["LHC23zzf"] = [544013]
-periods["LHC23zzg"] = [544028, 544032]
-periods["LHC23zzh"] = [544091, 544095, 544098]
-periods["LHC23zzi"] = [544167, 544180, 544184, 544185, 544389, 544390, 544391, 544392]
-periods["LHC23zzk"] = [544451, 544454, 544474, 544475, 544476, 544477, 544490, 544491, 544492, 544508, 544510]
+rates = get_run_metadata().rates()
+periods = get_run_metadata().periods()
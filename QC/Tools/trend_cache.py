@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+"""
+On-disk cache of the trended quantities computed by `trend_hyperloop.py`.
+Each value (with its error) is stored in a SQLite database in the output path, keyed by the checksum of the input file,
+the path of the object, the quantity computed (`what_to_do`) and a hash of the configuration keys affecting the result.
+Cosmetic changes of the configuration (thresholds, ranges to draw, labels) do not invalidate the cache.
+The records of the batch fits (all the parameters with their errors, chi2, ndf and status) are kept as well.
+Example usage: `./trend_cache.py` to print the content of the cache, `./trend_cache.py --clear` to empty it
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+cache_file_name = "trend_cache.sqlite"
+# Configuration keys that change the value computed, the `par_range*` keys are added to these
+config_keys = ["function", "fit_range", "initial_parameters", "parameterindex", "projection", "projection_range"]
+
+
+def config_hash(what_to_do, option=None):
+    """
+    Hash of the part of the configuration of a section that determines the value computed
+    """
+    relevant = {"what_to_do": what_to_do}
+    if what_to_do == "functionfit" and option is not None:
+        for i in option:
+            if i in config_keys or i.startswith("par_range"):
+                relevant[i] = option[i].strip()
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+class TrendCache:
+    def __init__(self, out_path="/tmp/"):
+        self.out_path = os.path.abspath(out_path)
+        os.makedirs(self.out_path, exist_ok=True)
+        self.db_path = os.path.join(self.out_path, cache_file_name)
+        self.lock = threading.Lock()
+        # The cache can be written from several worker processes
+        self.db = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS results (
+                               checksum TEXT NOT NULL,
+                               object TEXT NOT NULL,
+                               what_to_do TEXT NOT NULL,
+                               config_hash TEXT NOT NULL,
+                               value REAL,
+                               error REAL,
+                               ytitle TEXT,
+                               extra TEXT,
+                               time REAL,
+                               PRIMARY KEY (checksum, object, what_to_do, config_hash))""")
+            # Records of the batch fits (parameters, errors, chi2, ndf and status) as JSON
+            self.db.execute("""CREATE TABLE IF NOT EXISTS fits (
+                               checksum TEXT NOT NULL,
+                               object TEXT NOT NULL,
+                               config_hash TEXT NOT NULL,
+                               record TEXT,
+                               time REAL,
+                               PRIMARY KEY (checksum, object, config_hash))""")
+            # Checksums of the local files, recomputed only if the file changed
+            self.db.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                               local_path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               checksum TEXT)""")
+
+    def checksum(self, local_path, known_checksum=None):
+        """
+        Checksum of a local file. `known_checksum` (e.g. from the download catalog) is used if given,
+        otherwise the MD5 of the file is computed once per file version
+        """
+        if known_checksum is not None:
+            return known_checksum
+        size = os.path.getsize(local_path)
+        mtime = os.path.getmtime(local_path)
+        with self.lock:
+            r = self.db.execute("SELECT * FROM checksums WHERE local_path = ?", (local_path,)).fetchone()
+        if r is not None and r["size"] == size and r["mtime"] == mtime:
+            return r["checksum"]
+        from download_hyperloop_per_run import file_checksum
+        checksum = file_checksum(local_path)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)", (local_path, size, mtime, checksum))
+        return checksum
+
+    def get(self, checksum, name, what_to_do, option=None):
+        """
+        Returns the cached result as (value, error, ytitle, extra) or None if not cached
+        """
+        with self.lock:
+            r = self.db.execute("SELECT * FROM results WHERE checksum = ? AND object = ? AND what_to_do = ? AND config_hash = ?",
+                                (checksum, name, what_to_do, config_hash(what_to_do, option))).fetchone()
+        if r is None:
+            return None
+        return r["value"], r["error"], r["ytitle"], r["extra"]
+
+    def put(self, checksum, name, what_to_do, option, result):
+        y, ye, ytitle, extra = result
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (checksum, name, what_to_do, config_hash(what_to_do, option), y, ye, ytitle, extra, time.time()))
+
+    def get_fit(self, checksum, name, option):
+        """
+        Returns the cached record of the fit of the object, None if not cached
+        """
+        with self.lock:
+            r = self.db.execute("SELECT record FROM fits WHERE checksum = ? AND object = ? AND config_hash = ?",
+                                (checksum, name, config_hash("functionfit", option))).fetchone()
+        if r is None:
+            return None
+        return json.loads(r["record"])
+
+    def put_fit(self, checksum, name, option, record):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?)",
+                            (checksum, name, config_hash("functionfit", option), json.dumps(record), time.time()))
+
+    def entries(self):
+        with self.lock:
+            return [dict(i) for i in self.db.execute("SELECT * FROM results ORDER BY object, time")]
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM results")
+            self.db.execute("DELETE FROM fits")
+            self.db.execute("DELETE FROM checksums")
+
+    def close(self):
+        self.db.close()
+
+
+caches = {}
+
+
+def get_trend_cache(out_path="/tmp/"):
+    """
+    Returns the cache of the output path, opening it only once per process
+    """
+    out_path = os.path.abspath(out_path)
+    if out_path not in caches:
+        caches[out_path] = TrendCache(out_path)
+    return caches[out_path]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--out_path", "-o",
+                        default="/tmp/",
+                        help="Output path where the cache is located. Default: `/tmp/`")
+    parser.add_argument("--clear",
+                        action="store_true",
+                        help="Remove all the cached results")
+    args = parser.parse_args()
+    cache = get_trend_cache(args.out_path)
+    if args.clear:
+        cache.clear()
+        print("Cleared", cache.db_path)
+        return
+    entries = cache.entries()
+    print(len(entries), "cached results in", cache.db_path)
+    for i in entries:
+        print(f"  {i['object']} {i['what_to_do']} {i['checksum']} = {i['value']} +- {i['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""
+Fitting engine for the `functionfit` trended quantities.
+The model of a configuration section (function, fit range, initial parameters and parameter ranges) is compiled
+into a TF1 only once and reused for all the runs, each fit starts from the parameters of the closest run
+(in run number) already converged, and the status and number of calls of each fit are recorded.
+The `gaus(0)+polN(3)` models can also be fitted for many histograms at once with a vectorized
+least squares (Levenberg-Marquardt) in NumPy, see `batch_fit`.
+"""
+
+import re
+import time
+import numpy as np
+from grid_commands import record_trace
+
+
+def model_key(option):
+    """
+    Identifier of the model of a configuration section
+    """
+    keys = ["function", "fit_range", "initial_parameters"]
+    keys += sorted(i for i in option if i.startswith("par_range"))
+    return "|".join(f"{i}={option[i]}" for i in keys)
+
+
+class FitModel:
+    def __init__(self, option, name="trend_fit"):
+        """
+        Model compiled once from the configuration of a section (see `trend_plan.SectionPlan`)
+        """
+        from ROOT import TF1
+        from trend_plan import section_plan
+        plan = section_plan(option)
+        self.function = plan.function
+        self.fit_range = plan.fit_range
+        self.initial_parameters = plan.initial_parameters
+        self.par_ranges = plan.par_ranges
+        self.fun = TF1(name, self.function, *self.fit_range)
+        for i in self.par_ranges:
+            self.fun.SetParLimits(i, *self.par_ranges[i])
+
+    def set_parameters(self, parameters):
+        """
+        Sets all the parameters of the function, those not given (e.g. fewer initial parameters than in the function) are set to 0
+        """
+        for i in range(self.fun.GetNpar()):
+            self.fun.SetParameter(i, parameters[i] if i < len(parameters) else 0.)
+
+    def parameters(self):
+        return [self.fun.GetParameter(i) for i in range(self.fun.GetNpar())]
+
+
+class FitEngine:
+    def __init__(self, warm_start=True):
+        """
+        Fits with the compiled models, if `warm_start` each fit is seeded with the parameters of the closest converged run
+        """
+        self.warm_start = warm_start
+        self.models = {}
+        # Converged parameters per model and run
+        self.converged = {}
+        self.records = []
+
+    def model(self, option):
+        key = model_key(option)
+        if key not in self.models:
+            self.models[key] = FitModel(option, name=f"trend_fit_{len(self.models)}")
+            self.converged[key] = {}
+        return key, self.models[key]
+
+    def seed(self, key, run):
+        if not self.warm_start or run is None or len(self.converged[key]) == 0:
+            return None
+        closest = min(self.converged[key], key=lambda x: abs(x - int(run)))
+        return self.converged[key][closest]
+
+    def fit(self, h, option, run=None):
+        """
+        Fits the histogram with the model of the section, returns the fitted TF1 (shared among the runs) and the fit record
+        """
+        key, model = self.model(option)
+        seed = self.seed(key, run)
+        start = time.time()
+        record = self.fit_from(model, h, seed if seed is not None else model.initial_parameters)
+        record["warm_start"] = seed is not None
+        if seed is not None and record["status"] != 0:
+            # Not converging from the neighbouring run, trying again from the configured parameters
+            record = self.fit_from(model, h, model.initial_parameters)
+            record["warm_start"] = False
+        record["run"] = run
+        record["function"] = model.function
+        record["duration"] = time.time() - start
+        if record["status"] == 0 and run is not None:
+            self.converged[key][int(run)] = model.parameters()
+        self.records.append(record)
+        record_trace("fit", start, record["duration"], exit_code=record["status"], run=run)
+        return model.fun, record
+
+    def fit_from(self, model, h, parameters):
+        model.set_parameters(parameters)
+        r = h.Fit(model.fun, "QNRS")
+        record = {"status": int(r), "calls": 0, "chi2": None, "ndf": None}
+        if r.Get():
+            record["calls"] = r.NCalls()
+            record["chi2"] = r.Chi2()
+            record["ndf"] = r.Ndf()
+        return record
+
+    def summary(self):
+        if len(self.records) == 0:
+            return
+        failed = [i["run"] for i in self.records if i["status"] != 0]
+        warm = len([i for i in self.records if i["warm_start"]])
+        cached = len([i for i in self.records if i.get("cached", False)])
+        calls = sum(i.get("calls", i.get("iterations", 0)) for i in self.records) / len(self.records)
+        print(f"{len(self.records)} fits, {cached} from the trend cache, {warm} warm started, {calls:.1f} calls on average,",
+              f"{len(failed)} not converged", failed)
+
+
+fit_engine = None
+
+
+def get_fit_engine():
+    global fit_engine
+    if fit_engine is None:
+        fit_engine = FitEngine()
+    return fit_engine
+
+
+def parse_function(function):
+    """
+    Degree of the polynomial of a `gaus(0)+polN(3)` function, -1 for `gaus` alone, None if not supported by `batch_fit`
+    """
+    m = re.fullmatch(r"gaus(\(0\))?(\+pol(\d)\(3\))?", function.replace(" ", ""))
+    if m is None:
+        return None
+    if m.group(3) is None:
+        return -1
+    return int(m.group(3))
+
+
+def gaus_pol(x, p, npol):
+    """
+    gaus(0)+polN(3) for the parameters p (one row per histogram)
+    """
+    f = p[:, 0:1] * np.exp(-0.5 * ((x - p[:, 1:2]) / p[:, 2:3])**2)
+    for k in range(npol + 1):
+        f = f + p[:, 3 + k:4 + k] * x**k
+    return f
+
+
+def gaus_pol_jacobian(x, p, npol):
+    z = (x - p[:, 1:2]) / p[:, 2:3]
+    e = np.exp(-0.5 * z * z)
+    columns = [e, p[:, 0:1] * e * z / p[:, 2:3], p[:, 0:1] * e * z * z / p[:, 2:3]]
+    for k in range(npol + 1):
+        columns.append(np.broadcast_to(x**k, e.shape))
+    return np.stack(columns, axis=-1)
+
+
+def least_squares(x, y, w, p, npol, lower, upper, max_iterations=200, tolerance=1e-7):
+    """
+    Levenberg-Marquardt minimization of the weighted chi2 for all the rows at once.
+    Returns the parameters, their errors, the chi2, the iterations and whether each fit converged.
+    """
+    n = len(p)
+    with np.errstate(all="ignore"):
+        chi2 = ((y - gaus_pol(x, p, npol))**2 * w).sum(axis=1)
+    damping = np.full(n, 1e-3)
+    active = np.isfinite(chi2)
+    converged = np.zeros(n, dtype=bool)
+    iterations = np.zeros(n, dtype=int)
+    for _ in range(max_iterations):
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+        with np.errstate(all="ignore"):
+            jac = gaus_pol_jacobian(x, p[rows], npol)
+            a = np.einsum("rbi,rb,rbj->rij", jac, w[rows], jac)
+            g = np.einsum("rbi,rb,rb->ri", jac, w[rows], y[rows] - gaus_pol(x, p[rows], npol))
+        finite = np.isfinite(a).all(axis=(1, 2)) & np.isfinite(g).all(axis=1)
+        # Fits that cannot be continued are stopped as not converged
+        active[rows[~finite]] = False
+        rows, a, g = rows[finite], a[finite], g[finite]
+        if len(rows) == 0:
+            break
+        diagonal = np.einsum("rii->ri", a)
+        damped = a + damping[rows, None, None] * (diagonal[:, :, None] * np.eye(a.shape[1]))
+        step = np.einsum("rij,rj->ri", np.linalg.pinv(damped), g)
+        # Steps going beyond the parameter ranges only go half way to the limit, so that the fit can still move back
+        trial = p[rows] + step
+        trial = np.where(trial < lower, 0.5 * (p[rows] + lower), trial)
+        trial = np.where(trial > upper, 0.5 * (p[rows] + upper), trial)
+        with np.errstate(all="ignore"):
+            trial_chi2 = ((y[rows] - gaus_pol(x, trial, npol))**2 * w[rows]).sum(axis=1)
+        better = np.isfinite(trial_chi2) & (trial_chi2 <= chi2[rows])
+        done = better & (chi2[rows] - trial_chi2 <= tolerance * np.maximum(chi2[rows], 1.))
+        p[rows[better]] = trial[better]
+        chi2[rows[better]] = trial_chi2[better]
+        damping[rows[better]] /= 10
+        damping[rows[~better]] *= 10
+        iterations[rows] += 1
+        # No improvement possible anymore: at the minimum
+        done |= damping[rows] > 1e10
+        converged[rows[done]] = True
+        active[rows[done]] = False
+    with np.errstate(all="ignore"):
+        jac = gaus_pol_jacobian(x, p, npol)
+        a = np.einsum("rbi,rb,rbj->rij", jac, w, jac)
+    errors = np.full(p.shape, np.nan)
+    finite = np.isfinite(a).all(axis=(1, 2))
+    if finite.any():
+        errors[finite] = np.sqrt(np.abs(np.einsum("rii->ri", np.linalg.pinv(a[finite]))))
+    converged &= finite
+    return p, errors, chi2, iterations, converged
+
+
+def batch_fit(histos, option, runs=None):
+    """
+    Fits the `hist_arrays.ArrayHisto` with the gaus(0)+polN(3) model of the section, all at once.
+    As for the ROOT fit with option "R" only the bins with centers in the fit range and non-zero error are used.
+    Fits not converging are repeated starting from the closest converged one.
+    Returns one record per histogram with the parameters, their errors, the chi2, ndf, iterations and status.
+    """
+    from trend_plan import section_plan
+    plan = section_plan(option)
+    npol = plan.batch_npol
+    if npol is None:
+        raise ValueError(f"Function {plan.function} not supported by the batch fit")
+    fit_range = plan.fit_range
+    npar = 3 + npol + 1
+    initial = (plan.initial_parameters + [0.] * npar)[:npar]
+    lower = np.full(npar, -np.inf)
+    upper = np.full(npar, np.inf)
+    for i in plan.par_ranges:
+        lower[i], upper[i] = plan.par_ranges[i]
+    # The width of the gaussian must stay positive
+    lower[2] = max(lower[2], 1e-9 * (fit_range[1] - fit_range[0]))
+    if runs is None:
+        runs = list(range(len(histos)))
+    records = [None] * len(histos)
+    # Histograms with the same binning are fitted together
+    groups = {}
+    for i, h in enumerate(histos):
+        groups.setdefault(tuple(h.edges), []).append(i)
+    for edges in groups:
+        indices = groups[edges]
+        x = histos[indices[0]].centers()
+        y = np.stack([histos[i].contents[1:-1] for i in indices])
+        e = np.stack([histos[i].errors[1:-1] for i in indices])
+        in_range = (x >= fit_range[0]) & (x <= fit_range[1])
+        w = np.where((e > 0) & in_range, 1. / np.where(e > 0, e, 1.)**2, 0.)
+        start = time.time()
+        p, errors, chi2, iterations, converged = least_squares(x, y, w, np.tile(initial, (len(indices), 1)), npol, lower, upper)
+        warm = np.zeros(len(indices), dtype=bool)
+        retry = np.flatnonzero(~converged)
+        if len(retry) > 0 and converged.any():
+            good = np.flatnonzero(converged)
+            seeds = np.array([p[good[np.argmin(np.abs(np.array([runs[indices[k]] for k in good]) - runs[indices[r]]))]] for r in retry])
+            p_retry, e_retry, c_retry, i_retry, ok_retry = least_squares(x, y[retry], w[retry], seeds, npol, lower, upper)
+            improved = ok_retry
+            for k, r in enumerate(retry):
+                if improved[k]:
+                    p[r], errors[r], chi2[r], converged[r], warm[r] = p_retry[k], e_retry[k], c_retry[k], True, True
+                iterations[r] += i_retry[k]
+        duration = (time.time() - start) / len(indices)
+        ndf = (w > 0).sum(axis=1) - npar
+        for k, i in enumerate(indices):
+            records[i] = {"parameters": p[k].tolist(),
+                          "errors": errors[k].tolist(),
+                          "chi2": float(chi2[k]),
+                          "ndf": int(ndf[k]),
+                          "iterations": int(iterations[k]),
+                          "status": 0 if converged[k] and ndf[k] > 0 else 1,
+                          "warm_start": bool(warm[k]),
+                          "run": runs[i],
+                          "function": plan.function,
+                          "duration": duration}
+            record_trace("fit[batch]", start, duration, exit_code=records[i]["status"], run=runs[i])
+    return records
@@ -6,41 +6,357 @@ Script to trend variables run per run
 """
 
 import download_hyperloop_per_run
-from download_hyperloop_per_run import draw_label
-from ROOT import TH1F, TGraph, TColor, TH1, TLegend, TGraphErrors
-from utils import draw_nice_canvas
+import grid_commands
+from download_hyperloop_per_run import draw_label, fill_trend_bin
+from utils import draw_nice_canvas, get_object_cache
+import os
+import json
 import argparse
-import configparser
-from run_numbers import *
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_metadata import get_run_metadata
+from trend_store import get_trend_store
+from hyperloop_trains import get_fetcher
+from hyperloop_catalog import is_valid
+from trend_cache import get_trend_cache, config_hash
+from hist_arrays import batch_mean, batch_value_at
+from trend_fit import get_fit_engine, batch_fit
+from trend_plan import compile_plan
+from trend_outliers import flag_outliers, OutlierDetector
+from collections import namedtuple
+import numpy as np
 
 trend_calls = -1
 trend_objects = []
 
 
+def input_checksum(j, cache):
+    """
+    Checksum of the file the quantities of a run are computed from (full output or objects cache)
+    """
+    if os.path.isfile(j.out_filename()):
+        entry = j.catalog_entry()
+        known_checksum = None
+        if is_valid(entry):
+            known_checksum = entry["checksum"]
+        return cache.checksum(j.out_filename(), known_checksum)
+    return cache.checksum(j.objects_filename())
+
+
+def with_current_title(result, object_config):
+    """
+    Result with the title of the current configuration of the section: the trending title of the fits
+    does not change the value, results computed with another title are reused
+    """
+    if result is None or object_config.what_to_do != "functionfit":
+        return result
+    return (result[0], result[1], object_config.title, result[3])
+
+
+def extract_run(j, sections, draw_every_run=False, skip_non_sane_runs=True, use_cache=True):
+    """
+    Computes the trended quantities of all the sections for one run.
+    Returns a dictionary {section: result of `compute_quantity`} or None if the run is skipped.
+    If `use_cache` the results already computed for the same file and configuration are taken from the trend cache.
+    """
+    if skip_non_sane_runs and not (j.exists() or j.has_objects_cache()):
+        print("Skipping", j, "something wrong with the file")
+        return None
+    cache = None
+    checksum = None
+    if use_cache and not draw_every_run:
+        cache = get_trend_cache(j.out_path)
+        checksum = input_checksum(j, cache)
+    batched = download_hyperloop_per_run.HISTOGRAM_BACKEND == "numpy" and not draw_every_run
+    results = {}
+    for i in sections:
+        object_config = sections[i]
+        if cache is not None and batched and object_config.is_batch_fit():
+            # Fitted already in a previous trending, the fit is not repeated
+            record = cache.get_fit(checksum, i, object_config)
+            if record is not None:
+                record["cached"] = True
+                get_fit_engine().records.append(record)
+                p = object_config.parameter_index
+                results[i] = (record["parameters"][p], record["errors"][p], object_config.title, record["extra"])
+                continue
+        if cache is not None:
+            results[i] = with_current_title(cache.get(checksum, i, object_config.what_to_do, object_config), object_config)
+            if results[i] is not None:
+                continue
+        if not j.has_in_file(i):
+            for alt_name in object_config.alternative_names:
+                if j.has_in_file(alt_name):
+                    j.get_as(alt_name, i)
+                    break
+        if batched and object_config.what_to_do in batched_quantities:
+            # Only the arrays are kept, the quantity is computed for all runs at once by `compute_batched`
+            histo = j.get_arrays(i)
+            if histo is not None:
+                results[i] = PendingQuantity(histo, checksum)
+                continue
+        if batched and object_config.is_batch_fit():
+            # The histogram to fit is kept, all runs are fitted at once by `compute_batched`
+            histo, extra = j.get_projected_arrays(i, object_config)
+            if histo is not None:
+                results[i] = PendingFit(histo, extra, checksum)
+                continue
+        if draw_every_run:
+            j.get(i)
+            j.draw(i, x_range=object_config.x_range, y_range=object_config.y_range, opt=object_config.draw_opt)
+            input(f"Plotting run {j.get_run()} press enter to continue")
+        results[i] = j.compute_quantity(i, object_config.what_to_do, object_config)
+        if cache is not None:
+            cache.put(checksum, i, object_config.what_to_do, object_config, results[i])
+    return results
+
+
+# Quantities computed with the numpy backend for all the runs of a section at once
+batched_quantities = ["mean", "valueat1"]
+# Histogram extracted as arrays, waiting for the batched quantity, with the checksum of its input for the trend cache
+PendingQuantity = namedtuple("PendingQuantity", ["histo", "checksum"])
+# Histogram to fit with the description of its projection, waiting for the batch fit
+PendingFit = namedtuple("PendingFit", ["histo", "extra", "checksum"])
+
+
+def compute_batched(per_run, sections):
+    """
+    Replaces the histograms extracted as arrays with the quantity of their section, computed for all runs at once.
+    The results are written to the trend cache as the ones computed run by run.
+    """
+    for i in sections:
+        runs = [j for j in per_run if per_run[j] is not None and isinstance(per_run[j][i], (PendingQuantity, PendingFit))]
+        if len(runs) == 0:
+            continue
+        if sections[i].what_to_do == "functionfit":
+            fits = batch_fit([per_run[j][i].histo for j in runs],
+                             sections[i],
+                             runs=[int(j.get_run()) if j.get_run() is not None else 0 for j in runs])
+            get_fit_engine().records.extend(fits)
+            parameter_index = sections[i].parameter_index
+            title = sections[i].title
+            for j, fit in zip(runs, fits):
+                if fit["status"] != 0:
+                    print("Fit did not converge for run", j.get_run(), "in", i)
+                checksum = per_run[j][i].checksum
+                fit["extra"] = per_run[j][i].extra
+                per_run[j][i] = (fit["parameters"][parameter_index], fit["errors"][parameter_index], title, fit["extra"])
+                if checksum is not None:
+                    get_trend_cache(j.out_path).put_fit(checksum, i, sections[i], fit)
+                    get_trend_cache(j.out_path).put(checksum, i, "functionfit", sections[i], per_run[j][i])
+            continue
+        histos = [per_run[j][i].histo for j in runs]
+        if sections[i].what_to_do == "mean":
+            y, ye = batch_mean(histos)
+            titles = [f"<{h.title}>" for h in histos]
+        else:
+            y, ye = batch_value_at(histos, 1)
+            titles = ["Value at 1" + "Run number"] * len(histos)
+        for j, yj, yej, title in zip(runs, y, ye, titles):
+            checksum = per_run[j][i].checksum
+            per_run[j][i] = (float(yj), float(yej), title, None)
+            if checksum is not None:
+                get_trend_cache(j.out_path).put(checksum, i, sections[i].what_to_do, sections[i], per_run[j][i])
+    return per_run
+
+
+def extract_and_close(j, sections, draw_every_run=False, skip_non_sane_runs=True, use_cache=True):
+    """
+    Extraction of one run, the file is closed and its ROOT objects dropped once done
+    so that only the numeric results are kept in memory
+    """
+    try:
+        return extract_run(j, sections, draw_every_run=draw_every_run, skip_non_sane_runs=skip_non_sane_runs, use_cache=use_cache)
+    finally:
+        j.close()
+
+
+def init_worker(verbose, backend, reader, dry, remote_read_prefix, trace_file):
+    """
+    Sets up a spawned worker with the modes of the parent process
+    """
+    if verbose:
+        download_hyperloop_per_run.set_verbose_mode()
+    download_hyperloop_per_run.set_histogram_backend(backend)
+    download_hyperloop_per_run.set_reader_backend(reader)
+    if dry:
+        download_hyperloop_per_run.set_dry_mode()
+    if remote_read_prefix is not None:
+        download_hyperloop_per_run.set_remote_read_prefix(remote_read_prefix)
+    if trace_file is not None:
+        grid_commands.set_trace_file(trace_file)
+
+
+def extract_all(stream, sections, workers=1, draw_every_run=False, skip_non_sane_runs=True, use_cache=True):
+    """
+    Extracts the trended quantities for all the runs of the stream of (HyperloopOutput, file name).
+    Each file is opened once for all the sections and closed before the next run, whatever the size of the train.
+    With more than one worker the runs are processed in a pool of processes, each with its own ROOT.
+    Returns a dictionary {HyperloopOutput: result of `extract_run`}.
+    """
+    per_run = {}
+    interactive = [i for i in sections if sections[i].show_single_fit]
+    if workers > 1 and len(interactive) > 0:
+        # The single fits wait for the user, the workers have no input
+        print("Showing the single fits of", interactive, "processing the runs serially")
+        workers = 1
+    if workers <= 1 or draw_every_run:
+        for j, _ in stream:
+            per_run[j] = extract_and_close(j, sections,
+                                           draw_every_run=draw_every_run,
+                                           skip_non_sane_runs=skip_non_sane_runs,
+                                           use_cache=use_cache)
+        return compute_batched(per_run, sections)
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(download_hyperloop_per_run.VERBOSE_MODE,
+                                       download_hyperloop_per_run.HISTOGRAM_BACKEND,
+                                       download_hyperloop_per_run.READER_BACKEND,
+                                       download_hyperloop_per_run.DRY_MODE_RUNNING,
+                                       download_hyperloop_per_run.REMOTE_READ_PREFIX,
+                                       grid_commands.trace_file)) as executor:
+        futures = {}
+        for j, _ in stream:
+            futures[executor.submit(extract_and_close, j, sections, False, skip_non_sane_runs, use_cache)] = j
+        for future in as_completed(futures):
+            per_run[futures[future]] = future.result()
+    return compute_batched(per_run, sections)
+
+
+def trend_state_file(hyperloop_train, out_path="/tmp/"):
+    return os.path.join(out_path, f"trend_state_{hyperloop_train}.json")
+
+
+def load_trend_state(file_name):
+    """
+    Loads the state of the trend of a train: for each section the configuration hash and,
+    per run, the signature of the input file with the result computed from it
+    """
+    if not os.path.isfile(file_name):
+        return {}
+    with open(file_name) as f:
+        return json.load(f)
+
+
+def save_trend_state(file_name, state):
+    with open(file_name + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def input_signature(j):
+    """
+    Cheap signature of the input file of a run (path, size and modification time), None if there is no input
+    """
+    for i in [j.out_filename(), j.objects_filename()]:
+        if i is not None and os.path.isfile(i):
+            return [i, os.path.getsize(i), os.path.getmtime(i)]
+    return None
+
+
+def is_up_to_date(j, state, sections):
+    """
+    Checks if the run was already trended, for all the sections, from the same input and configuration
+    """
+    run = f"{j.get_run()}"
+    signature = input_signature(j)
+    for i in sections:
+        if i not in state or state[i]["config"] != config_hash(sections[i].what_to_do, sections[i]):
+            return False
+        if run not in state[i]["runs"] or state[i]["runs"][run]["signature"] != signature:
+            return False
+    return True
+
+
+def update_trend_state(state, l, sections, per_run):
+    """
+    Merges the results of the runs processed into the state.
+    Returns the results for all the runs of the list, taking the ones not processed from the state.
+    """
+    for i in sections:
+        h = config_hash(sections[i].what_to_do, sections[i])
+        if i not in state or state[i]["config"] != h:
+            state[i] = {"config": h, "runs": {}}
+    results = {}
+    for j in l:
+        run = f"{j.get_run()}"
+        if j in per_run:
+            signature = input_signature(j)
+            for i in sections:
+                result = None
+                if per_run[j] is not None:
+                    result = list(per_run[j][i])
+                state[i]["runs"][run] = {"signature": signature, "result": result}
+            results[j] = per_run[j]
+            continue
+        stored = {i: state[i]["runs"][run]["result"] for i in sections}
+        if None in stored.values():
+            results[j] = None
+        else:
+            results[j] = {i: with_current_title(tuple(stored[i]), sections[i]) for i in sections}
+    return results
+
+
 def main(hyperloop_train,
          input_configuration,
          draw_every_run=True,
          do_download=False,
          skip_non_sane_runs=True,
-         label=""):
+         label="",
+         objects_only=False,
+         jobs=1,
+         workers=1,
+         use_cache=True,
+         incremental=False,
+         export=True,
+         outlier_threshold=None):
     global trend_calls
-    trend_calls += 1
-    import os
-    if not os.path.exists(input_configuration):
-        raise ValueError(f"Configuration file {input_configuration} does not exist")
+    # The configuration is validated before anything is downloaded or read
+    sections = compile_plan(input_configuration)
     print("Using trending configuration", input_configuration)
-    parser = configparser.ConfigParser()
-    parser.read(input_configuration)
-    if do_download:
-        download_hyperloop_per_run.process_one_hyperloop_id(hyperloop_train)
+    # ROOT is imported here and not at the module level, the extraction workers import this module
+    from ROOT import TH1F, TGraph, TColor, TH1, TLegend, TGraphErrors
+    trend_calls += 1
+    run_metadata = get_run_metadata()
     l = download_hyperloop_per_run.get_run_per_run_files(train_id=hyperloop_train)
-    for i in parser.sections():
-        object_config = parser[i]
+    download_hyperloop_per_run.resolve_merge_stages(l)
+    out_path = l[0].out_path if len(l) > 0 else "/tmp/"
+    if do_download:
+        objects = None
+        if objects_only:
+            objects = sections.objects()
+        # Each run is processed as soon as its file is available, while the others are still downloading
+        stream = download_hyperloop_per_run.stream_downloads(l,
+                                                             hyperloop_train_id=hyperloop_train,
+                                                             jobs=jobs,
+                                                             objects=objects)
+    else:
+        stream = ((j, None) for j in l)
+    if incremental:
+        # Only the runs that are new or whose input changed are processed
+        state_file = trend_state_file(hyperloop_train, out_path)
+        state = load_trend_state(state_file)
+        stream = ((j, f) for j, f in stream if not is_up_to_date(j, state, sections))
+    per_run = extract_all(stream,
+                          sections,
+                          workers=workers,
+                          draw_every_run=draw_every_run,
+                          skip_non_sane_runs=skip_non_sane_runs,
+                          use_cache=use_cache)
+    get_fit_engine().summary()
+    download_hyperloop_per_run.vmsg("Cache of ROOT files and objects", get_object_cache().stats())
+    if incremental:
+        print("Trended", len(per_run), "new or changed runs out of", len(l))
+        per_run = update_trend_state(state, l, sections, per_run)
+        save_trend_state(state_file, state)
+    for i in sections:
+        object_config = sections[i]
         trend = f"trend_{i}_{trend_calls}"
         trend = TH1F(trend, trend, len(l), 0, len(l))
         trend.SetBit(TH1.kNoStats)
         trend.SetBit(TH1.kNoTitle)
-        graphs = {"skipped": TGraph(), "low": TGraph(), "high": TGraph()}
+        graphs = {"skipped": TGraph(), "low": TGraph(), "high": TGraph(), "outlier": TGraph()}
         graph_vs_rate = TGraphErrors()
         trend_objects.append(graph_vs_rate)
         graph_vs_rate.SetName("graph_vs_rate_" + i)
@@ -49,74 +365,98 @@ def main(hyperloop_train,
         graph_vs_rate.SetMarkerStyle(20)
         graph_vs_rate_split = {}
         colors = ['#e41a1c', '#377eb8', '#4daf4a', '#984ea3', '#ff7f00', '#ffff33', '#a65628', '#f781bf', '#999999']
+        # Filling in the order of the runs, whatever the order in which they were processed
         for j in l:
-            if skip_non_sane_runs and not j.exists():
-                print("Skipping", j, "something wrong with the file")
-                bin_filled = j.fill_histo(trend, i, None)
+            if per_run[j] is None:
+                bin_filled = fill_trend_bin(trend, j.get_run(), None)
                 x = trend.GetXaxis().GetBinCenter(bin_filled)
                 graphs["skipped"].AddPoint(x, 1)
                 continue
-            if not j.has_in_file(i):
-                alt_name = "perf-k0s-resolution/K0sResolution/h2_masspT"
-                j.get_as(alt_name, i)
-            if draw_every_run:
-                j.get(i)
-                x_range = None
-                y_range = None
-                draw_opt = ""
-                if "x_range" in object_config:
-                    x_range = object_config["x_range"].split(", ")
-                if "y_range" in object_config:
-                    y_range = object_config["y_range"].split(", ")
-                if "draw_opt" in object_config:
-                    draw_opt = object_config["draw_opt"]
-                j.draw(i, x_range=x_range, y_range=y_range, opt=draw_opt)
-                input(f"Plotting run {j.get_run()} press enter to continue")
-            j.fill_histo(trend, i, object_config["what_to_do"], object_config)
-        # Computing average
-        average = []
+            fill_trend_bin(trend, j.get_run(), per_run[j][i])
         run_counters = {}
         coordinates_vs_rate_per_run = {}
         for j in graphs:
             run_counters[j] = []
+        results = {int(j.get_run()): per_run[j][i] if per_run[j] is not None else None for j in l}
+        rows = []
         for j in range(1, trend.GetNbinsX()+1):
             x = trend.GetXaxis().GetBinCenter(j)
             y = trend.GetBinContent(j)
             ye = trend.GetBinError(j)
             run_number = int(trend.GetXaxis().GetBinLabel(j))
-            average.append(y)
-            if object_config["maximum_threshold"] != "None":
-                thr = float(object_config["maximum_threshold"])
+            above = False
+            below = False
+            if object_config.maximum_threshold is not None:
+                thr = object_config.maximum_threshold
                 if y > thr:
+                    above = True
                     graphs["high"].AddPoint(x, thr)
                     run_counters["high"].append(run_number)
-            if object_config["minimum_threshold"] != "None":
-                thr = float(object_config["minimum_threshold"])
+            if object_config.minimum_threshold is not None:
+                thr = object_config.minimum_threshold
                 if y < thr:
+                    below = True
                     graphs["low"].AddPoint(x, thr)
                     run_counters["low"].append(run_number)
-            if run_number in rates:
-                graph_vs_rate.AddPoint(rates[run_number], y)
-                coordinates_vs_rate_per_run[run_number] = [rates[run_number], y]
+            rate = run_metadata.get_rate(run_number)
+            if rate is not None:
+                graph_vs_rate.AddPoint(rate, y)
+                coordinates_vs_rate_per_run[run_number] = [rate, y]
                 graph_vs_rate.SetPointError(graph_vs_rate.GetN()-1, 0, ye)
             else:
                 graph_vs_rate.AddPoint(-run_number, y)
-            for k in periods:
-                if run_number in periods[k]:
-                    if k not in graph_vs_rate_split:
-                        col = TColor.GetColor(colors.pop(0))
-                        graph_vs_rate_split[k] = TGraphErrors()
-                        trend_objects.append(graph_vs_rate_split[k])
-                        graph_vs_rate_split[k].SetMarkerStyle(20 + int(trend.GetName().split("_")[-1]))
-                        graph_vs_rate_split[k].SetName(graph_vs_rate.GetName() + "_"+k)
-                        graph_vs_rate_split[k].SetTitle(k)
-                        graph_vs_rate_split[k].SetLineColor(col)
-                        graph_vs_rate_split[k].SetMarkerColor(col)
-                    print("Adding", run_number, rates[run_number], "to", k)
-                    graph_vs_rate_split[k].AddPoint(rates[run_number], y)
-                    graph_vs_rate_split[k].SetPointError(graph_vs_rate_split[k].GetN()-1, 0, ye)
-                    break
-        average = sum(average)/len(average)
+            k = run_metadata.get_period(run_number)
+            result = results.get(run_number)
+            rows.append({"run": run_number,
+                         "bin": j,
+                         "value": y,
+                         "error": ye,
+                         "skipped": result is None,
+                         "below_threshold": below,
+                         "above_threshold": above,
+                         "rate": rate,
+                         "period": k,
+                         "what_to_do": object_config.what_to_do,
+                         "ytitle": result[2] if result is not None else None,
+                         "extra": result[3] if result is not None else None})
+            if k is not None:
+                if k not in graph_vs_rate_split:
+                    col = TColor.GetColor(colors.pop(0))
+                    graph_vs_rate_split[k] = TGraphErrors()
+                    trend_objects.append(graph_vs_rate_split[k])
+                    graph_vs_rate_split[k].SetMarkerStyle(20 + int(trend.GetName().split("_")[-1]))
+                    graph_vs_rate_split[k].SetName(graph_vs_rate.GetName() + "_"+k)
+                    graph_vs_rate_split[k].SetTitle(k)
+                    graph_vs_rate_split[k].SetLineColor(col)
+                    graph_vs_rate_split[k].SetMarkerColor(col)
+                print("Adding", run_number, rate, "to", k)
+                graph_vs_rate_split[k].AddPoint(rate if rate is not None else -run_number, y)
+                graph_vs_rate_split[k].SetPointError(graph_vs_rate_split[k].GetN()-1, 0, ye)
+        values = np.array([r["value"] for r in rows])
+        threshold = object_config.outlier_threshold if object_config.outlier_threshold is not None else outlier_threshold
+        if threshold is not None:
+            # Skipped runs do not enter the baselines
+            trended = np.where([r["skipped"] for r in rows], np.nan, values)
+            if incremental:
+                # Only the flags affected by the new runs are recomputed
+                detector = OutlierDetector.from_state(state[i].get("outliers"), object_config.outlier_window, threshold)
+                flags = detector.update([r["run"] for r in rows], trended, [r["error"] for r in rows], [r["period"] for r in rows])
+                state[i]["outliers"] = detector.state()
+            else:
+                flags = flag_outliers(trended,
+                                      [r["error"] for r in rows],
+                                      [r["period"] for r in rows],
+                                      window=object_config.outlier_window,
+                                      threshold=threshold)
+            for k in np.flatnonzero(flags["outlier"]):
+                graphs["outlier"].AddPoint(trend.GetXaxis().GetBinCenter(rows[k]["bin"]), rows[k]["value"])
+                run_counters["outlier"].append(rows[k]["run"])
+            for k, r in enumerate(rows):
+                r.update({"z_score": float(flags["z"][k]), "z_score_period": float(flags["z_period"][k]), "outlier": bool(flags["outlier"][k])})
+        if export:
+            print("Trend written to", get_trend_store(out_path).write(hyperloop_train, i, rows))
+        # Computing average
+        average = float(values.mean()) if len(values) > 0 else 0.
         for j in range(graphs["skipped"].GetN()):
             graphs["skipped"].SetPoint(j, graphs["skipped"].GetPointX(j), average)
             run_counters["skipped"].append(j)
@@ -128,8 +468,8 @@ def main(hyperloop_train,
                 extra_label = draw_label(trend.GetListOfFunctions()[0].GetTitle(), align=33, x=0.92, y=0.90)
         trend_objects.append(trend)
 
-        colours = {"skipped": "#e41a1c", "low": "#377eb8", "high": "#4daf4a"}
-        markers = {"skipped": 4, "low": 22, "high": 23}
+        colours = {"skipped": "#e41a1c", "low": "#377eb8", "high": "#4daf4a", "outlier": "#ff7f00"}
+        markers = {"skipped": 4, "low": 22, "high": 23, "outlier": 28}
         for j in graphs:
             g = graphs[j]
             if g.GetN() == 0:
@@ -174,6 +514,9 @@ def main(hyperloop_train,
             input("Press enter to continue (before save)")
             can_vs_rate.SaveAs("/tmp/trend_vs_rate" + i.replace("/", "_") + ".png")
             can_vs_rate.SaveAs("/tmp/trend_vs_rate" + i.replace("/", "_") + ".pdf")
+    if incremental:
+        # With the outlier flags of the trends
+        save_trend_state(state_file, state)
     input("Press enter to continue")
 
 
@@ -189,6 +532,38 @@ if __name__ == "__main__":
     parser.add_argument("--download", "-d",
                         help="Download the output (to be ran on the first time only)",
                         action="store_true")
+    parser.add_argument("--objects_only",
+                        help="Download only the objects requested in the configuration instead of the full files",
+                        action="store_true")
+    parser.add_argument("--jobs", "-j",
+                        type=int,
+                        default=1,
+                        help="Number of concurrent downloads, runs are processed while the others are downloading")
+    parser.add_argument("--workers", "-w",
+                        type=int,
+                        default=1,
+                        help="Number of processes extracting the trended quantities, not used when drawing every run")
+    parser.add_argument("--no_cache",
+                        action="store_true",
+                        help="Recompute all the quantities instead of using the ones cached for the same file and configuration")
+    parser.add_argument("--incremental", "-I",
+                        action="store_true",
+                        help="Process only the runs that are new or changed since the last trend of the same train")
+    parser.add_argument("--backend",
+                        choices=["root", "numpy"],
+                        default="root",
+                        help="Backend for the histogram statistics, with `numpy` the means, values and gaus+polN fits are computed for all runs at once")
+    parser.add_argument("--reader",
+                        choices=["root", "uproot"],
+                        default="root",
+                        help="Backend to read the objects, with `uproot` the histograms are read without ROOT (used only for fits and drawing)")
+    parser.add_argument("--no_export",
+                        action="store_true",
+                        help="Do not write the trends in the columnar store of the output path, see `trend_store.py`")
+    parser.add_argument("--outliers", "-z",
+                        type=float,
+                        default=None,
+                        help="Flag the runs deviating more than this z-score from the rolling and per period medians, see `trend_outliers.py`. The `outlier_threshold` and `outlier_window` keys of a section override it")
     parser.add_argument("--draw_every_run", "-D", "--single",
                         help="Download the output (to be ran on the first time only)",
                         action="store_true")
@@ -197,14 +572,30 @@ if __name__ == "__main__":
                         default="")
     parser.add_argument("--verbose", "-v", action="store_true",
                         help="Increase verbosity")
+    parser.add_argument("--trace",
+                        default=None,
+                        help="File where to record a trace of the grid commands and file reads")
 
     args = parser.parse_args()
     if args.verbose:
         download_hyperloop_per_run.set_verbose_mode()
+    if args.trace is not None:
+        download_hyperloop_per_run.set_trace_file(args.trace)
+    download_hyperloop_per_run.set_histogram_backend(args.backend)
+    download_hyperloop_per_run.set_reader_backend(args.reader)
 
+    if len(args.hyperloop_train_ids) > 1:
+        get_fetcher().fetch_many(args.hyperloop_train_ids)
     for i in args.hyperloop_train_ids:
         main(i,
              label=args.label,
              input_configuration=args.input_configuration,
              do_download=args.download,
+             objects_only=args.objects_only,
+             jobs=args.jobs,
+             workers=args.workers,
+             use_cache=not args.no_cache,
+             incremental=args.incremental,
+             export=not args.no_export,
+             outlier_threshold=args.outliers,
              draw_every_run=args.draw_every_run)
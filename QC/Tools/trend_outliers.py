@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+"""
+Robust flagging of the outlier runs of a trend, computed on the whole trend at once.
+Each run is compared with the median of the neighbouring runs (rolling median, the spread is the rolling MAD)
+and with the median of the runs of its period. The z-scores combine the robust spread and the error of the run,
+runs with |z| above the threshold in either comparison are outliers.
+Skipped runs (NaN values) are ignored in the baselines.
+Example usage: `./trend_outliers.py -t <train> -s <section>` to flag the outliers of a trend written with `trend_store.py`
+"""
+
+import warnings
+import numpy as np
+
+# Scale factor from the MAD to the standard deviation for a gaussian distribution
+mad_to_sigma = 1.4826
+
+
+def rolling_median_mad(values, window=11):
+    """
+    Median and MAD of the `window` runs centered on each run (shorter windows at the edges)
+    """
+    values = np.asarray(values, dtype=float)
+    half = window // 2
+    padded = np.concatenate([np.full(half, np.nan), values, np.full(half, np.nan)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1)
+    # Windows with only skipped runs give NaN
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(windows, axis=1)
+        mad = np.nanmedian(np.abs(windows - median[:, None]), axis=1)
+    return median, mad
+
+
+def period_median_mad(values, periods):
+    """
+    Median and MAD of the runs of the same period, NaN for runs without period
+    """
+    values = np.asarray(values, dtype=float)
+    periods = np.asarray([i if i is not None else "" for i in periods])
+    median = np.full(len(values), np.nan)
+    mad = np.full(len(values), np.nan)
+    names, inverse = np.unique(periods, return_inverse=True)
+    for k, name in enumerate(names):
+        if name == "":
+            continue
+        in_period = inverse == k
+        v = values[in_period]
+        v = v[np.isfinite(v)]
+        if len(v) == 0:
+            continue
+        m = np.median(v)
+        median[in_period] = m
+        mad[in_period] = np.median(np.abs(v - m))
+    return median, mad
+
+
+def z_scores(values, errors, median, mad):
+    """
+    Deviation from the baseline in units of the robust spread and of the error of the run combined
+    """
+    values = np.asarray(values, dtype=float)
+    errors = np.zeros(len(values)) if errors is None else np.asarray(errors, dtype=float)
+    scale = np.sqrt((mad_to_sigma * mad)**2 + errors**2)
+    with np.errstate(all="ignore"):
+        z = np.where(scale > 0, (values - median) / scale, 0.)
+    return np.where(np.isfinite(z), z, 0.)
+
+
+def flag_outliers(values, errors=None, periods=None, window=11, threshold=5.):
+    """
+    Flags the outliers of a trend, `values`, `errors` and `periods` have one entry per run in the order of the runs.
+    Returns a dictionary of arrays: `median` and `mad` (rolling), `z` (rolling), `z_period` (0 if no period) and `outlier`
+    """
+    values = np.asarray(values, dtype=float)
+    median, mad = rolling_median_mad(values, window)
+    flags = {"median": median, "mad": mad, "z": z_scores(values, errors, median, mad)}
+    flags["z_period"] = np.zeros(len(values))
+    if periods is not None:
+        flags["z_period"] = z_scores(values, errors, *period_median_mad(values, periods))
+    flags["outlier"] = np.isfinite(values) & ((np.abs(flags["z"]) > threshold) | (np.abs(flags["z_period"]) > threshold))
+    return flags
+
+
+class OutlierDetector:
+    def __init__(self, window=11, threshold=5.):
+        """
+        Outlier flags of a trend updated when runs are appended: only the runs whose rolling window
+        or period changed are recomputed
+        """
+        self.window = window
+        self.threshold = threshold
+        self.runs = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros(0)
+        self.errors = np.zeros(0)
+        self.periods = np.zeros(0, dtype=object)
+        self.flags = {k: np.zeros(0) for k in ["median", "mad", "z", "z_period"]}
+        self.flags["outlier"] = np.zeros(0, dtype=bool)
+
+    def append(self, runs, values, errors=None, periods=None):
+        """
+        Appends runs (after the ones already known) and returns the indices of the runs whose flags were recomputed
+        """
+        n = len(self.values)
+        values = np.asarray(values, dtype=float)
+        self.runs = np.concatenate([self.runs, np.asarray(runs, dtype=np.int64)])
+        self.values = np.concatenate([self.values, values])
+        self.errors = np.concatenate([self.errors, np.zeros(len(values)) if errors is None else np.asarray(errors, dtype=float)])
+        self.periods = np.concatenate([self.periods, np.array([None] * len(values) if periods is None else list(periods), dtype=object)])
+        for k in self.flags:
+            self.flags[k] = np.concatenate([self.flags[k], np.zeros(len(values), dtype=self.flags[k].dtype)])
+        # The rolling windows of the last runs already known now include the new runs
+        first = max(0, n - self.window // 2)
+        start = max(0, first - self.window // 2)
+        median, mad = rolling_median_mad(self.values[start:], self.window)
+        updated = np.arange(first, len(self.values))
+        self.flags["median"][updated] = median[first - start:]
+        self.flags["mad"][updated] = mad[first - start:]
+        self.flags["z"][updated] = z_scores(self.values[updated], self.errors[updated], median[first - start:], mad[first - start:])
+        # The baselines of the periods of the new runs change for all their runs
+        new_periods = set(self.periods[n:].tolist()) - {None}
+        in_new_periods = np.flatnonzero([i in new_periods for i in self.periods])
+        if len(in_new_periods) > 0:
+            p_median, p_mad = period_median_mad(self.values[in_new_periods], self.periods[in_new_periods])
+            self.flags["z_period"][in_new_periods] = z_scores(self.values[in_new_periods], self.errors[in_new_periods], p_median, p_mad)
+        updated = np.union1d(updated, in_new_periods)
+        self.flags["outlier"][updated] = np.isfinite(self.values[updated]) & ((np.abs(self.flags["z"][updated]) > self.threshold) |
+                                                                             (np.abs(self.flags["z_period"][updated]) > self.threshold))
+        return updated
+
+    def update(self, runs, values, errors=None, periods=None):
+        """
+        Flags of the whole trend given in the order of the runs. If the runs already known are the first ones,
+        unchanged, only the new runs are appended, otherwise all the flags are recomputed. Returns the flags.
+        """
+        runs = np.asarray(runs, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        errors = np.zeros(len(values)) if errors is None else np.asarray(errors, dtype=float)
+        periods = [None] * len(values) if periods is None else list(periods)
+        n = len(self.runs)
+        appended = (n <= len(runs) and np.array_equal(self.runs, runs[:n])
+                    and np.array_equal(self.values, values[:n], equal_nan=True)
+                    and np.array_equal(self.errors, errors[:n], equal_nan=True)
+                    and self.periods.tolist() == periods[:n])
+        if not appended:
+            self.__init__(self.window, self.threshold)
+            n = 0
+        self.append(runs[n:], values[n:], errors[n:], periods[n:])
+        return self.flags
+
+    def state(self):
+        """
+        State of the detector that can be written as JSON, to be restored with `from_state`
+        """
+        state = {"window": self.window,
+                 "threshold": self.threshold,
+                 "runs": self.runs.tolist(),
+                 "values": self.values.tolist(),
+                 "errors": self.errors.tolist(),
+                 "periods": self.periods.tolist()}
+        state["flags"] = {k: v.tolist() for k, v in self.flags.items()}
+        return state
+
+    @classmethod
+    def from_state(cls, state, window=11, threshold=5.):
+        """
+        Detector restored from its state, a new one if there is no state or it was computed with other settings
+        """
+        detector = cls(window, threshold)
+        if state is None or state["window"] != window or state["threshold"] != threshold:
+            return detector
+        detector.runs = np.array(state["runs"], dtype=np.int64)
+        detector.values = np.array(state["values"], dtype=float)
+        detector.errors = np.array(state["errors"], dtype=float)
+        detector.periods = np.array(state["periods"], dtype=object)
+        detector.flags = {k: np.array(v, dtype=detector.flags[k].dtype) for k, v in state["flags"].items()}
+        return detector
+
+    def outliers(self):
+        return self.runs[self.flags["outlier"]].tolist()
+
+
+def main():
+    import argparse
+    from trend_store import get_trend_store
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--out_path", "-o",
+                        default="/tmp/",
+                        help="Output path where the trend store is located. Default: `/tmp/`")
+    parser.add_argument("--train", "-t",
+                        type=int,
+                        default=None,
+                        help="Train to consider, all by default (the runs of all the trains are then in the same trend)")
+    parser.add_argument("--section", "-s",
+                        required=True,
+                        help="Section of the trending configuration to consider")
+    parser.add_argument("--window",
+                        type=int,
+                        default=11,
+                        help="Number of runs of the rolling median. Default: 11")
+    parser.add_argument("--threshold", "-z",
+                        type=float,
+                        default=5.,
+                        help="Threshold on the absolute z-score. Default: 5")
+    args = parser.parse_args()
+    rows = sorted(get_trend_store(args.out_path).read(args.train, args.section), key=lambda x: (x["run"], x["train"]))
+    values = [i["value"] if not i["skipped"] else np.nan for i in rows]
+    flags = flag_outliers(values, [i["error"] for i in rows], [i["period"] for i in rows], args.window, args.threshold)
+    print(int(flags["outlier"].sum()), "outliers out of", len(rows), "runs")
+    for k in np.flatnonzero(flags["outlier"]):
+        print(f"  {rows[k]['run']} (train {rows[k]['train']}) {values[k]} z = {flags['z'][k]:.1f}, z in period = {flags['z_period'][k]:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Extraction plan of the trending, compiled once from the `.ini` configuration of `trend_hyperloop.py`.
+Each section (object to trend) is parsed and validated before anything is downloaded or read: quantity, fit model
+(function, fit range, initial parameters and parameter ranges), projection, thresholds and drawing options.
+All the errors of the configuration are reported at once with a `ValueError`.
+The trending title of the fits can be given with `trending_title` or with the legacy `treding_title` key.
+Objects named differently in older outputs are read from the comma separated `alternative_names` of their section.
+Example usage: `./trend_plan.py trendConfig/k0s.ini` to check a configuration and print its plan
+"""
+
+import os
+import configparser
+from trend_fit import parse_function
+
+quantities = ["mean", "valueat1", "functionfit"]
+# Keys used by the trending, the others are reported as unknown
+known_keys = ["what_to_do", "minimum_threshold", "maximum_threshold", "x_range", "y_range", "draw_opt",
+              "function", "fit_range", "fit_opt", "initial_parameters", "parameterindex",
+              "trending_title", "treding_title", "projection", "projection_range",
+              "show_single_fit", "show_single_fit_range", "outlier_threshold", "outlier_window",
+              "alternative_names"]
+# Names under which the objects can be found in the outputs of older tasks, if `alternative_names` is not given
+default_alternative_names = {"perf-k0s-resolution/h2_masspT": ["perf-k0s-resolution/K0sResolution/h2_masspT"]}
+
+
+def parse_floats(value, name, errors, size=None):
+    """
+    Parses a comma separated list of numbers, the errors are appended to `errors`
+    """
+    try:
+        values = [float(i) for i in value.split(",")]
+    except ValueError:
+        errors.append(f"{name} = '{value}' is not a list of numbers")
+        return None
+    if size is not None and len(values) != size:
+        errors.append(f"{name} = '{value}' should have {size} values")
+        return None
+    return values
+
+
+def parse_interval(value, name, errors):
+    values = parse_floats(value, name, errors, size=2)
+    if values is not None and values[0] >= values[1]:
+        errors.append(f"{name} = '{value}' is not an increasing interval")
+        return None
+    return values
+
+
+def parse_optional_float(value, name, errors):
+    if value is None or value.strip() == "None":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        errors.append(f"{name} = '{value}' is not a number or None")
+        return None
+
+
+class SectionPlan(dict):
+    """
+    Configuration of a section: the keys of the `.ini` (as strings) with their parsed and validated values as attributes
+    """
+
+    def __init__(self, name, option):
+        super().__init__({k: v for k, v in option.items()})
+        self.name = name
+        self.errors = []
+        self.unknown_keys = [i for i in self if i not in known_keys and not i.startswith("par_range")]
+        e = self.errors
+        self.what_to_do = None
+        if "what_to_do" not in self:
+            e.append(f"what_to_do is required, one of {quantities}")
+        elif self["what_to_do"].strip() not in quantities:
+            e.append(f"what_to_do = '{self['what_to_do'].strip()}' is not one of {quantities}")
+        else:
+            self.what_to_do = self["what_to_do"].strip()
+        self.minimum_threshold = parse_optional_float(self.get("minimum_threshold"), "minimum_threshold", e)
+        self.maximum_threshold = parse_optional_float(self.get("maximum_threshold"), "maximum_threshold", e)
+        self.outlier_threshold = parse_optional_float(self.get("outlier_threshold"), "outlier_threshold", e)
+        self.outlier_window = 11
+        if "outlier_window" in self:
+            try:
+                self.outlier_window = int(self["outlier_window"])
+            except ValueError:
+                e.append(f"outlier_window = '{self['outlier_window']}' is not an integer")
+        self.x_range = parse_floats(self["x_range"], "x_range", e, size=2) if "x_range" in self else None
+        self.y_range = parse_floats(self["y_range"], "y_range", e, size=2) if "y_range" in self else None
+        self.draw_opt = self.get("draw_opt", "")
+        # Names to read the object from when it is not in the output
+        self.alternative_names = default_alternative_names.get(name, [])
+        if "alternative_names" in self:
+            self.alternative_names = [i.strip() for i in self["alternative_names"].split(",") if i.strip() != ""]
+        # Projection of two dimensional histograms
+        self.projection = self.get("projection", "").strip() or None
+        if self.projection not in [None, "x", "y"]:
+            e.append(f"projection = '{self.projection}' is not x or y")
+        self.projection_range = None
+        if "projection_range" in self:
+            self.projection_range = parse_interval(self["projection_range"], "projection_range", e)
+        # Fit model
+        self.function = None
+        self.fit_range = None
+        self.initial_parameters = None
+        self.par_ranges = {}
+        self.parameter_index = None
+        self.title = None
+        self.batch_npol = None
+        self.show_single_fit = self.get("show_single_fit", "false").strip().lower() == "true"
+        self.show_single_fit_range = None
+        if "show_single_fit_range" in self:
+            self.show_single_fit_range = parse_interval(self["show_single_fit_range"], "show_single_fit_range", e)
+        if "trending_title" in self and "treding_title" in self and self["trending_title"] != self["treding_title"]:
+            e.append("trending_title and treding_title are both set and different")
+        if "trending_title" in self or "treding_title" in self:
+            self.title = self.get("trending_title", self.get("treding_title")).strip().strip("\"")
+        if self.what_to_do == "functionfit":
+            self.compile_fit()
+
+    def compile_fit(self):
+        e = self.errors
+        for i in ["function", "fit_range", "initial_parameters", "parameterindex"]:
+            if i not in self:
+                e.append(f"{i} is required for functionfit")
+        if self.title is None:
+            e.append("trending_title (or treding_title) is required for functionfit")
+        if "function" in self:
+            self.function = self["function"].strip()
+            self.batch_npol = parse_function(self.function)
+        if "fit_range" in self:
+            self.fit_range = parse_interval(self["fit_range"], "fit_range", e)
+        if "initial_parameters" in self:
+            self.initial_parameters = parse_floats(self["initial_parameters"], "initial_parameters", e)
+        npar = None if self.initial_parameters is None else len(self.initial_parameters)
+        if self.batch_npol is not None and npar is not None and npar > 3 + self.batch_npol + 1:
+            e.append(f"initial_parameters has {npar} values, {self.function} has {3 + self.batch_npol + 1} parameters")
+        for i in self:
+            if not i.startswith("par_range"):
+                continue
+            try:
+                index = int(i[len("par_range"):])
+            except ValueError:
+                e.append(f"{i} is not a parameter range (par_range<index>)")
+                continue
+            if npar is not None and index >= npar:
+                e.append(f"{i} refers to parameter {index}, only {npar} initial parameters are given")
+                continue
+            r = parse_interval(self[i], i, e)
+            if r is not None:
+                self.par_ranges[index] = r
+        if "parameterindex" in self:
+            try:
+                self.parameter_index = int(self["parameterindex"])
+            except ValueError:
+                e.append(f"parameterindex = '{self['parameterindex']}' is not an integer")
+            if self.parameter_index is not None and npar is not None and not 0 <= self.parameter_index < npar:
+                e.append(f"parameterindex = {self.parameter_index} is not one of the {npar} parameters")
+        if self.projection_range is not None and self.projection is None:
+            e.append("projection (x or y) is required with projection_range")
+
+    def is_batch_fit(self):
+        """
+        The fit can be done for all the runs at once with `trend_fit.batch_fit`
+        """
+        return self.what_to_do == "functionfit" and self.batch_npol is not None
+
+    def __reduce__(self):
+        # Pickled as the keys of the configuration, the plan is compiled again in the worker processes
+        return (SectionPlan, (self.name, dict(self)))
+
+
+def section_plan(option, name=""):
+    """
+    Returns the compiled plan of a section, `option` can be a section already compiled or a mapping of the keys
+    """
+    if isinstance(option, SectionPlan):
+        return option
+    plan = SectionPlan(name, option)
+    if len(plan.errors) > 0:
+        raise ValueError(f"Configuration of {name} not valid: " + "; ".join(plan.errors))
+    return plan
+
+
+class TrendPlan(dict):
+    """
+    Compiled plan of a configuration: the sections (in the order of the file) by name
+    """
+
+    def __init__(self, sections, input_configuration=""):
+        super().__init__()
+        self.input_configuration = input_configuration
+        errors = []
+        for i in sections:
+            self[i] = SectionPlan(i, sections[i])
+            errors += [f"[{i}] {j}" for j in self[i].errors]
+        if len(errors) > 0:
+            raise ValueError(f"Configuration {input_configuration} not valid:\n  " + "\n  ".join(errors))
+        for i in self:
+            if len(self[i].unknown_keys) > 0:
+                print(f"Unknown keys in [{i}] of {input_configuration}, they are not used:", self[i].unknown_keys)
+
+    def objects(self):
+        """
+        Objects to read from the output of each run, e.g. for the selective download, with their alternative names
+        """
+        objects = []
+        for i in self:
+            objects += [j for j in [i] + self[i].alternative_names if j not in objects]
+        return objects
+
+
+def compile_plan(input_configuration):
+    """
+    Reads and compiles the `.ini` configuration, raises ValueError if it is not valid
+    """
+    if not os.path.exists(input_configuration):
+        raise ValueError(f"Configuration file {input_configuration} does not exist")
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(input_configuration)
+    except configparser.Error as e:
+        raise ValueError(f"Configuration file {input_configuration} cannot be parsed: {e}")
+    return TrendPlan({i: dict(parser[i]) for i in parser.sections()}, input_configuration)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_configurations",
+                        nargs="+",
+                        help="Configurations to check")
+    args = parser.parse_args()
+    for i in args.input_configurations:
+        plan = compile_plan(i)
+        print(i, "is valid,", len(plan), "sections")
+        for j in plan.values():
+            print(f"  [{j.name}] {j.what_to_do}", end="")
+            if j.what_to_do == "functionfit":
+                print(f" {j.function} in {j.fit_range} from {j.initial_parameters}, parameter {j.parameter_index}:",
+                      f"'{j.title}'", "(batch fit)" if j.is_batch_fit() else "", end="")
+            print(f" thresholds {j.minimum_threshold}, {j.maximum_threshold}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""
+Columnar store of the trends computed by `trend_hyperloop.py`, so that trends of different trains can be compared
+without reprocessing the ROOT files.
+One row per run and trended quantity (value, error, rate, period, threshold flags, ...) is written in Parquet files
+(CSV if `pyarrow` is not available) partitioned by train and section:
+`<out_path>/trend_store/train=<train>/section=<section>/trend.parquet`.
+Each new trend of a train and section replaces the previous one.
+Example usage: `./trend_store.py` to list the stored trends, `./trend_store.py -s <section>` to print the values of
+a section for all the trains, `./trend_store.py -t <train> -s <section> --csv out.csv` to export them
+"""
+
+import os
+import csv
+import time
+from urllib.parse import quote, unquote
+
+store_directory = "trend_store"
+columns = ["train", "section", "run", "bin", "value", "error", "skipped", "below_threshold", "above_threshold",
+           "z_score", "z_score_period", "outlier", "rate", "period", "what_to_do", "ytitle", "extra", "time"]
+column_types = {"train": int, "run": int, "bin": int, "value": float, "error": float, "rate": float,
+                "skipped": bool, "below_threshold": bool, "above_threshold": bool,
+                "z_score": float, "z_score_period": float, "outlier": bool, "time": float}
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def has_parquet():
+    return pyarrow is not None
+
+
+def schema():
+    types = {int: pyarrow.int64(), float: pyarrow.float64(), bool: pyarrow.bool_()}
+    return pyarrow.schema([(k, types.get(column_types.get(k), pyarrow.string())) for k in columns])
+
+
+class TrendStore:
+    def __init__(self, out_path="/tmp/", file_format=None):
+        """
+        Store in `out_path`, `file_format` is "parquet" or "csv", by default parquet if `pyarrow` is available
+        """
+        self.path = os.path.join(os.path.abspath(out_path), store_directory)
+        if file_format is None:
+            file_format = "parquet" if has_parquet() else "csv"
+        if file_format == "parquet" and not has_parquet():
+            print("pyarrow is not available, writing the trends as CSV. Install it with `pip install pyarrow`")
+            file_format = "csv"
+        if file_format not in ["parquet", "csv"]:
+            raise ValueError(f"Format {file_format} not supported, use parquet or csv")
+        self.file_format = file_format
+
+    def partition(self, train, section):
+        return os.path.join(self.path, f"train={train}", "section=" + quote(section, safe=""))
+
+    def write(self, train, section, rows):
+        """
+        Writes the rows of the trend of a section of a train, replacing the previous ones
+        """
+        partition = self.partition(train, section)
+        os.makedirs(partition, exist_ok=True)
+        now = time.time()
+        rows = [{k: i.get(k) for k in columns} for i in rows]
+        for i in rows:
+            i.update({"train": int(train), "section": section, "time": now})
+        file_name = os.path.join(partition, "trend." + self.file_format)
+        tmp_file_name = file_name + ".tmp"
+        if self.file_format == "parquet":
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows, schema=schema()), tmp_file_name)
+        else:
+            with open(tmp_file_name, "w", newline="") as f:
+                w = csv.DictWriter(f, fieldnames=columns, lineterminator="\n")
+                w.writeheader()
+                w.writerows({k: ("" if i[k] is None else i[k]) for k in columns} for i in rows)
+        os.replace(tmp_file_name, file_name)
+        # A trend written before in the other format is now outdated
+        for i in os.listdir(partition):
+            if i.startswith("trend.") and i != os.path.basename(file_name) and not i.endswith(".tmp"):
+                os.remove(os.path.join(partition, i))
+        return file_name
+
+    def partitions(self, train=None, section=None):
+        """
+        List of (train, section, file) stored, optionally only for a train and/or a section
+        """
+        found = []
+        if not os.path.isdir(self.path):
+            return found
+        for i in sorted(os.listdir(self.path)):
+            if not i.startswith("train="):
+                continue
+            t = int(i.split("=", 1)[1])
+            if train is not None and t != int(train):
+                continue
+            for j in sorted(os.listdir(os.path.join(self.path, i))):
+                if not j.startswith("section="):
+                    continue
+                s = unquote(j.split("=", 1)[1])
+                if section is not None and s != section:
+                    continue
+                for k in sorted(os.listdir(os.path.join(self.path, i, j))):
+                    if k in ["trend.parquet", "trend.csv"]:
+                        found.append((t, s, os.path.join(self.path, i, j, k)))
+        return found
+
+    def read(self, train=None, section=None):
+        """
+        Rows (as dictionaries) of the stored trends, optionally only for a train and/or a section
+        """
+        rows = []
+        for t, s, file_name in self.partitions(train, section):
+            rows += read_file(file_name)
+        return rows
+
+    def read_table(self, train=None, section=None):
+        """
+        Stored trends as a single `pyarrow.Table`, for the queries on many trains
+        """
+        if not has_parquet():
+            raise ValueError("pyarrow is needed to read the trends as a table")
+        return pyarrow.Table.from_pylist(self.read(train, section), schema=schema())
+
+
+def read_file(file_name):
+    if file_name.endswith(".parquet"):
+        if not has_parquet():
+            print("pyarrow is not available, cannot read", file_name)
+            return []
+        return pyarrow.parquet.read_table(file_name).to_pylist()
+    with open(file_name, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for i in rows:
+        for k in i:
+            if i[k] == "":
+                i[k] = None
+            elif column_types.get(k) is bool:
+                i[k] = i[k] == "True"
+            elif k in column_types:
+                i[k] = column_types[k](i[k])
+    return rows
+
+
+stores = {}
+
+
+def get_trend_store(out_path="/tmp/", file_format=None):
+    """
+    Returns the store of the output path, created only once per process
+    """
+    key = (os.path.abspath(out_path), file_format)
+    if key not in stores:
+        stores[key] = TrendStore(out_path, file_format)
+    return stores[key]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--out_path", "-o",
+                        default="/tmp/",
+                        help="Output path where the store is located. Default: `/tmp/`")
+    parser.add_argument("--train", "-t",
+                        type=int,
+                        default=None,
+                        help="Train to consider, all by default")
+    parser.add_argument("--section", "-s",
+                        default=None,
+                        help="Section of the trending configuration to consider, all by default")
+    parser.add_argument("--csv",
+                        default=None,
+                        help="Write the selected rows in this CSV file")
+    args = parser.parse_args()
+    store = get_trend_store(args.out_path)
+    if args.csv is not None:
+        rows = store.read(args.train, args.section)
+        with open(args.csv, "w", newline="") as f:
+            w = csv.DictWriter(f, fieldnames=columns, lineterminator="\n")
+            w.writeheader()
+            w.writerows(rows)
+        print("Written", len(rows), "rows to", args.csv)
+        return
+    if args.section is None:
+        partitions = store.partitions(args.train)
+        print(len(partitions), "trends in", store.path)
+        for t, s, file_name in partitions:
+            print(f"  train {t} section {s}: {file_name}")
+        return
+    for i in store.read(args.train, args.section):
+        flags = [k for k in ["skipped", "below_threshold", "above_threshold", "outlier"] if i.get(k)]
+        print(f"  {i['train']} {i['run']} {i['value']} +- {i['error']} rate {i['rate']} period {i['period']}", *flags)
+
+
+if __name__ == "__main__":
+    main()